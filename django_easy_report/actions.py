@@ -41,3 +41,14 @@ def generate_report(modeladmin, request, queryset):
         generate_report_task.delay(query.pk)
 
         modeladmin.message_user(request, gettext('Report queued ({}).').format(query.pk), messages.SUCCESS)
+
+
+def cancel_report(modeladmin, request, queryset):
+    canceled = 0
+    for query in queryset:
+        if query.cancel():
+            canceled += 1
+    modeladmin.message_user(request, gettext('{} reports canceled.').format(canceled), messages.SUCCESS)
+
+
+cancel_report.short_description = gettext('Cancel selected reports')
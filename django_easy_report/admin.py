@@ -2,12 +2,13 @@ import json
 
 from django.contrib import admin
 
-from django_easy_report.actions import generate_report
+from django_easy_report.actions import generate_report, cancel_report
 from django_easy_report.models import (
     ReportSender,
     ReportGenerator,
     ReportQuery,
     ReportRequester,
+    ReportTiming,
     SecretKey,
     SecretReplace,
 )
@@ -49,7 +50,7 @@ class ReportSenderAdmin(admin.ModelAdmin):
         }),
         ('Email', {
             'classes': ('collapse',),
-            'fields': ('email_from', 'size_to_attach'),
+            'fields': ('email_from', 'size_to_attach', 'compress_attachment', 'digest_window', 'digest_max_items'),
         }),
         ('Storage', {
             'classes': ('collapse',),
@@ -81,10 +82,24 @@ class ReportGeneratorAdmin(admin.ModelAdmin):
     actions = [generate_report]
 
 
+class ReportTimingInline(admin.TabularInline):
+    model = ReportTiming
+    fields = ('attempt', 'phase', 'seconds', 'created_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):  # pragma: no cover
+        return False
+
+
 @admin.register(ReportQuery)
 class ReportQueryAdmin(admin.ModelAdmin):
-    list_display = ('status', 'report')
-    actions = [generate_report]
+    list_display = ('status', 'report', 'file_size', 'rows', 'total_rows', 'attempts', 'heartbeat_at')
+    actions = [generate_report, cancel_report]
+    inlines = [
+        ReportTimingInline,
+    ]
 
     def has_add_permission(self, request):  # pragma: no cover
         return False
@@ -103,3 +118,15 @@ class ReportRequesterAdmin(admin.ModelAdmin):
 
     def has_change_permission(self, request, obj=None):  # pragma: no cover
         return False
+
+
+@admin.register(ReportTiming)
+class ReportTimingAdmin(admin.ModelAdmin):
+    list_display = ('query', 'attempt', 'phase', 'seconds')
+    list_filter = ('phase', 'query__report')
+
+    def has_add_permission(self, request):  # pragma: no cover
+        return False
+
+    def has_change_permission(self, request, obj=None):  # pragma: no cover
+        return False
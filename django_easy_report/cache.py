@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+    Thread safe in process cache, with LRU eviction and optional expiration time
+    """
+
+    def __init__(self, max_size=None, ttl=None, on_evict=None):
+        """
+        :param max_size: Max number of items, None for unlimited
+        :type max_size: int|None
+        :param ttl: Default seconds until an item expire, None for never
+        :type ttl: int|float|None
+        :param on_evict: Function called with the value of each item removed from the cache
+        :type on_evict: callable|None
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None, transform=None):
+        """
+        :param transform: Function applied to the value while the lock is held,
+            for example to copy a value that on_evict could change
+        :type transform: callable|None
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, expire_at = self._items[key]
+            if expire_at is not None and expire_at <= time.monotonic():
+                self._evict(key)
+                return default
+            self._items.move_to_end(key)
+            if transform:
+                return transform(value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expire_at = None
+        if ttl:
+            expire_at = time.monotonic() + ttl
+        with self._lock:
+            if key in self._items:
+                self._evict(key)
+            self._items[key] = (value, expire_at)
+            while self.max_size and len(self._items) > self.max_size:
+                self._evict(next(iter(self._items)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items:
+                self._evict(key)
+
+    def delete_if(self, condition):
+        """
+        :param condition: Function called with each key, the item is removed if return True
+        :type condition: callable
+        """
+        with self._lock:
+            for key in [key for key in self._items if condition(key)]:
+                self._evict(key)
+
+    def clear(self):
+        self.delete_if(lambda key: True)
+
+    def _evict(self, key):
+        value, _ = self._items.pop(key)
+        if self.on_evict:
+            self.on_evict(value)
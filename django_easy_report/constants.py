@@ -4,10 +4,28 @@ STATUS_CREATED = 0
 STATUS_WORKING = 10
 STATUS_DONE = 20
 STATUS_ERROR = 30
+STATUS_CANCELED = 40
 
 STATUS_OPTIONS = [
     (STATUS_CREATED, _('Created')),
     (STATUS_WORKING, _('Working')),
     (STATUS_DONE, _('Done')),
-    (STATUS_ERROR, _('Error'))
+    (STATUS_ERROR, _('Error')),
+    (STATUS_CANCELED, _('Canceled')),
+]
+
+TIMING_QUEUE = 'queue'
+TIMING_QUERY = 'query'
+TIMING_RENDER = 'render'
+TIMING_GENERATE = 'generate'
+TIMING_UPLOAD = 'upload'
+TIMING_NOTIFY = 'notify'
+
+TIMING_OPTIONS = [
+    (TIMING_QUEUE, _('Queue wait')),
+    (TIMING_QUERY, _('Query')),
+    (TIMING_RENDER, _('Render')),
+    (TIMING_GENERATE, _('Generate')),
+    (TIMING_UPLOAD, _('Upload')),
+    (TIMING_NOTIFY, _('Notify')),
 ]
@@ -1,3 +1,7 @@
 
 class DoNotSend(Exception):
     pass
+
+
+class ReportCanceled(Exception):
+    pass
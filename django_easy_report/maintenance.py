@@ -0,0 +1,527 @@
+import datetime
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from django_easy_report.constants import STATUS_DONE, STATUS_ERROR, STATUS_CANCELED
+from django_easy_report.models import ReportQuery, ReportRequester, ReportSender, ReportGenerator, ReportTiming
+
+logger = logging.getLogger(__name__)
+
+
+def with_storage_sender(queryset):
+    """
+    :param queryset: ReportQuery queryset
+    :return: queryset annotated with the pk and updated_at of the sender where the report is stored
+    """
+    return queryset.annotate(
+        storage_sender_id=Coalesce('sender_id', 'report__sender_id'),
+        storage_sender_updated_at=Coalesce('sender__updated_at', 'report__sender__updated_at'),
+    )
+
+
+def purge_reports(queryset, batch_size=None, workers=None, dry_run=False, limit=None, throttle=None):
+    """
+    Delete the reports of the queryset and their files from storage.
+    The reports are processed on chunks of batch_size sorted by pk,
+    for each chunk the rows are removed with bulk deletes and after that the files are removed concurrently.
+    :param queryset: ReportQuery queryset with the reports to remove
+    :param batch_size: reports per chunk, by default setting REPORT_PURGE_BATCH_SIZE
+    :type batch_size: int|None
+    :param workers: threads deleting files, by default setting REPORT_PURGE_WORKERS
+    :type workers: int|None
+    :param dry_run: only count the reports
+    :type dry_run: bool
+    :param limit: max number of reports removed
+    :type limit: int|None
+    :param throttle: seconds waiting between chunks
+    :type throttle: float|None
+    :return: number of reports removed (or that would be removed with dry_run)
+    :rtype: int
+    """
+    batch_size = batch_size or getattr(settings, 'REPORT_PURGE_BATCH_SIZE', 1000)
+    workers = workers or getattr(settings, 'REPORT_PURGE_WORKERS', 8)
+    total = 0
+    last_pk = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while limit is None or total < limit:
+            chunk_size = batch_size if limit is None else min(batch_size, limit - total)
+            chunk = with_storage_sender(queryset).order_by('pk')
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            chunk = list(chunk.values_list(
+                'pk', 'storage_path_location', 'checksum',
+                'storage_sender_id', 'storage_sender_updated_at', 'report__preserve_report', 'checkpoint',
+            )[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1][0]
+            total += len(chunk)
+            if not dry_run:
+                purge_chunk(chunk, executor)
+            if len(chunk) < chunk_size:
+                break
+            if throttle:
+                time.sleep(throttle)
+    return total
+
+
+def purge_chunk(chunk, executor):
+    """
+    :param chunk: list of (pk, storage_path_location, checksum, sender pk, sender updated_at, preserve_report,
+        checkpoint)
+    :param executor: executor where files are deleted
+    :type executor: concurrent.futures.Executor
+    """
+    query_pks = [row[0] for row in chunk]
+    with transaction.atomic():
+        # Requester children (notifications and digests) do not have signals, so they are removed on bulk
+        ReportRequester.objects.filter(query_id__in=query_pks).delete()
+        # Without signals nor children Django deletes the timings with one query
+        ReportTiming.objects.filter(query_id__in=query_pks).delete()
+        # Skip delete_report_from_storage, files are removed after check references of the whole chunk
+        delete_without_signals(ReportQuery, query_pks)
+
+    paths = defaultdict(set)
+    checksums = defaultdict(set)
+    parts = defaultdict(set)
+    senders = {}
+    for _, path, checksum, sender_pk, sender_updated_at, preserve_report, checkpoint in chunk:
+        if checkpoint:
+            # Parts are only used by its report
+            senders[sender_pk] = sender_updated_at
+            parts[sender_pk].update(get_checkpoint_parts(checkpoint))
+        if not path or preserve_report:
+            continue
+        senders[sender_pk] = sender_updated_at
+        paths[sender_pk].add(path)
+        if checksum:
+            checksums[sender_pk].add(checksum)
+
+    references = with_storage_sender(ReportQuery.objects.filter(ReportQuery.stored_on(*senders.keys())))
+    for sender_pk, path in references.filter(
+            storage_path_location__in=set().union(*paths.values())
+    ).values_list('storage_sender_id', 'storage_path_location').distinct():
+        # File shared with other reports
+        paths[sender_pk].discard(path)
+    for sender_pk, checksum in references.filter(
+            checksum__in=set().union(*checksums.values())
+    ).values_list('storage_sender_id', 'checksum').distinct():
+        checksums[sender_pk].discard(checksum)
+
+    tasks = []
+    for sender_pk, sender_updated_at in senders.items():
+        try:
+            storage = ReportSender.get_pooled_storage(sender_pk, sender_updated_at)
+        except Exception:
+            logger.exception('Error loading storage', extra={'sender_pk': sender_pk})
+            continue
+        to_delete = paths[sender_pk] | parts[sender_pk]
+        for checksum in checksums[sender_pk]:
+            to_delete.add(ReportQuery.compressed_path(checksum))
+        for path in to_delete:
+            tasks.append(executor.submit(delete_file, storage, path))
+    for task in tasks:
+        task.result()
+
+
+def delete_without_signals(model, pks, batch_size=500):
+    """
+    Delete the rows without send the delete signals nor collect the related rows, they must be deleted before.
+    QuerySet.delete() loads and sends post_delete for each row when the model has receivers,
+    Django does not have public API to skip them, so the DELETE is executed directly.
+    :param model: model class
+    :param pks: primary keys of the rows
+    :type pks: list
+    :param batch_size: pks on each DELETE, below the SQLite variables limit
+    :type batch_size: int
+    :return: number of deleted rows
+    :rtype: int
+    """
+    connection = connections[router.db_for_write(model)]
+    sql = 'DELETE FROM {} WHERE {} IN ({{}})'.format(
+        connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(model._meta.pk.column)
+    )
+    deleted = 0
+    with connection.cursor() as cursor:
+        for pos in range(0, len(pks), batch_size):
+            batch = pks[pos:pos + batch_size]
+            cursor.execute(sql.format(', '.join(['%s'] * len(batch))), batch)
+            deleted += cursor.rowcount
+    return deleted
+
+
+def get_checkpoint_parts(checkpoint):
+    """
+    :param checkpoint: value of ReportQuery.checkpoint
+    :type checkpoint: str|None
+    :return: paths of the parts saved by the checkpoint
+    :rtype: list
+    """
+    if not checkpoint:
+        return []
+    try:
+        return json.loads(checkpoint).get('parts', [])
+    except ValueError:
+        logger.warning('Invalid checkpoint', extra={'checkpoint': checkpoint})
+        return []
+
+
+def enforce_retention(limit=None, batch_size=None, throttle=None):
+    """
+    Remove the finished reports out of the retention policy of their ReportGenerator.
+    Only limit reports are removed on each call, on small chunks waiting throttle seconds between them,
+    so it must be called periodically.
+    :param limit: max number of reports removed, by default setting REPORT_RETENTION_LIMIT
+    :type limit: int|None
+    :param batch_size: reports per chunk, by default setting REPORT_RETENTION_BATCH_SIZE
+    :type batch_size: int|None
+    :param throttle: seconds waiting between chunks, by default setting REPORT_RETENTION_THROTTLE
+    :type throttle: float|None
+    :return: number of removed reports
+    :rtype: int
+    """
+    limit = limit or getattr(settings, 'REPORT_RETENTION_LIMIT', 5000)
+    batch_size = batch_size or getattr(settings, 'REPORT_RETENTION_BATCH_SIZE', 100)
+    if throttle is None:
+        throttle = getattr(settings, 'REPORT_RETENTION_THROTTLE', 1)
+    removed = 0
+    generators = ReportGenerator.objects.filter(
+        Q(retention_days__isnull=False) | Q(retention_copies__isnull=False)
+    ).order_by('pk')
+    for generator in generators:
+        if removed >= limit:
+            break
+        finished = ReportQuery.objects.filter(
+            report=generator, status__in=(STATUS_DONE, STATUS_ERROR, STATUS_CANCELED)
+        )
+        if generator.retention_days is not None:
+            until = timezone.now() - datetime.timedelta(days=generator.retention_days)
+            removed += purge_reports(
+                finished.filter(created_at__lt=until),
+                batch_size=batch_size, limit=limit - removed, throttle=throttle
+            )
+        if generator.retention_copies is not None and removed < limit:
+            pks = get_extra_copies(finished, generator.retention_copies, limit - removed)
+            removed += purge_reports(
+                ReportQuery.objects.filter(pk__in=pks),
+                batch_size=batch_size, limit=limit - removed, throttle=throttle
+            )
+    return removed
+
+
+def get_extra_copies(queryset, copies, limit):
+    """
+    :param queryset: ReportQuery queryset
+    :param copies: number of newest reports kept for each params_hash
+    :type copies: int
+    :param limit: max number of pks
+    :type limit: int
+    :return: pks of the older reports with the same params_hash
+    :rtype: list
+    """
+    pks = []
+    repeated = queryset.values('params_hash').annotate(copies=Count('pk')).filter(copies__gt=copies).order_by()
+    for params_hash in repeated.values_list('params_hash', flat=True):
+        pks.extend(queryset.filter(params_hash=params_hash).order_by(
+            '-created_at', '-pk'
+        ).values_list('pk', flat=True)[copies:copies + limit - len(pks)])
+        if len(pks) >= limit:
+            break
+    return pks
+
+
+def delete_file(storage, path):
+    """
+    Remove the file from storage, errors are logged so the other files are removed
+    :rtype: bool
+    """
+    try:
+        storage.delete(path)
+        return True
+    except Exception:
+        logger.exception('Error deleting report file', extra={'path': path})
+        return False
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set, it never has false negatives and uses ~1.8 bytes per item with error_rate 0.001
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        :param capacity: expected number of items
+        :type capacity: int
+        :param error_rate: probability of false positive with capacity items
+        :type error_rate: float
+        """
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        for pos in range(self.hashes):
+            yield (first + pos * second) % self.size
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, value):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(value))
+
+
+def list_storage(storage, path):
+    """
+    Generator with the path of all the files under path
+    :type storage: django.core.files.storage.Storage
+    :type path: str
+    """
+    try:
+        directories, files = storage.listdir(path)
+    except (IOError, OSError):
+        return
+    for name in files:
+        yield os.path.join(path, name)
+    for name in directories:
+        yield from list_storage(storage, os.path.join(path, name))
+
+
+def build_index(chunk_size=None):
+    """
+    :param chunk_size: rows read from database on each chunk
+    :return: paths on storage used by the reports of every sender, several senders could share the same storage
+    :rtype: BloomFilter
+    """
+    chunk_size = chunk_size or getattr(settings, 'REPORT_SWEEP_CHUNK_SIZE', 10000)
+    reports = ReportQuery.objects.filter(
+        Q(storage_path_location__isnull=False) | Q(checksum__isnull=False) | Q(checkpoint__isnull=False)
+    )
+    index = BloomFilter(reports.count())
+    for path, checksum, checkpoint in reports.values_list(
+            'storage_path_location', 'checksum', 'checkpoint'
+    ).iterator(chunk_size=chunk_size):
+        if path:
+            index.add(path)
+        if checksum:
+            index.add(ReportQuery.compressed_path(checksum))
+        for part in get_checkpoint_parts(checkpoint):
+            index.add(part)
+    return index
+
+
+def find_orphans(sender, min_age=None, chunk_size=None, index=None):
+    """
+    Generator with the files of the sender storage without ReportQuery.
+    Only are listed the folders used by the default ReportBaseGenerator.get_remote_path,
+    the content addressed reports, the compressed attachments and the checkpoint parts.
+    The files used by reports of other senders are not orphans, the senders could share the storage.
+    :param sender: sender whose storage is swept
+    :type sender: django_easy_report.models.ReportSender
+    :param min_age: files modified on the last min_age are not orphans, they could be being generated
+    :type min_age: datetime.timedelta|None
+    :param chunk_size: number of files checked against the database together
+    :type chunk_size: int|None
+    :param index: result of build_index, by default it is built
+    :type index: BloomFilter|None
+    """
+    if min_age is None:
+        min_age = datetime.timedelta(seconds=getattr(settings, 'REPORT_SWEEP_MIN_AGE', 24 * 60 * 60))
+    chunk_size = chunk_size or getattr(settings, 'REPORT_SWEEP_CHUNK_SIZE', 10000)
+    storage = sender.get_storage()
+    if index is None:
+        index = build_index(chunk_size=chunk_size)
+    until = timezone.now() - min_age
+    prefixes = list(ReportGenerator.objects.filter(
+        Q(sender=sender) | Q(reportquery__sender=sender)
+    ).values_list('name', flat=True).distinct())
+    prefixes += ['sha256', 'zip', 'parts']
+
+    candidates = []
+    for prefix in prefixes:
+        for path in list_storage(storage, prefix):
+            if path in index:
+                continue
+            try:
+                if storage.get_modified_time(path) > until:
+                    continue
+            except NotImplementedError:
+                logger.warning('Orphan age cannot be checked', extra={'path': path})
+                continue
+            candidates.append(path)
+            if len(candidates) >= chunk_size:
+                yield from exclude_used(candidates)
+                candidates = []
+    yield from exclude_used(candidates)
+
+
+def exclude_used(paths):
+    """
+    :return: the paths not used by any report, created after the index was built
+    :rtype: list
+    """
+    if not paths:
+        return []
+    reports = ReportQuery.objects.all()
+    used = set(reports.filter(storage_path_location__in=paths).values_list('storage_path_location', flat=True))
+    zip_paths = {
+        path: os.path.splitext(os.path.basename(path))[0]
+        for path in paths if path.startswith('zip' + os.sep)
+    }
+    used_checksums = set(reports.filter(checksum__in=zip_paths.values()).values_list('checksum', flat=True))
+    # Parts are saved on parts/<query pk>/
+    query_pks = {path.split(os.sep)[1] for path in paths if path.startswith('parts' + os.sep)}
+    for checkpoint in reports.filter(
+            pk__in=[pk for pk in query_pks if pk.isdigit()], checkpoint__isnull=False
+    ).values_list('checkpoint', flat=True):
+        used.update(get_checkpoint_parts(checkpoint))
+    return [
+        path for path in paths
+        if path not in used and zip_paths.get(path) not in used_checksums
+    ]
+
+
+def sweep_orphans(senders=None, delete=False, min_age=None, workers=None):
+    """
+    Search and optionally delete the files on storage without ReportQuery
+    :param senders: senders swept, by default all
+    :param delete: remove the orphans from storage
+    :type delete: bool
+    :param min_age: files modified on the last min_age are ignored, by default setting REPORT_SWEEP_MIN_AGE (seconds)
+    :type min_age: datetime.timedelta|None
+    :param workers: threads deleting files, by default setting REPORT_PURGE_WORKERS
+    :type workers: int|None
+    :return: generator of (sender, path) with the orphans
+    """
+    if senders is None:
+        senders = ReportSender.objects.all()
+    workers = workers or getattr(settings, 'REPORT_PURGE_WORKERS', 8)
+    index = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for sender in senders:
+            storage = sender.get_storage()
+            if index is None:
+                # Shared by all the senders, it has the reports of all of them
+                index = build_index()
+            tasks = []
+            for path in find_orphans(sender, min_age=min_age, index=index):
+                if delete:
+                    tasks.append(executor.submit(delete_file, storage, path))
+                    if len(tasks) >= workers * 100:
+                        for task in tasks:
+                            task.result()
+                        tasks = []
+                yield sender, path
+            for task in tasks:
+                task.result()
+
+
+def tier_reports(queryset, target, batch_size=None, workers=None, limit=None):
+    """
+    Move the finished reports of the queryset to the storage of the target sender.
+    The files are copied concurrently and each report is updated only if it did not change during the copy,
+    after that the file is removed from the source if no other report uses it.
+    :param queryset: ReportQuery queryset with the reports to move
+    :param target: sender where the reports are moved
+    :type target: django_easy_report.models.ReportSender
+    :param batch_size: reports per chunk, by default setting REPORT_PURGE_BATCH_SIZE
+    :type batch_size: int|None
+    :param workers: threads copying files, by default setting REPORT_PURGE_WORKERS
+    :type workers: int|None
+    :param limit: max number of reports moved
+    :type limit: int|None
+    :return: number of moved reports
+    :rtype: int
+    """
+    batch_size = batch_size or getattr(settings, 'REPORT_PURGE_BATCH_SIZE', 1000)
+    workers = workers or getattr(settings, 'REPORT_PURGE_WORKERS', 8)
+    target_storage = target.get_storage()
+    queryset = with_storage_sender(queryset.filter(
+        status=STATUS_DONE, storage_path_location__isnull=False
+    ).exclude(ReportQuery.stored_on(target.pk)))
+    moved = 0
+    last_pk = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while limit is None or moved < limit:
+            chunk = queryset.order_by('pk')
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            chunk = list(chunk.values_list(
+                'pk', 'storage_path_location', 'checksum', 'storage_sender_id', 'storage_sender_updated_at',
+            )[:batch_size if limit is None else min(batch_size, limit - moved)])
+            if not chunk:
+                break
+            last_pk = chunk[-1][0]
+            tasks = []
+            for query_pk, path, checksum, sender_pk, sender_updated_at in chunk:
+                try:
+                    storage = ReportSender.get_pooled_storage(sender_pk, sender_updated_at)
+                except Exception:
+                    logger.exception('Error loading storage', extra={'sender_pk': sender_pk})
+                    continue
+                task = executor.submit(copy_file, storage, target_storage, path)
+                tasks.append((query_pk, path, checksum, sender_pk, storage, task))
+            for query_pk, path, checksum, sender_pk, storage, task in tasks:
+                new_path = task.result()
+                if new_path is None:
+                    continue
+                updated = ReportQuery.objects.filter(
+                    ReportQuery.stored_on(sender_pk), pk=query_pk, storage_path_location=path
+                ).update(sender=target, storage_path_location=new_path)
+                if updated:
+                    moved += 1
+                    release_file(sender_pk, storage, path)
+                    release_compressed(sender_pk, storage, checksum)
+                else:
+                    # Report changed during the copy
+                    release_file(target.pk, target_storage, new_path)
+    return moved
+
+
+def copy_file(source, target, path):
+    """
+    :type source: django.core.files.storage.Storage
+    :type target: django.core.files.storage.Storage
+    :return: path on target or None if it cannot be copied
+    :rtype: str|None
+    """
+    try:
+        if path.startswith('sha256' + os.sep) and target.exists(path):
+            # Content addressed, same path same content
+            return path
+        with source.open(path, 'rb') as remote_file:
+            return target.save(path, remote_file)
+    except Exception:
+        logger.exception('Error copying report file', extra={'path': path})
+
+
+def release_file(sender_pk, storage, path):
+    """
+    Remove the file from storage if no report of the sender uses it
+    """
+    if not ReportQuery.objects.filter(ReportQuery.stored_on(sender_pk), storage_path_location=path).exists():
+        delete_file(storage, path)
+
+
+def release_compressed(sender_pk, storage, checksum):
+    """
+    Remove the compressed report from storage if no report of the sender has the same content
+    """
+    if checksum and not ReportQuery.objects.filter(ReportQuery.stored_on(sender_pk), checksum=checksum).exists():
+        delete_file(storage, ReportQuery.compressed_path(checksum))
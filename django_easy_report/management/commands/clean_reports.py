@@ -3,6 +3,7 @@ import argparse
 
 from django.core.management.base import BaseCommand
 
+from django_easy_report.maintenance import purge_reports
 from django_easy_report.models import ReportQuery
 
 
@@ -24,6 +25,9 @@ class Command(BaseCommand):
                            help='Date in format DD-MM-YYYY')
         group.add_argument('--weeks', type=int)
         group.add_argument('--days', type=int)
+        parser.add_argument('--batch-size', type=int, help='Reports removed on each chunk')
+        parser.add_argument('--workers', type=int, help='Threads removing files from storage')
+        parser.add_argument('--dry-run', action='store_true', help='Only show the number of reports')
 
     def handle(self, *args, **options):
         until = None
@@ -36,7 +40,8 @@ class Command(BaseCommand):
 
         reports = ReportQuery.objects.filter(created_at__lt=until)
         self.stdout.write(self.style.NOTICE('{} reports will be remoted'.format(reports.count())))
-        for query in reports.iterator():
-            query.delete()
+        if options['dry_run']:
+            return
+        purge_reports(reports, batch_size=options['batch_size'], workers=options['workers'])
 
         self.stdout.write(self.style.SUCCESS('Successfully removed'))
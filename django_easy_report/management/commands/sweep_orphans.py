@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from django_easy_report.maintenance import sweep_orphans
+from django_easy_report.models import ReportSender
+
+
+class Command(BaseCommand):
+    help = 'Search the report files on storage without report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sender', action='append', help='Sender name, by default all')
+        parser.add_argument('--min-age', type=int, help='Ignore files modified on the last hours')
+        parser.add_argument('--workers', type=int, help='Threads removing files from storage')
+        parser.add_argument('--delete', action='store_true', help='Remove the files from storage')
+
+    def handle(self, *args, **options):
+        senders = ReportSender.objects.all()
+        if options['sender']:
+            senders = senders.filter(name__in=options['sender'])
+        min_age = None
+        if options['min_age'] is not None:
+            min_age = timedelta(hours=options['min_age'])
+
+        orphans = 0
+        for sender, path in sweep_orphans(senders, delete=options['delete'],
+                                          min_age=min_age, workers=options['workers']):
+            self.stdout.write('{}: {}'.format(sender.name, path))
+            orphans += 1
+
+        if options['delete']:
+            self.stdout.write(self.style.SUCCESS('{} orphan files removed'.format(orphans)))
+        else:
+            self.stdout.write(self.style.NOTICE('{} orphan files found'.format(orphans)))
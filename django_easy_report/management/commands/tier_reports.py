@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from django_easy_report.maintenance import tier_reports
+from django_easy_report.models import ReportQuery, ReportSender
+
+
+class Command(BaseCommand):
+    help = 'Move old reports to other sender'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', required=True, help='Name of the sender where the reports are moved')
+        parser.add_argument('--days', type=int, required=True, help='Move reports older than days')
+        parser.add_argument('--sender', action='append', help='Only move reports stored on the sender name')
+        parser.add_argument('--batch-size', type=int, help='Reports moved on each chunk')
+        parser.add_argument('--workers', type=int, help='Threads copying files')
+        parser.add_argument('--limit', type=int, help='Max number of reports moved')
+
+    def handle(self, *args, **options):
+        try:
+            target = ReportSender.objects.get(name=options['target'])
+        except ReportSender.DoesNotExist:
+            raise CommandError('Sender "{}" not found'.format(options['target']))
+
+        reports = ReportQuery.objects.filter(created_at__lt=timezone.now() - timedelta(days=options['days']))
+        if options['sender']:
+            senders = ReportSender.objects.filter(name__in=options['sender']).values_list('pk', flat=True)
+            reports = reports.filter(ReportQuery.stored_on(*senders))
+
+        moved = tier_reports(reports, target, batch_size=options['batch_size'],
+                             workers=options['workers'], limit=options['limit'])
+
+        self.stdout.write(self.style.SUCCESS('{} reports moved to {}'.format(moved, target.name)))
@@ -0,0 +1,228 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+QUERIES = 'django_easy_report_queries'
+REQUESTS = 'django_easy_report_requests_total'
+GENERATION_SECONDS = 'django_easy_report_generation_seconds'
+ROWS = 'django_easy_report_rows_total'
+BYTES = 'django_easy_report_bytes_total'
+NOTIFICATION_FAILURES = 'django_easy_report_notification_failures_total'
+DOWNLOADS = 'django_easy_report_downloads_total'
+
+GAUGE = 'gauge'
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+METRICS = {
+    QUERIES: (GAUGE, 'Reports by status'),
+    REQUESTS: (COUNTER, 'Report requests by result, hit when the report already exists'),
+    GENERATION_SECONDS: (HISTOGRAM, 'Seconds generating and saving the reports'),
+    ROWS: (COUNTER, 'Rows written on the reports'),
+    BYTES: (COUNTER, 'Bytes written on the reports'),
+    NOTIFICATION_FAILURES: (COUNTER, 'Requesters that cannot be notified'),
+    DOWNLOADS: (COUNTER, 'Reports downloaded'),
+}
+
+BUCKETS = (0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600, float('inf'))
+
+
+def enabled():
+    return getattr(settings, 'REPORT_METRICS', False)
+
+
+def label_key(labels):
+    """
+    :return: labels serialized, used as key on the registry and on the multiprocess files
+    :rtype: str
+    """
+    return json.dumps(sorted(labels.items()))
+
+
+class Registry(object):
+    """
+    Metrics of this process.
+    When REPORT_METRICS_DIR is defined, they are saved on a file by process and read from all of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_flush = 0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(lambda: defaultdict(float))
+            self.histograms = defaultdict(dict)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase the counter
+        :param name: counter name, item of METRICS
+        :type name: str
+        :param value: increment
+        :type value: int|float
+        :param labels: labels of the counter
+        """
+        if not enabled():
+            return
+        with self._lock:
+            self.counters[name][label_key(labels)] += value
+        self.flush()
+
+    def observe(self, name, value, **labels):
+        """
+        Add the value to the histogram
+        :param name: histogram name, item of METRICS
+        :type name: str
+        :param value: observed value
+        :type value: int|float
+        :param labels: labels of the histogram
+        """
+        if not enabled():
+            return
+        with self._lock:
+            histogram = self.histograms[name].setdefault(label_key(labels), {
+                'buckets': [0] * len(BUCKETS),
+                'sum': 0,
+                'count': 0,
+            })
+            for pos, bucket in enumerate(BUCKETS):
+                if value <= bucket:
+                    histogram['buckets'][pos] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+        self.flush()
+
+    def snapshot(self):
+        """
+        :return: JSON serializable copy of the metrics
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'counters': {name: dict(values) for name, values in self.counters.items()},
+                'histograms': json.loads(json.dumps(self.histograms)),
+            }
+
+    def flush(self, force=False):
+        """
+        Save the metrics on the file of this process, at most each REPORT_METRICS_FLUSH_INTERVAL seconds
+        :param force: ignore the interval, for example at the end of a task
+        :type force: bool
+        """
+        path = getattr(settings, 'REPORT_METRICS_DIR', None)
+        if not path:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < getattr(settings, 'REPORT_METRICS_FLUSH_INTERVAL', 1):
+            return
+        self._last_flush = now
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=path, suffix='.tmp', delete=False) as tmp_file:
+                json.dump(self.snapshot(), tmp_file)
+            # Replaced atomically, the readers never see a partial file
+            os.replace(tmp_file.name, os.path.join(path, 'metrics_{}.json'.format(os.getpid())))
+        except (IOError, OSError):
+            logger.exception('Error saving metrics')
+
+    def collect(self):
+        """
+        :return: metrics of this process or of all the processes in multiprocess mode
+        :rtype: dict
+        """
+        path = getattr(settings, 'REPORT_METRICS_DIR', None)
+        if not path:
+            return self.snapshot()
+        self.flush(force=True)
+        collected = {'counters': {}, 'histograms': {}}
+        for filename in glob.glob(os.path.join(path, 'metrics_*.json')):
+            try:
+                with open(filename) as metrics_file:
+                    merge(collected, json.load(metrics_file))
+            except (IOError, OSError, ValueError):
+                logger.warning('Invalid metrics file', extra={'filename': filename})
+        return collected
+
+
+def merge(collected, snapshot):
+    """
+    Add the values of snapshot to collected
+    """
+    for name, values in snapshot.get('counters', {}).items():
+        counter = collected['counters'].setdefault(name, {})
+        for key, value in values.items():
+            counter[key] = counter.get(key, 0) + value
+    for name, values in snapshot.get('histograms', {}).items():
+        histograms = collected['histograms'].setdefault(name, {})
+        for key, value in values.items():
+            histogram = histograms.setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0})
+            histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], value['buckets'])]
+            histogram['sum'] += value['sum']
+            histogram['count'] += value['count']
+
+
+def format_labels(key, **extra):
+    labels = [tuple(item) for item in json.loads(key)] + sorted(extra.items())
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render(metrics, gauges=None):
+    """
+    :param metrics: collected metrics
+    :type metrics: dict
+    :param gauges: values computed when the metrics are read, {name: {label_key: value}}
+    :type gauges: dict
+    :return: metrics on Prometheus text exposition format
+    :rtype: str
+    """
+    gauges = gauges or {}
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind == GAUGE:
+            for key, value in sorted(gauges.get(name, {}).items()):
+                lines.append('{}{} {}'.format(name, format_labels(key), format_value(value)))
+        elif kind == COUNTER:
+            for key, value in sorted(metrics['counters'].get(name, {}).items()):
+                lines.append('{}{} {}'.format(name, format_labels(key), format_value(value)))
+        else:
+            for key, histogram in sorted(metrics['histograms'].get(name, {}).items()):
+                cumulative = 0
+                for bucket, count in zip(BUCKETS, histogram['buckets']):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(key, le=format_value(bucket)), format_value(cumulative)
+                    ))
+                lines.append('{}_sum{} {}'.format(name, format_labels(key), format_value(histogram['sum'])))
+                lines.append('{}_count{} {}'.format(name, format_labels(key), format_value(histogram['count'])))
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+flush = registry.flush
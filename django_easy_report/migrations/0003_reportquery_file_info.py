@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 17:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0002_secretkey_secretreplace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportquery',
+            name='checksum',
+            field=models.CharField(blank=True, help_text='SHA256 of the report', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportquery',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, help_text='Size in bytes of the report', null=True),
+        ),
+        migrations.AddField(
+            model_name='reportquery',
+            name='rows',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of rows of the report', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0003_reportquery_file_info'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportgenerator',
+            name='cache_control',
+            field=models.CharField(blank=True, help_text='Cache-Control header used on downloads, for example: "private, max-age=86400"', max_length=128, null=True),
+        ),
+    ]
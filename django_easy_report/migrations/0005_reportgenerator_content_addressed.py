@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 17:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0004_reportgenerator_cache_control'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportgenerator',
+            name='content_addressed',
+            field=models.BooleanField(default=False, help_text='Save the file using the content hash as name, identical reports will share the same file'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0005_reportgenerator_content_addressed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('requester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='django_easy_report.reportrequester')),
+            ],
+            options={
+                'ordering': ('pk',),
+            },
+        ),
+    ]
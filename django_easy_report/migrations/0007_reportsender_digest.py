@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0006_reportnotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportsender',
+            name='digest_max_items',
+            field=models.PositiveSmallIntegerField(blank=True, default=20, help_text='Max number of reports on one digest message, the message is sent when it is reached. If empty there is no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='reportsender',
+            name='digest_window',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds collecting the reports completed for the same email to send them on one message. If empty one message is sent per report.', null=True),
+        ),
+        migrations.CreateModel(
+            name='ReportDigestEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('email', models.EmailField(max_length=254)),
+                ('requester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='django_easy_report.reportrequester')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='django_easy_report.reportsender')),
+            ],
+            options={
+                'ordering': ('pk',),
+                'index_together': {('sender', 'email')},
+            },
+        ),
+    ]
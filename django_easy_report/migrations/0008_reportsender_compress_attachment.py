@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0007_reportsender_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportsender',
+            name='compress_attachment',
+            field=models.BooleanField(default=False, help_text='Attach the report compressed on a zip file if it is too big to be attached as it is.'),
+        ),
+    ]
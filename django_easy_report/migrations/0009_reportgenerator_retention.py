@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0008_reportsender_compress_attachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportgenerator',
+            name='retention_copies',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Max number of reports kept with the same parameters, if empty there is no limit', null=True),
+        ),
+        migrations.AddField(
+            model_name='reportgenerator',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Days that the reports are kept, if empty are kept forever', null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0009_reportgenerator_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportquery',
+            name='sender',
+            field=models.ForeignKey(blank=True, help_text='Sender where the report is stored, if empty the sender of the report generator', null=True, on_delete=django.db.models.deletion.PROTECT, to='django_easy_report.reportsender'),
+        ),
+    ]
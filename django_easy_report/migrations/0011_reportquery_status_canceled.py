@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0010_reportquery_sender'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reportquery',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Created'), (10, 'Working'), (20, 'Done'), (30, 'Error'), (40, 'Canceled')], default=0),
+        ),
+    ]
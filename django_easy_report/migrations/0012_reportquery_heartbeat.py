@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0011_reportquery_status_canceled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportquery',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Number of times that generation was started'),
+        ),
+        migrations.AddField(
+            model_name='reportquery',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='Last time that the worker notified that is generating the report', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0012_reportquery_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportquery',
+            name='checkpoint',
+            field=models.TextField(blank=True, help_text='Progress saved to resume the generation', null=True),
+        ),
+    ]
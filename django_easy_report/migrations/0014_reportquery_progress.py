@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0013_reportquery_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportquery',
+            name='bytes_written',
+            field=models.BigIntegerField(blank=True, help_text='Bytes written of the report while it is generated', null=True),
+        ),
+        migrations.AddField(
+            model_name='reportquery',
+            name='started_at',
+            field=models.DateTimeField(blank=True, help_text='Start of the last generation', null=True),
+        ),
+        migrations.AddField(
+            model_name='reportquery',
+            name='total_rows',
+            field=models.PositiveIntegerField(blank=True, help_text='Estimated number of rows of the report while it is generated', null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0014_reportquery_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportTiming',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('attempt', models.PositiveSmallIntegerField(default=0, help_text='Generation attempt of the report')),
+                ('phase', models.CharField(choices=[('queue', 'Queue wait'), ('query', 'Query'), ('render', 'Render'), ('generate', 'Generate'), ('upload', 'Upload'), ('notify', 'Notify')], max_length=16)),
+                ('seconds', models.FloatField()),
+                ('query', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='django_easy_report.reportquery')),
+            ],
+            options={
+                'ordering': ('created_at',),
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 19:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_easy_report', '0015_reporttiming'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportquery',
+            name='progress_at',
+            field=models.DateTimeField(blank=True, help_text='Last time that the worker saved the progress of the report', null=True),
+        ),
+    ]
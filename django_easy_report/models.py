@@ -1,24 +1,34 @@
 import base64
+import datetime
 import hashlib
 import json
 import os
+import shutil
+import zipfile
+from email.mime.base import MIMEBase
+from tempfile import SpooledTemporaryFile
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
 from django.core.files.storage import Storage
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.shortcuts import redirect
+from django.utils import timezone
 from django.utils.translation import gettext as _
 
+from django_easy_report.cache import LocalCache
 from django_easy_report.choices import MODE_ENVIRONMENT, MODE_DJANGO_SETTINGS, MODE_CRYPTOGRAPHY, \
     MODE_CRYPTOGRAPHY_ENVIRONMENT, MODE_CRYPTOGRAPHY_DJANGO
-from django_easy_report.constants import STATUS_CREATED, STATUS_OPTIONS
+from django_easy_report.constants import STATUS_CREATED, STATUS_OPTIONS, STATUS_WORKING, STATUS_CANCELED, \
+    TIMING_OPTIONS
 from django_easy_report.reports import ReportBaseGenerator
-from django_easy_report.utils import create_class, import_class, get_key, encrypt
+from django_easy_report.utils import create_class, import_class, get_key, encrypt, sign_download, wipe
 
 try:
     from cryptography.fernet import Fernet, InvalidToken
@@ -26,6 +36,14 @@ except ImportError:  # pragma: no cover
     Fernet = None
     InvalidToken = Exception
 
+# Storages shared by all the ReportSender instances of the process, key: (sender pk, sender updated_at)
+# updated_at also changes when its secrets change, see touch_senders
+storage_pool = LocalCache(max_size=getattr(settings, 'REPORT_STORAGE_POOL_SIZE', 32))
+# Max size in bytes of the compressed reports keep on memory before they are saved on storage
+ATTACHMENT_SPOOL_SIZE = 1024 * 1024
+# Decrypted secrets, key: (secret pk, secret version)
+secret_cache = LocalCache(max_size=getattr(settings, 'REPORT_SECRET_CACHE_SIZE', 128), on_evict=wipe)
+
 
 class SecretKeyManager(models.Manager):
     def create_secret(self, **kwargs):
@@ -69,6 +87,16 @@ class SecretKey(models.Model):
         if Fernet and self.mode & MODE_CRYPTOGRAPHY:
             return get_key(self.mode, self.key)
 
+    def get_version(self):
+        """
+        :return: hash of the fields used to get the secret
+        :rtype: str
+        """
+        sha = hashlib.sha256()
+        for value in (self.mode, self.key, self.value):
+            sha.update(str(value).encode())
+        return sha.hexdigest()
+
     def get_secret(self):
         if self.mode == MODE_ENVIRONMENT:
             return os.environ.get(self.value)
@@ -77,8 +105,19 @@ class SecretKey(models.Model):
         elif (
                 Fernet and self.mode & MODE_CRYPTOGRAPHY
         ):
-            key = base64.urlsafe_b64encode(self.get_key())
-            return Fernet(key).decrypt(self.value.encode()).decode()
+            ttl = getattr(settings, 'REPORT_SECRET_CACHE_TTL', 300)
+            cache_key = (self.pk, self.get_version())
+            secret = None
+            if self.pk and ttl:
+                # Decoded under the cache lock, the cached buffer is wiped when evicted
+                secret = secret_cache.get(cache_key, transform=bytearray.decode)
+            if secret is None:
+                key = base64.urlsafe_b64encode(self.get_key())
+                plain = bytearray(Fernet(key).decrypt(self.value.encode()))
+                secret = plain.decode()
+                if self.pk and ttl:
+                    secret_cache.set(cache_key, plain, ttl=ttl)
+            return secret
 
     def clean(self):
         super(SecretKey, self).clean()
@@ -170,6 +209,20 @@ class ReportSender(models.Model):
     storage_init_params = models.TextField(
         blank=True, null=True, help_text=_('JSON with init parameters')
     )
+    compress_attachment = models.BooleanField(
+        default=False,
+        help_text=_('Attach the report compressed on a zip file if it is too big to be attached as it is.')
+    )
+    digest_window = models.PositiveIntegerField(
+        blank=True, null=True,
+        help_text=_('Seconds collecting the reports completed for the same email to send them on one message. '
+                    'If empty one message is sent per report.')
+    )
+    digest_max_items = models.PositiveSmallIntegerField(
+        default=20, blank=True, null=True,
+        help_text=_('Max number of reports on one digest message, the message is sent when it is reached. '
+                    'If empty there is no limit.')
+    )
 
     def __init__(self, *args, **kwargs):
         super(ReportSender, self).__init__(*args, **kwargs)
@@ -178,27 +231,50 @@ class ReportSender(models.Model):
     def __str__(self):  # pragma: no cover
         return self.name
 
+    def save(self, *args, **kwargs):
+        super(ReportSender, self).save(*args, **kwargs)
+        self.__storage = None
+
     def get_storage(self, force_load=False):
         """
         :return:
         :rtype: Storage
         """
         if self.__storage is None or force_load:
-            replace = {}
-            for replace_item in self.secretreplace_set.all():
-                replace[replace_item.replace_word] = replace_item.secret.get_secret()
             if (
                 hasattr(settings, 'SENDER_CLASSES') and
                 isinstance(settings.SENDER_CLASSES, (list, tuple)) and
                 self.storage_class_name not in settings.SENDER_CLASSES
             ):
                 raise ImportError('Storage class are not on the SENDER_CLASSES list')
-            cls = create_class(self.storage_class_name, self.storage_init_params, replace=replace)
-            if not isinstance(cls, Storage):
-                raise ImportError('Only Storage classes are allowed')
-            self.__storage = cls
+            pool_key = (self.pk, self.updated_at)
+            storage = None
+            if self.pk and not force_load:
+                storage = storage_pool.get(pool_key)
+            if storage is None:
+                replace = {}
+                for replace_item in self.secretreplace_set.all():
+                    replace[replace_item.replace_word] = replace_item.secret.get_secret()
+                storage = create_class(self.storage_class_name, self.storage_init_params, replace=replace)
+                if not isinstance(storage, Storage):
+                    raise ImportError('Only Storage classes are allowed')
+                if self.pk:
+                    storage_pool.set(pool_key, storage)
+            self.__storage = storage
         return self.__storage
 
+    @classmethod
+    def get_pooled_storage(cls, pk, updated_at):
+        """
+        Storage of the sender, only query the database if it is not on the process pool
+        :raise ReportSender.DoesNotExist: if it is not on the pool and do not exist
+        :rtype: Storage
+        """
+        storage = storage_pool.get((pk, updated_at))
+        if storage is None:
+            storage = cls.objects.get(pk=pk).get_storage()
+        return storage
+
     def clean(self):
         super(ReportSender, self).clean()
         if (
@@ -225,6 +301,41 @@ class SecretReplace(models.Model):
         unique_together = (('secret', 'sender'), ('sender', 'replace_word'))
 
 
+def invalidate_storage_pool(*sender_pks):
+    storage_pool.delete_if(lambda key: key[0] in sender_pks)
+
+
+def touch_senders(*sender_pks):
+    """
+    Change the updated_at of the senders, so the storages pooled by any process are not used anymore
+    """
+    ReportSender.objects.filter(pk__in=sender_pks).update(updated_at=timezone.now())
+    invalidate_storage_pool(*sender_pks)
+
+
+@receiver(post_save, sender=ReportSender)
+@receiver(post_delete, sender=ReportSender)
+def invalidate_sender_storage(sender, instance, **kwargs):
+    invalidate_storage_pool(instance.pk)
+
+
+@receiver(post_save, sender=SecretReplace)
+@receiver(post_delete, sender=SecretReplace)
+def invalidate_secret_replace_storage(sender, instance, **kwargs):
+    touch_senders(instance.sender_id)
+
+
+@receiver(post_save, sender=SecretKey)
+def invalidate_secret_storage(sender, instance, **kwargs):
+    touch_senders(*instance.secretreplace_set.values_list('sender_id', flat=True))
+
+
+@receiver(post_save, sender=SecretKey)
+@receiver(post_delete, sender=SecretKey)
+def invalidate_secret_cache(sender, instance, **kwargs):
+    secret_cache.delete_if(lambda key: key[0] == instance.pk)
+
+
 class ReportGenerator(models.Model):
     """
     Model for Report object creation information.
@@ -261,6 +372,22 @@ class ReportGenerator(models.Model):
         default=False,
         help_text=_('If model is deleted, do not remove the file on storage')
     )
+    content_addressed = models.BooleanField(
+        default=False,
+        help_text=_('Save the file using the content hash as name, identical reports will share the same file')
+    )
+    cache_control = models.CharField(
+        max_length=128, blank=True, null=True,
+        help_text=_('Cache-Control header used on downloads, for example: "private, max-age=86400"')
+    )
+    retention_days = models.PositiveIntegerField(
+        blank=True, null=True,
+        help_text=_('Days that the reports are kept, if empty are kept forever')
+    )
+    retention_copies = models.PositiveSmallIntegerField(
+        blank=True, null=True,
+        help_text=_('Max number of reports kept with the same parameters, if empty there is no limit')
+    )
 
     def __init__(self, *args, **kwargs):
         super(ReportGenerator, self).__init__(*args, **kwargs)
@@ -378,6 +505,28 @@ class ReportQuery(models.Model):
     params = models.TextField(blank=True, null=True)
     params_hash = models.CharField(max_length=128)
     storage_path_location = models.CharField(max_length=512, blank=True, null=True)
+    file_size = models.BigIntegerField(blank=True, null=True, help_text=_('Size in bytes of the report'))
+    checksum = models.CharField(max_length=64, blank=True, null=True, help_text=_('SHA256 of the report'))
+    rows = models.PositiveIntegerField(blank=True, null=True, help_text=_('Number of rows of the report'))
+    sender = models.ForeignKey(
+        ReportSender, on_delete=models.PROTECT, blank=True, null=True,
+        help_text=_('Sender where the report is stored, if empty the sender of the report generator')
+    )
+    started_at = models.DateTimeField(blank=True, null=True, help_text=_('Start of the last generation'))
+    total_rows = models.PositiveIntegerField(
+        blank=True, null=True, help_text=_('Estimated number of rows of the report while it is generated')
+    )
+    bytes_written = models.BigIntegerField(
+        blank=True, null=True, help_text=_('Bytes written of the report while it is generated')
+    )
+    heartbeat_at = models.DateTimeField(
+        blank=True, null=True, help_text=_('Last time that the worker notified that is generating the report')
+    )
+    progress_at = models.DateTimeField(
+        blank=True, null=True, help_text=_('Last time that the worker saved the progress of the report')
+    )
+    attempts = models.PositiveSmallIntegerField(default=0, help_text=_('Number of times that generation was started'))
+    checkpoint = models.TextField(blank=True, null=True, help_text=_('Progress saved to resume the generation'))
 
     class Meta:
         ordering = ('created_at', )
@@ -437,22 +586,225 @@ class ReportQuery(models.Model):
             self.__report.setup(self, **self.get_params())
         return self.__report
 
+    def get_cancel_key(self):
+        return 'django_easy_report:canceled:{}'.format(self.pk)
+
+    def cancel(self):
+        """
+        Cancel the report if it is pending or being generated,
+        the generation is stopped on the next check point of the report.
+        :return: True if the report was canceled
+        :rtype: bool
+        """
+        updated = ReportQuery.objects.filter(
+            pk=self.pk, status__in=(STATUS_CREATED, STATUS_WORKING)
+        ).update(status=STATUS_CANCELED, updated_at=timezone.now())
+        if updated:
+            self.status = STATUS_CANCELED
+            cache = caches[getattr(settings, 'REPORT_CANCEL_CACHE', 'default')]
+            cache.set(self.get_cancel_key(), True, getattr(settings, 'REPORT_CANCEL_TIMEOUT', 24 * 60 * 60))
+        return bool(updated)
+
+    def is_canceled(self):
+        """
+        Check the flag set by cancel, without query the database
+        :rtype: bool
+        """
+        cache = caches[getattr(settings, 'REPORT_CANCEL_CACHE', 'default')]
+        return bool(cache.get(self.get_cancel_key()))
+
+    def start_attempt(self):
+        """
+        Mark the report as generated by a new attempt, only if it is still pending,
+        for example it could be canceled after it was read
+        :return: True if this attempt generates the report
+        :rtype: bool
+        """
+        now = timezone.now()
+        if not self.sender_id:
+            # Keep the report on the same sender although the report generator changes
+            self.sender = self.report.sender
+        values = {
+            'status': STATUS_WORKING,
+            'attempts': self.attempts + 1,
+            'started_at': now,
+            'heartbeat_at': now,
+            'progress_at': None,
+            'updated_at': now,
+            'rows': None,
+            'total_rows': None,
+            'bytes_written': None,
+            'sender': self.sender,
+        }
+        updated = ReportQuery.objects.filter(pk=self.pk, status=STATUS_CREATED, attempts=self.attempts).update(**values)
+        if updated:
+            for field, value in values.items():
+                setattr(self, field, value)
+        return bool(updated)
+
+    def heartbeat(self, rows=None, total_rows=None, bytes_written=None):
+        """
+        Notify that the report is being generated by this attempt, saving the progress
+        :param rows: rows processed
+        :type rows: int|None
+        :param total_rows: estimated number of rows
+        :type total_rows: int|None
+        :param bytes_written: bytes written
+        :type bytes_written: int|None
+        :return: False if the report is not longer generated by this attempt (canceled or reaped)
+        :rtype: bool
+        """
+        return self.update_progress(rows=rows, total_rows=total_rows, bytes_written=bytes_written)
+
+    def update_progress(self, **values):
+        """
+        Save the values and the heartbeat only if the report is generated by this attempt,
+        without values it only refreshes the heartbeat and keeps the time of the progress used by the ETA
+        :return: True if it was saved
+        :rtype: bool
+        """
+        now = timezone.now()
+        if values:
+            values['progress_at'] = now
+        updated = ReportQuery.objects.filter(
+            pk=self.pk, status=STATUS_WORKING, attempts=self.attempts
+        ).update(heartbeat_at=now, **values)
+        if updated:
+            self.heartbeat_at = now
+            for field, value in values.items():
+                setattr(self, field, value)
+        return bool(updated)
+
+    def get_progress(self):
+        """
+        :return: rows processed, estimated total of rows, bytes written and estimated time of arrival
+        :rtype: dict
+        """
+        progress = {
+            'rows': self.rows,
+            'total_rows': self.total_rows,
+            'bytes_written': self.bytes_written if self.status == STATUS_WORKING else self.file_size,
+            'percent': None,
+            'eta': None,
+        }
+        if self.status != STATUS_WORKING or not (self.rows and self.total_rows):
+            return progress
+        progress['percent'] = min(100, int(100 * self.rows / self.total_rows))
+        if self.started_at and self.progress_at and self.progress_at > self.started_at:
+            elapsed = (self.progress_at - self.started_at).total_seconds()
+            remaining = max(self.total_rows - self.rows, 0) * elapsed / self.rows
+            progress['eta'] = self.progress_at + datetime.timedelta(seconds=remaining)
+        return progress
+
+    @staticmethod
+    def stale(timeout=None):
+        """
+        :param timeout: seconds without heartbeat, by default REPORT_HEARTBEAT_TIMEOUT
+        :type timeout: int|None
+        :return: filter of the reports working without heartbeat, for example if the worker was killed
+        :rtype: Q
+        """
+        if timeout is None:
+            timeout = getattr(settings, 'REPORT_HEARTBEAT_TIMEOUT', 10 * 60)
+        limit = timezone.now() - datetime.timedelta(seconds=timeout)
+        return models.Q(status=STATUS_WORKING) & (
+            models.Q(heartbeat_at__lt=limit) | models.Q(heartbeat_at__isnull=True, updated_at__lt=limit)
+        )
+
+    def get_checkpoint(self):
+        """
+        :return: progress saved by the report to resume the generation
+        :rtype: dict
+        """
+        if self.checkpoint:
+            return json.loads(self.checkpoint)
+        return {}
+
+    def save_checkpoint(self, data, rows=None, total_rows=None, bytes_written=None):
+        """
+        Save the progress of the report, it also works as heartbeat
+        :param data: JSON serializable progress
+        :type data: dict
+        :param rows: rows processed
+        :type rows: int|None
+        :param total_rows: estimated number of rows
+        :type total_rows: int|None
+        :param bytes_written: bytes written
+        :type bytes_written: int|None
+        :return: False if the report is not longer generated by this attempt (canceled or reaped)
+        :rtype: bool
+        """
+        return self.update_progress(
+            checkpoint=json.dumps(data, cls=DjangoJSONEncoder),
+            rows=rows, total_rows=total_rows, bytes_written=bytes_written
+        )
+
+    def discard_checkpoint(self, checkpoint=None):
+        """
+        Remove from storage the parts saved by the checkpoint
+        :param checkpoint: value of the checkpoint field with the parts, by default the current checkpoint
+        :type checkpoint: str|None
+        :return: None
+        """
+        if checkpoint is None:
+            checkpoint, self.checkpoint = self.checkpoint, None
+        parts = json.loads(checkpoint).get('parts', []) if checkpoint else []
+        storage = self.get_sender().get_storage()
+        if parts and storage:
+            for path in parts:
+                storage.delete(path)
+
+    def save_result(self, update_fields):
+        """
+        Save the fields only if the report was not reaped or started by other attempt meanwhile
+        :param update_fields: fields to save
+        :type update_fields: list
+        :return: True if the fields were saved
+        :rtype: bool
+        """
+        self.updated_at = timezone.now()
+        values = {field: getattr(self, field) for field in update_fields}
+        values['updated_at'] = self.updated_at
+        return bool(ReportQuery.objects.filter(
+            pk=self.pk, attempts=self.attempts, status__in=(STATUS_WORKING, STATUS_CANCELED)
+        ).update(**values))
+
+    def get_sender(self):
+        """
+        :return: sender where the report is stored
+        :rtype: ReportSender
+        """
+        if self.sender_id:
+            return self.sender
+        return self.report.sender
+
+    @staticmethod
+    def stored_on(*sender_pks):
+        """
+        :param sender_pks: ReportSender pks
+        :return: filter of the reports stored on the senders
+        :rtype: Q
+        """
+        return models.Q(sender_id__in=sender_pks) | models.Q(sender__isnull=True, report__sender_id__in=sender_pks)
+
     def get_file_size(self):
         if not self.storage_path_location:
             return 0
-        storage = self.report.sender.get_storage()
+        if self.file_size is not None:
+            return self.file_size
+        storage = self.get_sender().get_storage()
         return storage.size(self.storage_path_location)
 
     def get_url(self):
-        storage = self.report.sender.get_storage()
+        storage = self.get_sender().get_storage()
         try:
             url = storage.url(self.storage_path_location)
             return url
         except NotImplementedError:  # pragma: no cover
             pass
 
-    def get_file(self, open_file=None):
-        storage = self.report.sender.get_storage()
+    def get_file(self, open_file=None, mode='r'):
+        storage = self.get_sender().get_storage()
         if open_file is None:
             open_file = self.report.always_download
         if not storage or not self.storage_path_location:
@@ -462,8 +814,132 @@ class ReportQuery(models.Model):
             if url:
                 return redirect(url)
 
+        if self.checksum:
+            # File was completely saved, do not check if exists
+            try:
+                return storage.open(self.storage_path_location, mode)
+            except (IOError, OSError):
+                return
         if storage.exists(self.storage_path_location):
-            return storage.open(self.storage_path_location, 'r')
+            return storage.open(self.storage_path_location, mode)
+
+    def get_compressed_path(self):
+        """
+        :return: path on storage of the zip with the report, shared by the reports with the same content
+        :rtype: str|None
+        """
+        if self.checksum:
+            return self.compressed_path(self.checksum)
+
+    @staticmethod
+    def compressed_path(checksum):
+        """
+        :param checksum: SHA256 of the report
+        :return: path on storage of the zip with the report content
+        :rtype: str
+        """
+        return os.path.join('zip', checksum[:2], checksum + '.zip')
+
+    def compress(self):
+        """
+        Save on storage the report compressed, only the first time for each content
+        :return: size of the compressed report or None if it cannot be compressed
+        :rtype: int|None
+        """
+        storage = self.get_sender().get_storage()
+        path = self.get_compressed_path()
+        if not storage or not path:
+            return
+        if not storage.exists(path):
+            remote_file = self.get_file(open_file=True, mode='rb')
+            if remote_file is None:
+                return
+            with remote_file, SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE) as spool:
+                with zipfile.ZipFile(spool, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+                    with archive.open(os.path.basename(self.filename), mode='w') as member:
+                        shutil.copyfileobj(remote_file, member)
+                spool.seek(0)
+                path = storage.save(path, spool)
+        return storage.size(path)
+
+    def get_attachment(self, compressed=False):
+        """
+        Email attachment with the report, read by chunks from the storage and base64 encoded only once
+        so the same instance could be attached on several messages.
+        The encoded payload is kept on memory, the callers must check the size to attach.
+        :param compressed: attach the zip saved by compress instead of the report
+        :type compressed: bool
+        :rtype: MIMEBase|None
+        """
+        filename = os.path.basename(self.filename)
+        mimetype = self.mimetype
+        if compressed:
+            storage = self.get_sender().get_storage()
+            try:
+                remote_file = storage.open(self.get_compressed_path(), 'rb')
+            except (IOError, OSError):
+                return
+            filename = os.path.splitext(filename)[0] + '.zip'
+            mimetype = 'application/zip'
+        else:
+            remote_file = self.get_file(open_file=True, mode='rb')
+        if remote_file is None:
+            return
+        # Must be multiple of 57, base64 lines of 76 chars
+        line_size = 57
+        payload = []
+        pending = b''
+        with remote_file:
+            for chunk in remote_file.chunks():
+                pending += chunk
+                aligned = len(pending) - len(pending) % line_size
+                if aligned:
+                    payload.append(base64.encodebytes(pending[:aligned]).decode('ascii'))
+                    pending = pending[aligned:]
+        if pending:
+            payload.append(base64.encodebytes(pending).decode('ascii'))
+        maintype, subtype = mimetype.split('/', 1)
+        attachment = MIMEBase(maintype, subtype)
+        attachment.set_payload(''.join(payload))
+        attachment['Content-Transfer-Encoding'] = 'base64'
+        attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+        return attachment
+
+    def get_etag(self):
+        """
+        :return: strong validator for the stored report
+        :rtype: str
+        """
+        if self.checksum:
+            return '"{}"'.format(self.checksum)
+        return '"{}-{}"'.format(self.pk, int(self.updated_at.timestamp()))
+
+    def get_download_token(self, max_age=None):
+        """
+        Signed token with all the information needed to download the report
+        :param max_age: seconds until the token expire, by default setting REPORT_DOWNLOAD_TOKEN_MAX_AGE
+        :type max_age: int
+        :return: None if the tokens are disabled or the report was not stored
+        :rtype: str|None
+        """
+        if max_age is None:
+            max_age = getattr(settings, 'REPORT_DOWNLOAD_TOKEN_MAX_AGE', None)
+        if not max_age or not self.storage_path_location:
+            return
+        return sign_download({
+            'q': self.pk,
+            'r': self.report.name,
+            's': self.get_sender().pk,
+            'su': self.get_sender().updated_at.isoformat(),
+            'p': self.storage_path_location,
+            'f': self.filename,
+            'm': self.mimetype,
+            'd': self.report.always_download,
+            'z': self.file_size,
+            'e': self.get_etag(),
+            't': int(self.updated_at.timestamp()),
+            'cc': self.report.cache_control,
+        }, max_age)
 
     def get_params(self):
         """
@@ -476,13 +952,40 @@ class ReportQuery(models.Model):
         return self.__params
 
 
-@receiver(pre_delete, sender=ReportQuery)
+@receiver(post_delete, sender=ReportQuery)
 def delete_report_from_storage(sender, instance, **kwargs):
-    if instance.storage_path_location and instance.report.preserve_report:  # pragma: no cover
+    if instance.checkpoint:
+        instance.discard_checkpoint()
+    if not instance.storage_path_location or instance.report.preserve_report:  # pragma: no cover
+        return
+    storage_sender = instance.get_sender()
+    references = ReportQuery.objects.filter(ReportQuery.stored_on(storage_sender.pk))
+    storage = storage_sender.get_storage()
+    if not storage:  # pragma: no cover
         return
-    storage = instance.report.sender.get_storage()
-    if storage:
+    if not references.filter(storage_path_location=instance.storage_path_location).exists():
+        # File not shared with other reports
         storage.delete(instance.storage_path_location)
+    compressed_path = instance.get_compressed_path()
+    if compressed_path and not references.filter(checksum=instance.checksum).exists():
+        storage.delete(compressed_path)
+
+
+class ReportTiming(models.Model):
+    """
+    Time spent on each phase of the report generation and notification.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    query = models.ForeignKey(ReportQuery, on_delete=models.CASCADE)
+    attempt = models.PositiveSmallIntegerField(default=0, help_text=_('Generation attempt of the report'))
+    phase = models.CharField(max_length=16, choices=TIMING_OPTIONS)
+    seconds = models.FloatField()
+
+    class Meta:
+        ordering = ('created_at', )
+
+    def __str__(self):  # pragma: no cover
+        return '{}: {:.3f}s'.format(self.get_phase_display(), self.seconds)
 
 
 class ReportRequester(models.Model):
@@ -524,3 +1027,51 @@ class ReportRequester(models.Model):
             if self.user_params:
                 self.__params = json.loads(self.user_params)
         return self.__params
+
+
+class ReportNotificationManager(models.Manager):
+    def add_pending(self, query_pk, requester_pks=None):
+        """
+        Add to the outbox the requesters of the query pending to be notified
+        :param query_pk: ReportQuery pk
+        :param requester_pks: only add that requesters
+        :type requester_pks: list|None
+        :rtype: list
+        """
+        requesters = ReportRequester.objects.filter(query_id=query_pk, notified=False)
+        if requester_pks is not None:
+            requesters = requesters.filter(pk__in=requester_pks)
+        return self.bulk_create([
+            self.model(requester_id=requester_pk)
+            for requester_pk in requesters.values_list('pk', flat=True)
+        ])
+
+
+class ReportNotification(models.Model):
+    """
+    Outbox with the requesters pending to be notified.
+    It is written on the same transaction than the requester or query changes
+    and drained by the task django_easy_report.tasks.dispatch_notifications.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    requester = models.ForeignKey(ReportRequester, on_delete=models.CASCADE)
+
+    objects = ReportNotificationManager()
+
+    class Meta:
+        ordering = ('pk', )
+
+
+class ReportDigestEntry(models.Model):
+    """
+    Requesters notified by email pending to be sent on the next digest message.
+    Sent by the task django_easy_report.tasks.send_digests.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    sender = models.ForeignKey(ReportSender, on_delete=models.CASCADE)
+    email = models.EmailField()
+    requester = models.ForeignKey(ReportRequester, on_delete=models.CASCADE)
+
+    class Meta:
+        ordering = ('pk', )
+        index_together = ('sender', 'email')
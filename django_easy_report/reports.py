@@ -1,14 +1,23 @@
 import datetime
 import json
 import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 from csv import DictWriter
 from gettext import gettext as _
+from io import StringIO
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
 from django.forms.utils import ErrorDict
+from django.urls import reverse
+from django.utils.http import urlencode
 
-from django_easy_report.constants import STATUS_DONE, STATUS_ERROR, STATUS_OPTIONS
-from django_easy_report.exceptions import DoNotSend
+from django_easy_report.constants import STATUS_DONE, STATUS_ERROR, STATUS_CANCELED, STATUS_OPTIONS, \
+    TIMING_QUERY, TIMING_RENDER
+from django_easy_report.exceptions import DoNotSend, ReportCanceled
 from django_easy_report.utils import import_class
 
 
@@ -26,11 +35,19 @@ class ReportBaseGenerator(object):
     form_class = None
     binary = True
     using = None
+    webhook_param = None
 
     def __init__(self, **kwargs):
         self.setup_params = {}
         self.report_model = None
         self.form = None
+        self.rows = None
+        self.check_point_rows = getattr(settings, 'REPORT_CHECK_POINT_ROWS', 1000)
+        self.heartbeat_interval = getattr(settings, 'REPORT_HEARTBEAT_INTERVAL', 30)
+        self.last_heartbeat = None
+        self.total_rows = None
+        self.writer = None
+        self.timings = defaultdict(float)
         self.reset()
 
     def reset(self):
@@ -41,6 +58,10 @@ class ReportBaseGenerator(object):
         self.setup_params = {}
         self.report_model = None
         self.form = None
+        self.rows = None
+        self.total_rows = None
+        self.writer = None
+        self.timings = defaultdict(float)
 
     def setup(self, report_model, **kwargs):
         """
@@ -51,6 +72,77 @@ class ReportBaseGenerator(object):
         """
         self.setup_params = kwargs
         self.report_model = report_model
+        self.rows = None
+        self.total_rows = None
+        self.last_heartbeat = time.monotonic()
+
+    def row_written(self):
+        """
+        Must be called by generate for each row written, it allows know the number of rows of the report
+        and run check_point each check_point_rows rows
+        :return: None
+        """
+        self.rows = (self.rows or 0) + 1
+        if self.check_point_rows and self.rows % self.check_point_rows == 0:
+            self.check_point()
+
+    def check_point(self):
+        """
+        Called periodically while the report is generated,
+        it sends the heartbeat each heartbeat_interval seconds
+        :raise ReportCanceled: if the report was canceled or reaped
+        :return: None
+        """
+        if not self.report_model:
+            return
+        if self.report_model.is_canceled():
+            raise ReportCanceled()
+        now = time.monotonic()
+        if self.last_heartbeat is None or now - self.last_heartbeat >= self.heartbeat_interval:
+            self.last_heartbeat = now
+            if not self.report_model.heartbeat(**self.get_progress()):
+                raise ReportCanceled()
+
+    @contextmanager
+    def timer(self, phase):
+        """
+        Add to timings the seconds spent on the block
+        :param phase: item on the list: django_easy_report.constants.TIMING_OPTIONS
+        :type phase: str
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.perf_counter() - start
+
+    def timed_iterator(self, iterable, phase=TIMING_QUERY):
+        """
+        Yield the items of iterable adding to timings the seconds spent getting them, but not using them
+        :param iterable: for example a queryset
+        :param phase: item on the list: django_easy_report.constants.TIMING_OPTIONS
+        :type phase: str
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def get_progress(self):
+        """
+        Progress saved with the heartbeat, total_rows must be set by generate to estimate the time of arrival
+        :return: rows written, estimated total of rows and bytes written
+        :rtype: dict
+        """
+        return {
+            'rows': self.rows,
+            'total_rows': self.total_rows,
+            'bytes_written': self.writer.size if self.writer else None,
+        }
 
     def get_email(self, requester):
         """
@@ -125,6 +217,15 @@ class ReportBaseGenerator(object):
         ]
         return os.path.join(*path_parts)
 
+    def get_content_path(self):
+        """
+        :return: path used on remote storage when the report is content addressed
+        :rtype: str
+        """
+        checksum = self.report_model.checksum
+        extension = os.path.splitext(self.report_model.filename)[1]
+        return os.path.join('sha256', checksum[:2], checksum + extension)
+
     def save(self, buffer):
         """
         Save buffer on remote storage
@@ -132,11 +233,75 @@ class ReportBaseGenerator(object):
         :return: path saved on remote storage
         :rtype: str
         """
-        filepath = self.get_remote_path()
-        storage = self.report_model.report.sender.get_storage()
+        storage = self.report_model.get_sender().get_storage()
+        if self.report_model.report.content_addressed and self.report_model.checksum:
+            filepath = self.get_content_path()
+            if storage.exists(filepath):
+                return filepath
+        else:
+            filepath = self.get_remote_path()
         name = storage.save(filepath, buffer)
         return name
 
+    def get_download_link(self, requester, token):
+        """
+        :param requester: requester
+        :type requester: django_easy_report.models.ReportRequester
+        :param token: signed download token
+        :type token: str
+        :return: absolute URL to the download view or None if cannot be built
+        :rtype: str|None
+        """
+        params = requester.get_params()
+        domain = params.get('domain')
+        if not token or not domain:
+            return
+        path = reverse('django_easy_report:report_download', kwargs={
+            'report_name': self.report_model.report.name,
+            'query_pk': self.report_model.pk,
+        })
+        return '{}://{}{}?{}'.format(
+            params.get('protocol', 'http'), domain, path, urlencode({'token': token})
+        )
+
+    def get_webhook(self, requester):
+        """
+        :param requester: requester
+        :type requester: django_easy_report.models.ReportRequester
+        :return: URL where notify the requester instead of by email, from user_params[webhook_param]
+        :rtype: str|None
+        """
+        if not self.webhook_param:
+            return
+        return requester.get_params().get(self.webhook_param) or None
+
+    def get_webhook_payload(self, report_status, requester, link=None):
+        """
+        :param report_status: item on the list: django_easy_report.constants.STATUS_OPTIONS
+        :type report_status: int
+        :param requester: requester
+        :type requester: django_easy_report.models.ReportRequester
+        :param link: The link point to remote file
+        :type link: str
+        :return: JSON serializable data sent to the webhook
+        :rtype: dict
+        """
+        query = self.report_model
+        return {
+            'report': query.report.name,
+            'query': query.pk,
+            'requester': requester.pk,
+            'status': {
+                'code': report_status,
+                'name': dict(STATUS_OPTIONS).get(report_status),
+            },
+            'filename': query.filename,
+            'mimetype': query.mimetype,
+            'file_size': query.file_size,
+            'checksum': query.checksum,
+            'link': link if report_status == STATUS_DONE else None,
+        }
+
     def get_subject(self, requester):
         """
         :param requester: requester
@@ -163,6 +328,8 @@ class ReportBaseGenerator(object):
             return self.get_done_message(requester, attachment, link)
         elif report_status == STATUS_ERROR:
             return self.get_error_message()
+        elif report_status == STATUS_CANCELED:
+            return self.get_canceled_message()
         status = report_status
         status_options = dict(STATUS_OPTIONS)
         if report_status in status_options:
@@ -176,6 +343,13 @@ class ReportBaseGenerator(object):
         """
         return _('Something was wrong')
 
+    def get_canceled_message(self):
+        """
+        :return: Message used when the report is canceled
+        :rtype: str
+        """
+        return _('Report canceled')
+
     def get_done_message(self, requester=None, attachment=None, url=None):
         """
         :param requester:
@@ -202,6 +376,7 @@ class ReportModelGenerator(ReportBaseGenerator):
                  form_class_name=None,
                  user_fields=None,
                  email_field=None,
+                 chunk_size=None,
                  **kwargs):
         super(ReportModelGenerator, self).__init__(**kwargs)
         try:
@@ -216,6 +391,7 @@ class ReportModelGenerator(ReportBaseGenerator):
             self.form_class = import_class(form_class_name)
         self.email_field = email_field or ''
         self.user_fields = user_fields or []
+        self.chunk_size = chunk_size
 
     def validate(self, data):
         errors = super(ReportModelGenerator, self).validate(data)
@@ -252,9 +428,71 @@ class ReportModelGenerator(ReportBaseGenerator):
     def generate(self, buffer, tmp_dir):
         reader = DictWriter(buffer, self.fields)
         reader.writeheader()
-        for item in self.get_queryset():
-            row = self.get_row(item)
-            reader.writerow(row)
+        self.rows = 0
+        if self.chunk_size:
+            with self.timer(TIMING_QUERY):
+                # Only the chunked reports pay the count to estimate the progress
+                self.total_rows = self.get_queryset().count()
+            return self.generate_chunks(buffer)
+        for item in self.timed_iterator(self.get_queryset()):
+            with self.timer(TIMING_RENDER):
+                row = self.get_row(item)
+                reader.writerow(row)
+            self.row_written()
+
+    def get_part_path(self, first_pk, last_pk):
+        """
+        :return: path used on remote storage for the rows between first_pk and last_pk
+        :rtype: str
+        """
+        return os.path.join('parts', str(self.report_model.pk), '{}-{}.part'.format(first_pk, last_pk))
+
+    def generate_chunks(self, buffer):
+        """
+        Write the rows ordered by pk on chunks of chunk_size rows, each chunk is saved as part on storage
+        and the progress on the checkpoint, so a retry resumes after the last chunk saved
+        :param buffer: Buffer where write the report
+        :return: None
+        """
+        checkpoint = self.report_model.get_checkpoint()
+        storage = self.report_model.get_sender().get_storage()
+        parts = checkpoint.get('parts', [])
+        for path in parts:
+            with storage.open(path, 'rb') as part_file:
+                buffer.write(part_file.read().decode())
+        self.rows = checkpoint.get('rows', 0)
+        last_pk = checkpoint.get('last_pk')
+        queryset = self.get_queryset().order_by('pk')
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            with self.timer(TIMING_QUERY):
+                items = list(chunk[:self.chunk_size])
+            if not items:
+                break
+            part = StringIO()
+            reader = DictWriter(part, self.fields)
+            for item in items:
+                with self.timer(TIMING_RENDER):
+                    reader.writerow(self.get_row(item))
+                self.row_written()
+            path = self.get_part_path(items[0].pk, items[-1].pk)
+            if storage.exists(path):
+                # Saved by an attempt that failed before the checkpoint
+                storage.delete(path)
+            path = storage.save(path, ContentFile(part.getvalue().encode()))
+            buffer.write(part.getvalue())
+            last_pk = items[-1].pk
+            parts.append(path)
+            saved = self.report_model.save_checkpoint({
+                'parts': parts,
+                'last_pk': last_pk,
+                'rows': self.rows,
+            }, **self.get_progress())
+            if not saved:
+                storage.delete(path)
+                raise ReportCanceled()
 
     def get_email(self, requester):
         """
@@ -310,8 +548,7 @@ class AdminReportGenerator(ReportBaseGenerator):
         raise DoNotSend()
 
     def setup(self, report_model, **kwargs):
-        self.setup_params = kwargs
-        self.report_model = report_model
+        super(AdminReportGenerator, self).setup(report_model, **kwargs)
         self.fields = kwargs.get('fields', [])
         self.sql = kwargs.get('sql', '')
         admin_class = kwargs.get('admin_class')
@@ -344,6 +581,9 @@ class AdminReportGenerator(ReportBaseGenerator):
     def generate(self, buffer, tmp_dir):
         reader = DictWriter(buffer, self.fields)
         reader.writeheader()
-        for item in self.get_queryset():
-            row = self.get_row(item)
-            reader.writerow(row)
+        self.rows = 0
+        for item in self.timed_iterator(self.get_queryset()):
+            with self.timer(TIMING_RENDER):
+                row = self.get_row(item)
+                reader.writerow(row)
+            self.row_written()
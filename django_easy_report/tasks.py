@@ -1,62 +1,322 @@
+import datetime
 import logging
 import os.path
+import threading
+import time
+from collections import defaultdict
+from gettext import gettext
 from tempfile import TemporaryDirectory
 
 from celery import shared_task
-from django.core.mail import EmailMessage
-from django.db import transaction
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
 
-from django_easy_report.constants import STATUS_ERROR, STATUS_DONE, STATUS_WORKING
-from django_easy_report.exceptions import DoNotSend
-from django_easy_report.models import ReportRequester, ReportQuery
+from django_easy_report import maintenance, metrics, tracing
+from django_easy_report.constants import STATUS_CREATED, STATUS_ERROR, STATUS_DONE, STATUS_CANCELED, \
+    TIMING_QUEUE, TIMING_GENERATE, TIMING_UPLOAD, TIMING_NOTIFY
+from django_easy_report.exceptions import DoNotSend, ReportCanceled
+from django_easy_report.models import ReportRequester, ReportQuery, ReportNotification, ReportDigestEntry, ReportTiming
+from django_easy_report.utils import ChecksumWriter
+from django_easy_report.webhooks import WebhookSender, is_allowed_webhook
 
 
 logger = logging.getLogger(__name__)
 
 
+def outbox_enabled():
+    return getattr(settings, 'REPORT_NOTIFICATION_OUTBOX', False)
+
+
+class KeepAlive(threading.Thread):
+    """
+    Send the heartbeat of the query each interval seconds while the worker is alive,
+    also on the phases without check points: count, first fetch, upload and custom generate implementations
+    """
+
+    def __init__(self, query, interval):
+        """
+        :type query: ReportQuery
+        :param interval: seconds between heartbeats
+        :type interval: int|float
+        """
+        super(KeepAlive, self).__init__(name='report-keep-alive-{}'.format(query.pk), daemon=True)
+        self.query = query
+        self.interval = interval
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    if not self.query.update_progress():
+                        # Canceled or reaped, the check points will stop the generation
+                        self.lost = True
+                        return
+                except Exception:
+                    logger.exception('Error sending heartbeat', extra={'query_pk': self.query.pk})
+        finally:
+            # Each thread has its own connection
+            connection.close()
+
+    def __enter__(self):
+        if self.interval:
+            self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
 @shared_task
+@tracing.traced_task('report.generate')
 def generate_report(query_pk):
     query = ReportQuery.objects.get(pk=query_pk)
-    query.status = STATUS_WORKING
-    query.save(update_fields=['status', 'updated_at'])
+    report = None
+    timings = {}
+    # Last change of the query was its creation or requeue
+    queued_at = query.updated_at
+    if query.status != STATUS_CANCELED and not query.start_attempt():
+        query.refresh_from_db()
+        if query.status != STATUS_CANCELED:
+            # Started by other attempt or already finished
+            logger.warning('Report not pending', extra={'query_pk': query_pk, 'status': query.status})
+            return
     try:
+        if query.status == STATUS_CANCELED:
+            # Canceled while it was queued
+            raise ReportCanceled()
+        timings[TIMING_QUEUE] = max((query.started_at - queued_at).total_seconds(), 0)
         report = query.get_report()
-        with TemporaryDirectory() as tmp_dirname:
+        keep_alive = KeepAlive(query, getattr(settings, 'REPORT_KEEP_ALIVE_INTERVAL', 60))
+        with keep_alive, TemporaryDirectory() as tmp_dirname:
             filename = report.get_filename()
             query.filename = filename
             query.mimetype = report.get_mimetype()
             tmp_path = os.path.join(tmp_dirname, filename)
-            mode = 'wb' if report.binary else 'w'
-            with open(tmp_path, mode=mode) as buffer:
+            writer = report.writer = ChecksumWriter(tmp_path, mode='w+b')
+            with tracing.span('report.render', query=query_pk), report.timer(TIMING_GENERATE), \
+                    writer.wrap(binary=report.binary) as buffer:
                 report.generate(buffer, tmp_dirname)
-            mode = 'rb' if report.binary else 'r'
-            with open(tmp_path, mode=mode) as buffer:
+            query.file_size = writer.size
+            query.checksum = writer.checksum
+            query.rows = report.rows
+            if keep_alive.lost or not query.update_progress():
+                # Canceled or reaped, other attempt could be generating it
+                raise ReportCanceled()
+            with tracing.span('report.storage', query=query_pk), report.timer(TIMING_UPLOAD), \
+                    open(tmp_path, mode='rb') as buffer:
                 query.storage_path_location = report.save(buffer)
         query.status = STATUS_DONE
+    except ReportCanceled:
+        # Temporal files were removed by TemporaryDirectory, the worker is free
+        logger.info('Report canceled', extra={'query_pk': query_pk})
+        query.status = STATUS_CANCELED
     except Exception:
         logger.exception('Error generating report')
-        query.status = STATUS_ERROR
-        raise
+        if query.checkpoint and query.attempts < getattr(settings, 'REPORT_MAX_ATTEMPTS', 3):
+            # Retried from the last checkpoint
+            query.status = STATUS_CREATED
+        else:
+            query.status = STATUS_ERROR
+            raise
     finally:
-        query.save(update_fields=['status', 'updated_at', 'mimetype', 'storage_path_location', 'filename'])
-        notify_report_done.delay(
-            list(ReportRequester.objects.filter(query_id=query_pk).values_list('id', flat=True))
-        )
+        retry = query.status == STATUS_CREATED
+        checkpoint = query.checkpoint
+        if not retry:
+            # The report will not be resumed, the parts are removed once the result is saved
+            query.checkpoint = None
+        with transaction.atomic():
+            saved = query.save_result(update_fields=[
+                'status', 'mimetype', 'storage_path_location', 'filename',
+                'file_size', 'checksum', 'rows', 'sender', 'checkpoint',
+            ])
+            if saved and not retry and outbox_enabled():
+                ReportNotification.objects.add_pending(query_pk)
+            if saved:
+                save_timings(query, timings, report.timings if report else None)
+        if saved and query.status == STATUS_DONE:
+            report_name = query.report.name
+            metrics.observe(
+                metrics.GENERATION_SECONDS, (timezone.now() - query.started_at).total_seconds(), report=report_name
+            )
+            metrics.inc(metrics.ROWS, query.rows or 0, report=report_name)
+            metrics.inc(metrics.BYTES, query.file_size or 0, report=report_name)
+        metrics.flush(force=True)
+        if saved and not retry and checkpoint:
+            query.discard_checkpoint(checkpoint)
+        if not saved:
+            # Reaped while it was generated, other attempt will notify it
+            logger.warning('Report reaped', extra={'query_pk': query_pk})
+            if query.status == STATUS_DONE and query.storage_path_location:
+                # Uploaded before losing the report, the content addressed files could be used by others
+                sender = query.get_sender()
+                maintenance.release_file(sender.pk, sender.get_storage(), query.storage_path_location)
+        elif retry:
+            tracing.apply_async(generate_report, (query_pk, ), countdown=getattr(settings, 'REPORT_RETRY_DELAY', 60))
+        elif not outbox_enabled():
+            notify_requesters(query_pk)
+
+
+def save_timings(query, *timings):
+    """
+    Save the seconds spent on each phase of the current attempt of the query
+    :type query: ReportQuery
+    :param timings: dicts with phase and seconds
+    """
+    items = []
+    for timing in timings:
+        for phase, seconds in (timing or {}).items():
+            items.append(ReportTiming(query=query, attempt=query.attempts, phase=phase, seconds=seconds))
+    if items:
+        ReportTiming.objects.bulk_create(items)
+
+
+@shared_task
+def reap_reports(timeout=None, max_attempts=None):
+    """
+    Requeue the reports without heartbeat, for example if the worker was killed,
+    or mark them as error after max_attempts generations.
+    It must be scheduled periodically.
+    :param timeout: seconds without heartbeat, by default REPORT_HEARTBEAT_TIMEOUT
+    :param max_attempts: generations before mark it as error, by default REPORT_MAX_ATTEMPTS
+    :return: number of reaped reports
+    :rtype: int
+    """
+    if max_attempts is None:
+        max_attempts = getattr(settings, 'REPORT_MAX_ATTEMPTS', 3)
+    reaped = 0
+    stale = ReportQuery.objects.filter(ReportQuery.stale(timeout)).values_list('pk', 'attempts')
+    for query_pk, attempts in stale.iterator():
+        status = STATUS_CREATED if attempts < max_attempts else STATUS_ERROR
+        with transaction.atomic():
+            # Only if the worker did not finish or send a heartbeat meanwhile
+            updated = ReportQuery.objects.filter(ReportQuery.stale(timeout), pk=query_pk, attempts=attempts).update(
+                status=status, updated_at=timezone.now()
+            )
+            if updated and status == STATUS_ERROR and outbox_enabled():
+                ReportNotification.objects.add_pending(query_pk)
+        if not updated:
+            continue
+        reaped += 1
+        logger.warning('Report reaped', extra={'query_pk': query_pk, 'attempts': attempts})
+        if status == STATUS_CREATED:
+            generate_report.delay(query_pk)
+            continue
+        query = ReportQuery.objects.get(pk=query_pk)
+        if query.checkpoint:
+            # It will not be resumed
+            query.discard_checkpoint()
+            query.save(update_fields=['checkpoint'])
+        if not outbox_enabled():
+            notify_requesters(query_pk)
+    return reaped
+
+
+@shared_task
+def enforce_retention(limit=None):
+    """
+    Remove the reports out of the retention policy of their ReportGenerator.
+    It must be scheduled periodically when some ReportGenerator has retention.
+    :return: number of removed reports
+    :rtype: int
+    """
+    return maintenance.enforce_retention(limit=limit)
+
+
+@shared_task
+def sweep_orphans(delete=False):
+    """
+    Log the files on storage without report, older than REPORT_SWEEP_MIN_AGE, and remove them if delete
+    :return: number of orphan files
+    :rtype: int
+    """
+    orphans = 0
+    for sender, path in maintenance.sweep_orphans(delete=delete):
+        logger.info('Orphan report file', extra={'sender_pk': sender.pk, 'path': path})
+        orphans += 1
+    return orphans
+
+
+def notify_requesters(query_pk):
+    """
+    Enqueue the notification of the pending requesters of the query
+    """
+    requester_pks = ReportRequester.objects.filter(
+        query_id=query_pk, notified=False
+    ).order_by('pk').values_list('pk', flat=True)
+    notify_in_chunks(requester_pks.iterator())
+
+
+def notify_in_chunks(requester_pks):
+    """
+    Enqueue the notification of requesters of the same query,
+    split in chunks of REPORT_NOTIFY_CHUNK_SIZE requesters notified in parallel
+    """
+    chunk_size = getattr(settings, 'REPORT_NOTIFY_CHUNK_SIZE', 100)
+    chunk = []
+    for requester_pk in requester_pks:
+        chunk.append(requester_pk)
+        if len(chunk) >= chunk_size:
+            tracing.apply_async(notify_report_done, (chunk, ))
+            chunk = []
+    if chunk:
+        tracing.apply_async(notify_report_done, (chunk, ))
+
+
+@shared_task
+def dispatch_notifications(batch_size=None):
+    """
+    Drain the notification outbox, enqueuing the pending notifications grouped by query.
+    It must be scheduled periodically when REPORT_NOTIFICATION_OUTBOX is enabled.
+    :return: number of dispatched notifications
+    :rtype: int
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'REPORT_NOTIFICATION_BATCH_SIZE', 1000)
+    with transaction.atomic():
+        pending = list(ReportNotification.objects.select_for_update(skip_locked=True, of=('self', )).values_list(
+            'pk', 'requester_id', 'requester__query_id'
+        )[:batch_size])
+        by_query = defaultdict(list)
+        for _, requester_pk, query_pk in pending:
+            by_query[query_pk].append(requester_pk)
+        for requester_pks in by_query.values():
+            notify_in_chunks(requester_pks)
+        # If the broker fails the transaction is rolled back and will be dispatched on the next run
+        ReportNotification.objects.filter(pk__in=[pk for pk, _, _ in pending]).delete()
+    return len(pending)
 
 
 @shared_task
+@tracing.traced_task('report.notify')
 def notify_report_done(requester_pks):
-    requesters = ReportRequester.objects.select_for_update().filter(pk__in=requester_pks, notified=False)
     with transaction.atomic():
-        requester = requesters.last()
-        if not requester:
+        # Rows locked by other task are being notified by it
+        claimed = list(ReportRequester.objects.select_for_update(skip_locked=True).filter(
+            pk__in=requester_pks, notified=False
+        ).values_list('pk', 'query_id'))
+        if not claimed:
             return
-        if requesters.exclude(query=requester.query).exists():
+        query_pks = set(query_pk for _, query_pk in claimed)
+        if len(query_pks) > 1:
             raise ValueError('All requesters must be from the same query ({})'.format(requester_pks))
-        requester_pks = list(requesters.values_list('pk', flat=True))
-        requesters.update(notified=True)
+        requester_pks = [requester_pk for requester_pk, _ in claimed]
+        ReportRequester.objects.filter(pk__in=requester_pks).update(notified=True)
+    start = time.perf_counter()
 
-    query = requester.query
+    requesters = list(ReportRequester.objects.filter(pk__in=requester_pks).select_related(
+        'user', 'query__report__sender', 'query__sender'
+    ))
+    query = requesters[0].query
+    for requester in requesters:
+        # Share the same query, so the report is built only once
+        requester.query = query
     report = query.get_report()
     sender = query.report.sender
 
@@ -64,40 +324,256 @@ def notify_report_done(requester_pks):
 
     with_attachment = False
     link = query.get_url()
+    token = None
+    if query.status == STATUS_DONE:
+        token = query.get_download_token()
 
-    if sender.email_from and file_size:
-        if file_size < sender.size_to_attach:
-            with_attachment = True
+    compressed = False
+    if sender.email_from and file_size and not sender.digest_window:
+        attach_size, compressed = get_attachment_size(query, file_size, sender.size_to_attach)
+        with_attachment = attach_size is not None
 
-    content = None
+    attachment = None
     if with_attachment and file_size:
-        with query.get_file(open_file=True) as attachment:
-            content = attachment.read()
-            attachment.close()
+        attachment = query.get_attachment(compressed=compressed)
+        # The file could be missing on storage, in that case the link is sent
+        with_attachment = attachment is not None
 
-    requesters = ReportRequester.objects.filter(pk__in=requester_pks)
+    messages = []
+    webhooks = []
+    digest_entries = []
+    connection = get_connection()
     for requester in requesters:
         try:
+            webhook = report.get_webhook(requester)
+            if webhook:
+                if not is_allowed_webhook(webhook):
+                    raise ValueError('Webhook not allowed')
+                requester_link = report.get_download_link(requester, token) or link
+                payload = report.get_webhook_payload(requester.query.status, requester, requester_link)
+                webhooks.append((requester, webhook, payload))
+                continue
             email_to = report.get_email(requester)
+            if sender.digest_window:
+                # Rendered and sent with other reports of the same email by send_digest
+                digest_entries.append(ReportDigestEntry(sender=sender, email=email_to, requester=requester))
+                continue
             subject = report.get_subject(requester)
-            body = report.get_message(requester.query.status, requester, with_attachment, link)
+            requester_link = report.get_download_link(requester, token) or link
+            body = report.get_message(requester.query.status, requester, with_attachment, requester_link)
 
             mail = EmailMessage(
                 subject,
                 body,
                 sender.email_from,
                 [email_to],
+                connection=connection,
             )
-            if content:
-                mail.attach(query.filename, content, query.mimetype)
-
-            mail.send()
+            if attachment:
+                mail.attach(attachment)
+            messages.append((requester, mail))
         except DoNotSend:
             logger.info('Report will not be send',
                         extra={'query_pk': query.pk, 'requester_pk': requester.pk})
             continue
         except Exception:
-            # Only update notified if it was falling in other case the previous updated set as true
-            requester.notified = False
-            requester.save(update_fields=['notified'])
+            set_not_notified(requester)
             logger.exception('Error sending report', extra={'query_pk': query.pk, 'requester_pk': requester.pk})
+
+    batch_size = getattr(settings, 'REPORT_EMAIL_BATCH_SIZE', 100)
+    for pos in range(0, len(messages), batch_size):
+        send_batch(connection, messages[pos:pos + batch_size], query.pk)
+
+    if webhooks:
+        send_webhooks(webhooks, query.pk)
+
+    if digest_entries:
+        add_to_digest(sender, digest_entries)
+
+    save_timings(query, {TIMING_NOTIFY: time.perf_counter() - start})
+    metrics.flush(force=True)
+
+
+def get_attachment_size(query, file_size, max_size):
+    """
+    :param query: report to attach
+    :type query: ReportQuery
+    :param file_size: size of the report
+    :param max_size: attachments must be smaller than it
+    :return: size of the attachment or None if it does not fit, and if it must be compressed
+    :rtype: (int|None, bool)
+    """
+    if file_size < max_size:
+        return file_size, False
+    sender = query.report.sender
+    # Reports much bigger than the attachment would not fit compressed, they are not downloaded
+    max_ratio = getattr(settings, 'REPORT_COMPRESS_MAX_RATIO', 10)
+    if max_ratio and file_size > max_size * max_ratio:
+        return None, False
+    if sender.compress_attachment and query.status == STATUS_DONE and query.checksum:
+        # Compressed once, the zip is saved on storage by checksum
+        compressed_size = query.compress()
+        if compressed_size is not None and compressed_size < max_size:
+            return compressed_size, True
+    return None, False
+
+
+def set_not_notified(requester):
+    # Only update notified if it was falling in other case the previous updated set as true
+    requester.notified = False
+    requester.save(update_fields=['notified'])
+    metrics.inc(metrics.NOTIFICATION_FAILURES, report=requester.query.report.name)
+
+
+def add_to_digest(sender, entries):
+    """
+    Save the entries and send the digest of the emails that reached sender.digest_max_items
+    :type sender: django_easy_report.models.ReportSender
+    :param entries: list of unsaved ReportDigestEntry
+    """
+    ReportDigestEntry.objects.bulk_create(entries)
+    if not sender.digest_max_items:
+        return
+    full = ReportDigestEntry.objects.filter(
+        sender=sender, email__in=set(entry.email for entry in entries)
+    ).values('email').annotate(items=Count('pk')).filter(items__gte=sender.digest_max_items).order_by()
+    for email in full.values_list('email', flat=True):
+        send_digest.delay(sender.pk, email)
+
+
+@shared_task
+def send_digests():
+    """
+    Send the digest messages whose window is expired.
+    It must be scheduled periodically when some ReportSender has digest_window.
+    :return: number of sent messages
+    :rtype: int
+    """
+    now = timezone.now()
+    groups = ReportDigestEntry.objects.values(
+        'sender_id', 'email', 'sender__digest_window', 'sender__digest_max_items'
+    ).annotate(first=Min('created_at'), items=Count('pk')).order_by()
+    sent = 0
+    for group in groups:
+        window = datetime.timedelta(seconds=group['sender__digest_window'] or 0)
+        max_items = group['sender__digest_max_items']
+        if group['first'] + window <= now or (max_items and group['items'] >= max_items):
+            try:
+                sent += send_digest(group['sender_id'], group['email'])
+            except Exception:
+                # The entries are kept and retried on the next run, the other digests are sent
+                logger.exception('Error sending digest', extra={'sender_pk': group['sender_id']})
+    return sent
+
+
+@shared_task
+def send_digest(sender_pk, email):
+    """
+    Send one message with the pending reports of the email,
+    with the links and as attachments the reports that fit together on sender.size_to_attach
+    :return: number of sent messages
+    :rtype: int
+    """
+    with transaction.atomic():
+        # If the message cannot be sent the transaction is rolled back and will be sent on the next run
+        entries = list(ReportDigestEntry.objects.select_for_update(skip_locked=True, of=('self', )).filter(
+            sender_id=sender_pk, email=email
+        ).select_related('sender', 'requester__user', 'requester__query__report', 'requester__query__sender'))
+        if not entries:
+            return 0
+        sender = entries[0].sender
+        max_items = sender.digest_max_items or len(entries)
+        entries = entries[:max_items]
+
+        queries = {}
+        parts = []
+        attachments = []
+        attached_size = 0
+        for entry in entries:
+            requester = entry.requester
+            # Share the query between the requesters, so the report is built only once
+            if requester.query_id not in queries:
+                queries[requester.query_id] = requester.query
+                requester.query.report.sender = sender
+            query = queries[requester.query_id]
+            requester.query = query
+            report = query.get_report()
+
+            with_attachment = False
+            file_size = query.get_file_size()
+            if file_size:
+                file_size, compressed = get_attachment_size(query, file_size, sender.size_to_attach - attached_size)
+                attachment = None
+                if file_size is not None:
+                    attachment = query.get_attachment(compressed=compressed)
+                # The file could be missing on storage, in that case only the link is sent
+                if attachment is not None:
+                    with_attachment = True
+                    attached_size += file_size
+                    attachments.append(attachment)
+
+            token = None
+            if query.status == STATUS_DONE:
+                token = query.get_download_token()
+            link = report.get_download_link(requester, token) or query.get_url()
+            try:
+                body = report.get_message(query.status, requester, with_attachment, link)
+            except DoNotSend:
+                logger.info('Report will not be send', extra={'query_pk': query.pk, 'requester_pk': requester.pk})
+                if with_attachment:
+                    attached_size -= file_size
+                    attachments.pop()
+                continue
+            parts.append('{}: {}'.format(report.get_subject(requester), body))
+
+        ReportDigestEntry.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
+        if not parts:
+            return 0
+        mail = EmailMessage(
+            gettext('{} reports completed').format(len(parts)),
+            '\n\n'.join(parts),
+            sender.email_from,
+            [email],
+        )
+        for attachment in attachments:
+            mail.attach(attachment)
+        mail.send()
+    return 1
+
+
+def send_webhooks(webhooks, query_pk):
+    """
+    Deliver the webhooks concurrently
+    :param webhooks: list of (requester, url, payload)
+    :param query_pk: used for logging
+    """
+    results = WebhookSender().send([(url, payload) for _, url, payload in webhooks])
+    for (requester, _, _), delivered in zip(webhooks, results):
+        if not delivered:
+            set_not_notified(requester)
+            logger.error('Error calling webhook', extra={'query_pk': query_pk, 'requester_pk': requester.pk})
+
+
+def send_batch(connection, messages, query_pk):
+    """
+    Send the messages using only one connection
+    :param connection: email backend shared by all the messages
+    :param messages: list of (requester, email message)
+    :param query_pk: used for logging
+    """
+    try:
+        connection.open()
+    except Exception:
+        logger.exception('Error opening email connection', extra={'query_pk': query_pk})
+        for requester, _ in messages:
+            set_not_notified(requester)
+        return
+    try:
+        for requester, mail in messages:
+            try:
+                mail.send()
+            except Exception:
+                set_not_notified(requester)
+                logger.exception('Error sending report', extra={'query_pk': query_pk, 'requester_pk': requester.pk})
+    finally:
+        connection.close()
@@ -0,0 +1,442 @@
+import json
+import os
+from datetime import date, timedelta
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from django_easy_report.constants import STATUS_DONE, STATUS_WORKING, STATUS_CANCELED, TIMING_GENERATE
+from django_easy_report.maintenance import purge_reports, sweep_orphans, delete_without_signals, BloomFilter
+from django_easy_report.models import ReportQuery, ReportRequester, ReportNotification, ReportSender, ReportTiming
+from django_easy_report.tasks import enforce_retention, sweep_orphans as sweep_orphans_task
+from django_easy_report.tests.test_report_generation import ReportBaseTestCase
+
+
+class StorageBaseTestCase(ReportBaseTestCase):
+
+    def setUp(self):
+        super(StorageBaseTestCase, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self._setup_sender(self.tmp_dir.name)
+
+    def _path(self, query):
+        return os.path.join(self.tmp_dir.name, query.storage_path_location)
+
+
+class CleanReportsTestCase(StorageBaseTestCase):
+
+    def _create_reports(self, count):
+        queries = []
+        for pos in range(count):
+            query = self._create_query({'pos': pos}, {})
+            self._save_example_report(query, 'content {}'.format(pos), filename='report{}.csv'.format(pos))
+            ReportNotification.objects.add_pending(query.pk)
+            ReportTiming.objects.create(query=query, phase=TIMING_GENERATE, seconds=1)
+            queries.append(query)
+        return queries
+
+    def _clean(self, *args):
+        tomorrow = (date.today() + timedelta(days=1)).strftime('%d-%m-%Y')
+        out = StringIO()
+        call_command('clean_reports', '--until', tomorrow, *args, stdout=out)
+        return out.getvalue()
+
+    def test_clean_reports(self):
+        queries = self._create_reports(5)
+
+        output = self._clean('--batch-size', '2', '--workers', '2')
+
+        self.assertIn('5 reports will be remoted', output)
+        self.assertIn('Successfully removed', output)
+        self.assertFalse(ReportQuery.objects.exists())
+        self.assertFalse(ReportRequester.objects.exists())
+        self.assertFalse(ReportNotification.objects.exists())
+        self.assertFalse(ReportTiming.objects.exists())
+        for query in queries:
+            self.assertFalse(os.path.exists(self._path(query)))
+
+    def test_clean_reports_dry_run(self):
+        queries = self._create_reports(2)
+
+        output = self._clean('--dry-run')
+
+        self.assertIn('2 reports will be remoted', output)
+        self.assertNotIn('Successfully removed', output)
+        self.assertEqual(ReportQuery.objects.count(), 2)
+        for query in queries:
+            self.assertTrue(os.path.exists(self._path(query)))
+
+    def test_purge_keep_shared_files(self):
+        removed, kept = self._create_reports(2)
+        shared = self._create_query({'shared': True}, {})
+        shared.storage_path_location = kept.storage_path_location
+        shared.save()
+        removed.storage_path_location = kept.storage_path_location
+        removed.save()
+
+        self.assertEqual(purge_reports(ReportQuery.objects.exclude(pk=shared.pk), batch_size=1), 2)
+
+        self.assertEqual(list(ReportQuery.objects.all()), [shared])
+        self.assertTrue(os.path.exists(self._path(shared)))
+
+    def test_purge_preserve_report(self):
+        query, = self._create_reports(1)
+        self.report.preserve_report = True
+        self.report.save()
+
+        self.assertEqual(purge_reports(ReportQuery.objects.all()), 1)
+
+        self.assertFalse(ReportQuery.objects.exists())
+        self.assertTrue(os.path.exists(self._path(query)))
+
+    def test_purge_checkpoint_parts(self):
+        query, = self._create_reports(1)
+        storage = self.report.sender.get_storage()
+        path = storage.save('parts/{}/1-2.part'.format(query.pk), ContentFile(b'admin\n'))
+        ReportQuery.objects.filter(pk=query.pk).update(checkpoint=json.dumps({'parts': [path]}))
+
+        self.assertEqual(purge_reports(ReportQuery.objects.all()), 1)
+
+        self.assertFalse(storage.exists(path))
+        self.assertFalse(os.path.exists(self._path(query)))
+
+    def test_delete_without_signals(self):
+        first, second, kept = self._create_reports(3)
+        ReportRequester.objects.filter(query__in=[first, second]).delete()
+        ReportTiming.objects.filter(query__in=[first, second]).delete()
+        deleted = []
+
+        def receiver(instance, **kwargs):
+            deleted.append(instance.pk)
+
+        post_delete.connect(receiver, sender=ReportQuery)
+        self.addCleanup(post_delete.disconnect, receiver, sender=ReportQuery)
+
+        self.assertEqual(delete_without_signals(ReportQuery, [first.pk, second.pk], batch_size=1), 2)
+
+        self.assertEqual(list(ReportQuery.objects.all()), [kept])
+        self.assertEqual(deleted, [])
+        # Files are not removed by the signal
+        self.assertTrue(os.path.exists(self._path(first)))
+
+    def test_purge_dry_run(self):
+        self._create_reports(3)
+        self.assertEqual(purge_reports(ReportQuery.objects.all(), dry_run=True), 3)
+        self.assertEqual(ReportQuery.objects.count(), 3)
+
+    def test_purge_storage_failing(self):
+        first, second = self._create_reports(2)
+        storage = self.report.sender.get_storage()
+        with patch.object(storage.__class__, 'delete', side_effect=[OSError('Storage down'), None, None, None]):
+            self.assertEqual(purge_reports(ReportQuery.objects.all(), workers=1), 2)
+        self.assertFalse(ReportQuery.objects.exists())
+
+    def test_purge_queries_by_chunk(self):
+        def count_queries(count):
+            self._create_reports(count)
+            with CaptureQueriesContext(connection) as context:
+                purge_reports(ReportQuery.objects.all(), batch_size=100)
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(2), count_queries(10))
+
+
+@override_settings(REPORT_RETENTION_THROTTLE=0)
+class RetentionTestCase(StorageBaseTestCase):
+
+    def _create_reports(self, count, params=None, days_ago=0, status=STATUS_DONE):
+        queries = []
+        for pos in range(count):
+            query = self._create_query(params or {'pos': pos}, {})
+            self._save_example_report(query, 'content {}'.format(pos), filename='report{}.csv'.format(pos))
+            query.status = status
+            query.save()
+            ReportQuery.objects.filter(pk=query.pk).update(
+                created_at=timezone.now() - timedelta(days=days_ago, seconds=count - pos)
+            )
+            queries.append(query)
+        return queries
+
+    def test_retention_days(self):
+        old = self._create_reports(2, days_ago=8)
+        old += self._create_reports(1, days_ago=8, status=STATUS_CANCELED)
+        working, = self._create_reports(1, days_ago=8, status=STATUS_WORKING)
+        recent = self._create_reports(2, days_ago=6)
+        self.report.retention_days = 7
+        self.report.save()
+
+        self.assertEqual(enforce_retention(), 3)
+
+        self.assertEqual(set(ReportQuery.objects.all()), set(recent + [working]))
+        for query in old:
+            self.assertFalse(os.path.exists(self._path(query)))
+
+    def test_retention_copies(self):
+        copies = self._create_reports(4, params={'same': 'params'})
+        others = self._create_reports(2)
+        self.report.retention_copies = 2
+        self.report.save()
+
+        self.assertEqual(enforce_retention(), 2)
+
+        self.assertEqual(set(ReportQuery.objects.all()), set(copies[2:] + others))
+        self.assertEqual(enforce_retention(), 0)
+
+    def test_retention_limit(self):
+        self._create_reports(5, days_ago=2)
+        self.report.retention_days = 1
+        self.report.save()
+
+        self.assertEqual(enforce_retention(limit=3), 3)
+        self.assertEqual(ReportQuery.objects.count(), 2)
+        self.assertEqual(enforce_retention(limit=3), 2)
+
+    @override_settings(REPORT_RETENTION_BATCH_SIZE=2, REPORT_RETENTION_THROTTLE=0.1)
+    def test_retention_throttle(self):
+        self._create_reports(5, days_ago=2)
+        self.report.retention_days = 1
+        self.report.save()
+
+        with patch('django_easy_report.maintenance.time.sleep') as mock_sleep:
+            self.assertEqual(enforce_retention(), 5)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    def test_without_retention(self):
+        self._create_reports(2, days_ago=1000)
+        self.assertEqual(enforce_retention(), 0)
+        self.assertEqual(ReportQuery.objects.count(), 2)
+
+
+class SweepOrphansTestCase(StorageBaseTestCase):
+
+    def setUp(self):
+        super(SweepOrphansTestCase, self).setUp()
+        self.storage = self.report.sender.get_storage()
+
+    def _save_file(self, path, age=timedelta(days=2)):
+        path = self.storage.save(path, ContentFile(b'content'))
+        modified = (timezone.now() - age).timestamp()
+        os.utime(os.path.join(self.tmp_dir.name, path), (modified, modified))
+        return path
+
+    def _create_report(self, path, checksum=None):
+        query = self._create_query({'path': path}, {})
+        query.storage_path_location = self._save_file(path)
+        query.checksum = checksum
+        query.save()
+        return query
+
+    def _sweep(self, *args):
+        out = StringIO()
+        call_command('sweep_orphans', *args, stdout=out)
+        return out.getvalue()
+
+    def test_sweep_orphans(self):
+        checksum = 'a' * 64
+        used = self._create_report(os.path.join('User_report', '20210101-0000', 'used.csv'), checksum)
+        used_zip = self._save_file(ReportQuery.compressed_path(checksum))
+        orphan = self._save_file(os.path.join('User_report', '20210101-0000', 'orphan.csv'))
+        orphan_zip = self._save_file(ReportQuery.compressed_path('b' * 64))
+        orphan_content = self._save_file(os.path.join('sha256', 'cc', 'c' * 64 + '.csv'))
+        recent = self._save_file(os.path.join('User_report', '20210101-0000', 'recent.csv'), age=timedelta(0))
+        other = self._save_file(os.path.join('other', 'file.csv'))
+
+        output = self._sweep()
+
+        self.assertIn('3 orphan files found', output)
+        for path in (orphan, orphan_zip, orphan_content):
+            self.assertIn('Local storage: {}'.format(path), output)
+        for path in (used.storage_path_location, used_zip, orphan, recent, other):
+            self.assertTrue(self.storage.exists(path))
+
+        output = self._sweep('--delete', '--sender', 'Local storage')
+
+        self.assertIn('3 orphan files removed', output)
+        for path in (orphan, orphan_zip, orphan_content):
+            self.assertFalse(self.storage.exists(path))
+        for path in (used.storage_path_location, used_zip, recent, other):
+            self.assertTrue(self.storage.exists(path))
+
+    def test_sweep_checkpoint_parts(self):
+        query = self._create_query({}, {})
+        used = self._save_file(os.path.join('parts', str(query.pk), '1-2.part'))
+        ReportQuery.objects.filter(pk=query.pk).update(checkpoint=json.dumps({'parts': [used]}))
+        orphan = self._save_file(os.path.join('parts', str(query.pk + 1), '1-2.part'))
+
+        self.assertEqual(list(sweep_orphans(delete=True)), [(self.report.sender, orphan)])
+        self.assertTrue(self.storage.exists(used))
+        self.assertFalse(self.storage.exists(orphan))
+
+        with patch('django_easy_report.maintenance.build_index', return_value=BloomFilter(1)):
+            self.assertEqual(list(sweep_orphans()), [])
+
+    def test_sweep_min_age(self):
+        self._save_file(os.path.join('User_report', 'orphan.csv'), age=timedelta(hours=2))
+        self.assertIn('0 orphan files found', self._sweep('--min-age', '3'))
+        self.assertIn('1 orphan files found', self._sweep('--min-age', '1'))
+
+    def test_sweep_report_created_after_index(self):
+        query = self._create_report(os.path.join('User_report', 'new.csv'))
+        with patch('django_easy_report.maintenance.build_index', return_value=BloomFilter(1)):
+            self.assertEqual(list(sweep_orphans()), [])
+        self.assertTrue(self.storage.exists(query.storage_path_location))
+
+    def test_sweep_task(self):
+        orphan = self._save_file(os.path.join('User_report', 'orphan.csv'))
+        self.assertEqual(sweep_orphans_task(), 1)
+        self.assertTrue(self.storage.exists(orphan))
+        self.assertEqual(sweep_orphans_task(delete=True), 1)
+        self.assertFalse(self.storage.exists(orphan))
+
+    def test_sweep_shared_storage(self):
+        sender = self.report.sender
+        other_sender = ReportSender.objects.create(
+            name='Same location',
+            storage_class_name=sender.storage_class_name,
+            storage_init_params=sender.storage_init_params,
+        )
+        checksum = 'd' * 64
+        query = self._create_report(os.path.join('sha256', 'dd', checksum + '.csv'), checksum)
+        query.sender = other_sender
+        query.save()
+        used_zip = self._save_file(ReportQuery.compressed_path(checksum))
+
+        self.assertEqual(list(sweep_orphans(delete=True)), [])
+        self.assertTrue(self.storage.exists(query.storage_path_location))
+        self.assertTrue(self.storage.exists(used_zip))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        for pos in range(1000):
+            bloom.add('added/{}'.format(pos))
+        for pos in range(1000):
+            self.assertIn('added/{}'.format(pos), bloom)
+        false_positives = sum('missing/{}'.format(pos) in bloom for pos in range(1000))
+        self.assertLess(false_positives, 10)
+
+
+class TierReportsTestCase(StorageBaseTestCase):
+
+    def setUp(self):
+        super(TierReportsTestCase, self).setUp()
+        self.archive_dir = TemporaryDirectory()
+        self.addCleanup(self.archive_dir.cleanup)
+        self.archive = ReportSender.objects.create(
+            name='Archive',
+            storage_class_name='django.core.files.storage.FileSystemStorage',
+            storage_init_params=json.dumps({'location': self.archive_dir.name}),
+        )
+
+    def _create_report(self, pos, days_ago=10, status=STATUS_DONE):
+        query = self._create_query({'pos': pos}, {})
+        self._save_example_report(query, 'content {}'.format(pos), filename='report{}.csv'.format(pos))
+        query.status = status
+        query.save()
+        ReportQuery.objects.filter(pk=query.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+        return query
+
+    def _archive_path(self, query):
+        return os.path.join(self.archive_dir.name, query.storage_path_location)
+
+    def _tier(self, *args):
+        out = StringIO()
+        call_command('tier_reports', '--target', 'Archive', '--days', '7', *args, stdout=out)
+        return out.getvalue()
+
+    def test_tier_reports(self):
+        old = [self._create_report(0), self._create_report(1)]
+        working = self._create_report(2, status=STATUS_WORKING)
+        recent = self._create_report(3, days_ago=1)
+
+        self.assertIn('2 reports moved to Archive', self._tier('--batch-size', '1', '--workers', '2'))
+
+        for query in old:
+            source_path = self._path(query)
+            query.refresh_from_db()
+            self.assertEqual(query.sender, self.archive)
+            self.assertFalse(os.path.exists(source_path))
+            self.assertTrue(os.path.exists(self._archive_path(query)))
+            with query.get_file(open_file=True) as remote_file:
+                self.assertEqual(remote_file.read(), 'content {}'.format(query.get_params()['pos']))
+        for query in (working, recent):
+            query.refresh_from_db()
+            self.assertIsNone(query.sender)
+            self.assertTrue(os.path.exists(self._path(query)))
+
+        self.assertIn('0 reports moved to Archive', self._tier())
+
+        query = old[0]
+        query.delete()
+        self.assertFalse(os.path.exists(self._archive_path(query)))
+
+    def test_tier_compressed_report(self):
+        checksum = 'a' * 64
+        moved, shared = self._create_report(0), self._create_report(1, days_ago=1)
+        ReportQuery.objects.filter(pk__in=[moved.pk, shared.pk]).update(checksum=checksum)
+        storage = self.report.sender.get_storage()
+        zip_path = storage.save(ReportQuery.compressed_path(checksum), ContentFile(b'zip'))
+
+        self.assertIn('1 reports moved to Archive', self._tier())
+        # Still used by the report on the source storage
+        self.assertTrue(storage.exists(zip_path))
+
+        ReportQuery.objects.filter(pk=shared.pk).update(created_at=timezone.now() - timedelta(days=10))
+        self.assertIn('1 reports moved to Archive', self._tier())
+        self.assertFalse(storage.exists(zip_path))
+
+    def test_tier_keep_shared_file(self):
+        first = self._create_report(0)
+        second = self._create_report(1)
+        second.storage_path_location = first.storage_path_location
+        second.save()
+
+        self.assertIn('1 reports moved to Archive', self._tier('--limit', '1'))
+
+        self.assertTrue(os.path.exists(self._path(second)))
+        first.refresh_from_db()
+        self.assertTrue(os.path.exists(self._archive_path(first)))
+
+    def test_tier_report_changed_during_copy(self):
+        query = self._create_report(0)
+
+        storage = self.report.sender.get_storage()
+
+        def change_before_copy(*args):
+            ReportQuery.objects.filter(pk=query.pk).update(storage_path_location='changed.csv')
+            return storage
+
+        with patch.object(ReportSender, 'get_pooled_storage', side_effect=change_before_copy):
+            self.assertIn('0 reports moved to Archive', self._tier())
+
+        self.assertFalse(os.listdir(self.archive_dir.name))
+        self.assertTrue(os.path.exists(self._path(query)))
+
+    @override_settings(REPORT_DOWNLOAD_TOKEN_MAX_AGE=60)
+    def test_download_token_signed_before_move(self):
+        self.report.always_download = True
+        self.report.save()
+        query = self._create_report(0)
+        url = '{}?token={}'.format(reverse('django_easy_report:report_download', kwargs={
+            'report_name': self.report.name,
+            'query_pk': query.pk,
+        }), query.get_download_token())
+
+        self._tier()
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'content 0')
+
+    def test_tier_unknown_sender(self):
+        with self.assertRaises(CommandError):
+            call_command('tier_reports', '--target', 'unknown', '--days', '7')
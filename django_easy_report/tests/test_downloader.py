@@ -1,16 +1,20 @@
 import json
 from io import StringIO
 from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core import signing
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils.http import http_date
 
 from django_easy_report.constants import STATUS_DONE
 from django_easy_report.models import ReportGenerator, ReportQuery, ReportRequester
+from django_easy_report.views import DownloadReport
 
 
-class DownloaderTestCase(TestCase):
+class DownloaderBaseTestCase(TestCase):
     fixtures = ['basic_data.json']
 
     def setUp(self):
@@ -56,6 +60,9 @@ class DownloaderTestCase(TestCase):
         self.query.status = STATUS_DONE
         self.query.save()
 
+
+class DownloaderTestCase(DownloaderBaseTestCase):
+
     def test_report_do_not_match_with_query(self):
         self.client.force_login(self.user)
         report = ReportGenerator.objects.create(
@@ -118,3 +125,193 @@ class DownloaderTestCase(TestCase):
                 headers['Content-Disposition'],
                 'attachment; filename=test.csv'
             )
+
+
+class DownloaderCacheTestCase(DownloaderBaseTestCase):
+
+    def setUp(self):
+        super(DownloaderCacheTestCase, self).setUp()
+        self.client.force_login(self.user)
+        self.report.always_download = True
+        self.report.cache_control = 'private, max-age=3600'
+        self.report.save()
+
+    def test_validators(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('Just a test')
+            self.query.checksum = 'c0ffee'
+            self.query.file_size = len('Just a test')
+            self.query.save()
+
+            original = DownloadReport.file_response
+            with patch.object(DownloadReport, 'file_response', autospec=True, side_effect=original) as mock_response:
+                response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(mock_response.call_args[1]['size'], 11)
+            self.assertEqual(response['Content-Length'], '11')
+            self.assertEqual(response['ETag'], '"c0ffee"')
+            self.assertEqual(response['Last-Modified'], http_date(int(self.query.updated_at.timestamp())))
+            self.assertEqual(response['Cache-Control'], 'private, max-age=3600')
+
+    def test_validators_without_checksum(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('Just a test')
+
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                response['ETag'],
+                '"{}-{}"'.format(self.query.pk, int(self.query.updated_at.timestamp()))
+            )
+
+    def test_if_none_match(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('Just a test')
+            self.query.checksum = 'c0ffee'
+            self.query.save()
+
+            with patch('django_easy_report.models.ReportQuery.get_file') as mock_get_file:
+                response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"c0ffee"')
+                self.assertFalse(mock_get_file.called)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], '"c0ffee"')
+            self.assertEqual(response['Cache-Control'], 'private, max-age=3600')
+
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"')
+            self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('Just a test')
+            last_modified = http_date(int(self.query.updated_at.timestamp()))
+
+            response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 304)
+
+    def test_not_done_without_validators(self):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 404)
+
+    def test_token_if_none_match(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('Just a test')
+            self.query.checksum = 'c0ffee'
+            self.query.save()
+            token = self.query.get_download_token(max_age=60)
+            self.client.logout()
+
+            with patch('django_easy_report.views.ReportSender.get_storage') as mock_storage:
+                response = self.client.get('{}?token={}'.format(self.url, token), HTTP_IF_NONE_MATCH='"c0ffee"')
+                self.assertFalse(mock_storage.called)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['Cache-Control'], 'private, max-age=3600')
+
+
+class DownloaderTokenTestCase(DownloaderBaseTestCase):
+
+    def _get_token_url(self, max_age=60):
+        token = self.query.get_download_token(max_age=max_age)
+        return '{}?token={}'.format(self.url, token)
+
+    def test_token_disabled_by_default(self):
+        self.query.storage_path_location = 'test.csv'
+        self.assertIsNone(self.query.get_download_token())
+
+    @override_settings(REPORT_DOWNLOAD_TOKEN_MAX_AGE=60)
+    def test_token_from_settings(self):
+        self.query.storage_path_location = 'test.csv'
+        self.assertIsNotNone(self.query.get_download_token())
+
+    def test_token_without_file(self):
+        self.assertIsNone(self.query.get_download_token(max_age=60))
+
+    def test_token_download_without_login(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('Just a test')
+            self.report.always_download = True
+            self.report.save()
+            url = self._get_token_url()
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b'Just a test')
+            headers = response
+            if hasattr(response, 'headers'):
+                headers = response.headers
+            self.assertEqual(headers['Content-Type'], 'text/csv')
+            self.assertEqual(headers['Content-Disposition'], 'attachment; filename=test.csv')
+
+    def test_token_download_content_length(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('Just a test')
+            self.query.file_size = 11
+            self.query.save()
+            self.report.always_download = True
+            self.report.save()
+            url = self._get_token_url()
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Length'], '11')
+
+    def test_token_download_without_queries(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('Just a test')
+            self.report.always_download = True
+            self.report.save()
+            url = self._get_token_url()
+            self.client.get(url)
+
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b'Just a test')
+
+    def test_token_redirection(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('File content')
+            url = self._get_token_url()
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response.url.endswith('test.csv'))
+
+    def test_token_expired(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('File content')
+            url = self._get_token_url(max_age=-1)
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 403)
+
+    def test_token_tampered(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('File content')
+            token = signing.dumps({'q': self.query.pk, 'r': self.report.name, 'p': '../secret'})
+
+            response = self.client.get('{}?token={}'.format(self.url, token))
+            self.assertEqual(response.status_code, 403)
+
+    def test_token_other_query(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self._save_example_report('File content')
+            token = self.query.get_download_token(max_age=60)
+            url = reverse('django_easy_report:report_download', kwargs={
+                'report_name': self.report.name,
+                'query_pk': self.query.pk + 1,
+            })
+
+            response = self.client.get('{}?token={}'.format(url, token))
+            self.assertEqual(response.status_code, 403)
@@ -0,0 +1,149 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.http import Http404
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+
+from django_easy_report import metrics
+from django_easy_report.constants import STATUS_DONE
+from django_easy_report.models import ReportQuery
+from django_easy_report.tasks import generate_report
+from django_easy_report.tests.test_report_generation import ReportBaseTestCase
+from django_easy_report.views import ReportMetrics
+
+
+@override_settings(REPORT_METRICS=True)
+class RegistryTestCase(TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_disabled(self):
+        with override_settings(REPORT_METRICS=False):
+            self.registry.inc(metrics.DOWNLOADS, report='test')
+            self.registry.observe(metrics.GENERATION_SECONDS, 1, report='test')
+        self.assertEqual(self.registry.snapshot(), {'counters': {}, 'histograms': {}})
+
+    def test_render_counter(self):
+        self.registry.inc(metrics.DOWNLOADS, report='test')
+        self.registry.inc(metrics.DOWNLOADS, 2, report='test')
+        self.registry.inc(metrics.DOWNLOADS, report='say "hi"\n')
+
+        content = metrics.render(self.registry.collect())
+
+        self.assertIn('# TYPE django_easy_report_downloads_total counter\n', content)
+        self.assertIn('django_easy_report_downloads_total{report="test"} 3.0\n', content)
+        self.assertIn('django_easy_report_downloads_total{report="say \\"hi\\"\\n"} 1.0\n', content)
+
+    def test_render_histogram(self):
+        for value in (0.1, 3, 3, 7200):
+            self.registry.observe(metrics.GENERATION_SECONDS, value, report='test')
+
+        content = metrics.render(self.registry.collect())
+
+        self.assertIn('django_easy_report_generation_seconds_bucket{report="test",le="0.5"} 1.0\n', content)
+        self.assertIn('django_easy_report_generation_seconds_bucket{report="test",le="5.0"} 3.0\n', content)
+        self.assertIn('django_easy_report_generation_seconds_bucket{report="test",le="3600.0"} 3.0\n', content)
+        self.assertIn('django_easy_report_generation_seconds_bucket{report="test",le="+Inf"} 4.0\n', content)
+        self.assertIn('django_easy_report_generation_seconds_sum{report="test"} 7206.1\n', content)
+        self.assertIn('django_easy_report_generation_seconds_count{report="test"} 4.0\n', content)
+
+    def test_render_gauges(self):
+        content = metrics.render(self.registry.collect(), gauges={
+            metrics.QUERIES: {metrics.label_key({'status': 'Done'}): 2},
+        })
+        self.assertIn('django_easy_report_queries{status="Done"} 2.0\n', content)
+
+    def test_multiprocess(self):
+        other = metrics.Registry()
+        with TemporaryDirectory() as tmp_dirname, \
+                override_settings(REPORT_METRICS_DIR=tmp_dirname, REPORT_METRICS_FLUSH_INTERVAL=0):
+            self.registry.inc(metrics.ROWS, 10, report='test')
+            self.registry.observe(metrics.GENERATION_SECONDS, 1, report='test')
+            with patch('os.getpid', return_value=-1):
+                other.inc(metrics.ROWS, 5, report='test')
+                other.observe(metrics.GENERATION_SECONDS, 2, report='test')
+            self.assertEqual(len(os.listdir(tmp_dirname)), 2)
+
+            collected = self.registry.collect()
+
+        key = metrics.label_key({'report': 'test'})
+        self.assertEqual(collected['counters'][metrics.ROWS], {key: 15})
+        histogram = collected['histograms'][metrics.GENERATION_SECONDS][key]
+        self.assertEqual(histogram['count'], 2)
+        self.assertEqual(histogram['sum'], 3)
+
+    def test_flush_throttled(self):
+        with TemporaryDirectory() as tmp_dirname, override_settings(REPORT_METRICS_DIR=tmp_dirname):
+            self.registry.inc(metrics.ROWS, 10, report='test')
+            with patch('tempfile.NamedTemporaryFile') as mock_file:
+                self.registry.inc(metrics.ROWS, 10, report='test')
+            self.assertFalse(mock_file.called)
+
+
+@override_settings(REPORT_METRICS=True)
+class MetricsFlowTestCase(ReportBaseTestCase):
+
+    def setUp(self):
+        super(MetricsFlowTestCase, self).setUp()
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.factory = RequestFactory()
+
+    def _get_metrics(self, **kwargs):
+        request = self.factory.get('/metrics/', **kwargs)
+        return ReportMetrics.as_view()(request)
+
+    def _counter(self, name, **labels):
+        return metrics.registry.snapshot()['counters'].get(name, {}).get(metrics.label_key(labels))
+
+    def test_view_disabled(self):
+        with override_settings(REPORT_METRICS=False):
+            with self.assertRaises(Http404):
+                self._get_metrics()
+
+    def test_view(self):
+        query = self._create_query({}, {})
+        query.status = STATUS_DONE
+        query.save()
+
+        response = self._get_metrics()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('django_easy_report_queries{status="Done"} 1.0\n', response.content.decode())
+
+    @override_settings(REPORT_METRICS_TOKEN='secret')
+    def test_view_token(self):
+        self.assertEqual(self._get_metrics().status_code, 401)
+        self.assertEqual(self._get_metrics(HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_generation(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+            generate_report(query.pk)
+        query.refresh_from_db()
+
+        self.assertEqual(self._counter(metrics.ROWS, report=self.report.name), query.rows)
+        self.assertEqual(self._counter(metrics.BYTES, report=self.report.name), query.file_size)
+        histogram = metrics.registry.snapshot()['histograms'][metrics.GENERATION_SECONDS]
+        self.assertEqual(histogram[metrics.label_key({'report': self.report.name})]['count'], 1)
+
+    @patch('django_easy_report.views.generate_report')
+    def test_requests(self, mock_generate):
+        user = User.objects.get(username='admin')
+        self.client.force_login(user=user)
+        url = reverse('django_easy_report:report_generator', kwargs={'report_name': self.report.name})
+
+        self.client.post(url, data={})
+        self.client.post(url, data={})
+        self.client.post(url + '?generate=true', data={})
+
+        self.assertEqual(self._counter(metrics.REQUESTS, report=self.report.name, result='miss'), 1)
+        self.assertEqual(self._counter(metrics.REQUESTS, report=self.report.name, result='hit'), 1)
+        self.assertEqual(self._counter(metrics.REQUESTS, report=self.report.name, result='forced'), 1)
+        self.assertEqual(ReportQuery.objects.count(), 2)
@@ -7,7 +7,8 @@ from tempfile import TemporaryDirectory
 from django.contrib.auth.models import User
 from django.test import TestCase
 
-from django_easy_report.models import ReportSender, ReportGenerator, ReportQuery
+from django_easy_report.choices import MODE_DJANGO_SETTINGS
+from django_easy_report.models import ReportSender, ReportGenerator, ReportQuery, SecretKey, SecretReplace
 from django_easy_report.reports import ReportModelGenerator
 
 
@@ -51,6 +52,73 @@ class ReportSenderTestCase(TestCase):
         self.assertEqual(error_context.exception.msg, 'Only Storage classes are allowed')
 
 
+class ReportSenderStoragePoolTestCase(TestCase):
+
+    def setUp(self):
+        self.sender = ReportSender.objects.create(
+            name='pooled storage',
+            storage_class_name='django.core.files.storage.FileSystemStorage',
+            storage_init_params='{"location": "test_storage"}',
+        )
+
+    def test_storage_shared_between_instances(self):
+        storage = self.sender.get_storage()
+        other = ReportSender.objects.get(pk=self.sender.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(other.get_storage(), storage)
+
+    def test_force_load(self):
+        storage = self.sender.get_storage()
+        other = ReportSender.objects.get(pk=self.sender.pk)
+        self.assertIsNot(other.get_storage(force_load=True), storage)
+
+    def test_invalidate_on_save(self):
+        storage = self.sender.get_storage()
+        self.sender.storage_init_params = '{"location": "other_storage"}'
+        self.sender.save()
+        other = ReportSender.objects.get(pk=self.sender.pk)
+        new_storage = other.get_storage()
+        self.assertIsNot(new_storage, storage)
+        self.assertIs(self.sender.get_storage(), new_storage)
+        self.assertTrue(new_storage.location.endswith('other_storage'))
+
+    def test_invalidate_on_secret_replace(self):
+        storage = self.sender.get_storage()
+        secret = SecretKey.objects.create(mode=MODE_DJANGO_SETTINGS, name='secret', value='SECRET_KEY')
+        SecretReplace.objects.create(secret=secret, sender=self.sender, replace_word='secret')
+        other = ReportSender.objects.get(pk=self.sender.pk)
+        self.assertIsNot(other.get_storage(), storage)
+
+    def test_secret_change_update_sender(self):
+        secret = SecretKey.objects.create(mode=MODE_DJANGO_SETTINGS, name='secret', value='SECRET_KEY')
+        SecretReplace.objects.create(secret=secret, sender=self.sender, replace_word='secret')
+        pooled = ReportSender.objects.get(pk=self.sender.pk)
+        storage = pooled.get_storage()
+
+        secret.value = 'OTHER_KEY'
+        secret.save()
+
+        other = ReportSender.objects.get(pk=self.sender.pk)
+        # Other processes pool by updated_at, they will not reuse the old storage
+        self.assertGreater(other.updated_at, pooled.updated_at)
+        self.assertIsNot(other.get_storage(), storage)
+
+        SecretReplace.objects.filter(sender=self.sender).get().delete()
+        self.assertGreater(ReportSender.objects.get(pk=self.sender.pk).updated_at, other.updated_at)
+
+    def test_get_pooled_storage(self):
+        storage = self.sender.get_storage()
+        with self.assertNumQueries(0):
+            pooled = ReportSender.get_pooled_storage(self.sender.pk, self.sender.updated_at)
+        self.assertIs(pooled, storage)
+        with self.assertNumQueries(1):
+            self.assertIs(ReportSender.get_pooled_storage(self.sender.pk, None), storage)
+
+    def test_get_pooled_storage_not_exist(self):
+        with self.assertRaises(ReportSender.DoesNotExist):
+            ReportSender.get_pooled_storage(-1, None)
+
+
 class ReportGeneratorTestCase(TestCase):
     def test_get_permissions_list_without_permission(self):
         self.assertEqual(ReportGenerator().get_permissions(), set())
@@ -1,11 +1,15 @@
+import datetime
 import json
 from unittest.mock import patch, call
 
-from django.contrib.auth.models import User
-from django.test import TestCase
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from django_easy_report.models import ReportGenerator, ReportQuery, ReportRequester
+from django_easy_report.constants import STATUS_CANCELED, STATUS_DONE, STATUS_WORKING
+from django_easy_report.models import ReportGenerator, ReportQuery, ReportRequester, ReportNotification
 
 
 class ReportSenderTestCase(TestCase):
@@ -131,6 +135,9 @@ class ReportSenderTestCase(TestCase):
         self.assertNotIn('created', body)
         self.assertIn('find', body)
         self.assertEqual(body.get('find'), query.pk)
+        self.assertEqual(body.get('progress'), {
+            'rows': None, 'total_rows': None, 'bytes_written': None, 'percent': None, 'eta': None,
+        })
 
     @patch('django_easy_report.views.generate_report')
     def test_request_exists_report_force_generate(self, mock_generator):
@@ -180,3 +187,105 @@ class ReportSenderTestCase(TestCase):
         self.assertTrue(ReportRequester.objects.filter(pk=body.get('accepted')).exists())
         self.assertTrue(mock_notify.delay.called)
         self.assertTrue(mock_notify.delay.call_args, call(body.get('accepted')))
+
+    @override_settings(REPORT_NOTIFICATION_OUTBOX=True)
+    @patch('django_easy_report.views.notify_report_done')
+    def test_notify_report_with_outbox(self, mock_notify):
+        query = ReportQuery.objects.create(
+            filename='report.csv',
+            params_hash=ReportQuery.gen_hash(None),
+            report=self.report
+        )
+        self.login()
+        response = self.client.post(self.url + '?notify={}'.format(query.pk), data={})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(mock_notify.delay.called)
+        requester = ReportRequester.objects.get()
+        self.assertTrue(ReportNotification.objects.filter(requester=requester).exists())
+
+    @patch('django_easy_report.views.generate_report')
+    def test_request_exists_report_canceled(self, mock_generator):
+        ReportQuery.objects.create(
+            filename='report.csv',
+            params_hash=ReportQuery.gen_hash(None),
+            report=self.report,
+            status=STATUS_CANCELED,
+        )
+        self.login()
+        response = self.client.post(self.url, data={})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(mock_generator.delay.called)
+
+    @patch('django_easy_report.views.generate_report')
+    def test_request_exists_report_stale(self, mock_generator):
+        query = ReportQuery.objects.create(
+            filename='report.csv',
+            params_hash=ReportQuery.gen_hash(None),
+            report=self.report,
+            status=STATUS_WORKING,
+        )
+        ReportQuery.objects.filter(pk=query.pk).update(heartbeat_at=timezone.now() - datetime.timedelta(hours=1))
+        self.login()
+        response = self.client.post(self.url, data={})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(mock_generator.delay.called)
+
+
+class CancelReportTestCase(TestCase):
+    fixtures = ['basic_data.json']
+
+    def setUp(self):
+        self.report = ReportGenerator.objects.get(name='User_report')
+        self.user = User.objects.create_user('user', 'user@localhost', 'user')
+        self.user.user_permissions.add(Permission.objects.get(content_type__app_label='auth', codename='view_user'))
+        self.query = ReportQuery.objects.create(
+            filename='report.csv',
+            params_hash=ReportQuery.gen_hash(None),
+            report=self.report,
+            status=STATUS_WORKING,
+        )
+        ReportRequester.objects.create(query=self.query, user=self.user)
+        self.url = reverse('django_easy_report:report_cancel', kwargs={
+            'report_name': 'User_report',
+            'query_pk': self.query.pk,
+        })
+        self.client.force_login(user=self.user)
+        self.addCleanup(cache.clear)
+
+    def test_cancel(self):
+        response = self.client.post(self.url)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {'canceled': self.query.pk})
+        self.query.refresh_from_db()
+        self.assertEqual(self.query.status, STATUS_CANCELED)
+        self.assertTrue(self.query.is_canceled())
+
+    def test_cancel_finished(self):
+        self.query.status = STATUS_DONE
+        self.query.save()
+
+        response = self.client.post(self.url)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['status'], {'code': STATUS_DONE, 'name': 'Done'})
+        self.assertFalse(self.query.is_canceled())
+
+    def test_cancel_other_user_report(self):
+        other = User.objects.create_user('other', 'other@localhost', 'other')
+        other.user_permissions.add(*self.user.user_permissions.all())
+        self.client.force_login(user=other)
+
+        response = self.client.post(self.url)
+
+        self.assertEqual(response.status_code, 403)
+        self.query.refresh_from_db()
+        self.assertEqual(self.query.status, STATUS_WORKING)
+
+    def test_cancel_unknown_query(self):
+        url = reverse('django_easy_report:report_cancel', kwargs={'report_name': 'User_report', 'query_pk': 0})
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 404)
@@ -1,15 +1,33 @@
+import datetime
+import hashlib
 import json
 import os
-from io import StringIO
+import time
+import zipfile
+from email.mime.base import MIMEBase
+from io import BytesIO, StringIO
 from tempfile import TemporaryDirectory
-from unittest.mock import patch, call
+from unittest.mock import Mock, patch, call
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.mail import get_connection
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from django_easy_report.constants import STATUS_CREATED, STATUS_DONE, STATUS_ERROR
-from django_easy_report.models import ReportGenerator, ReportQuery, ReportRequester
-from django_easy_report.tasks import generate_report, notify_report_done
+from django_easy_report.constants import STATUS_CREATED, STATUS_DONE, STATUS_ERROR, STATUS_CANCELED, STATUS_WORKING, \
+    TIMING_OPTIONS, TIMING_QUERY, TIMING_RENDER, TIMING_GENERATE
+from django_easy_report.exceptions import ReportCanceled
+from django_easy_report.reports import ReportModelGenerator
+from django_easy_report.models import ReportGenerator, ReportQuery, ReportRequester, ReportNotification, \
+    ReportDigestEntry, ReportTiming
+from django_easy_report.tasks import generate_report, notify_report_done, notify_requesters, dispatch_notifications, \
+    send_digests, reap_reports, KeepAlive
 
 
 class ReportBaseTestCase(TestCase):
@@ -45,6 +63,24 @@ class ReportBaseTestCase(TestCase):
         sender.save()
         return sender
 
+    def _save_example_report(self, query, content=None, size=0, filename=None, mimetype=None):
+        storage = self.report.sender.get_storage()
+        buffer = StringIO()
+        if content:
+            buffer.write(content)
+        elif size:
+            buffer.write('A' * size)
+        buffer.seek(0)
+        if filename:
+            query.filename = filename
+        else:
+            query.filename = 'test.csv'
+        if mimetype:
+            query.mimetype = mimetype
+        query.storage_path_location = storage.save(query.filename, buffer)
+        query.status = STATUS_DONE
+        query.save()
+
 
 class ReportGenerateTestCase(ReportBaseTestCase):
 
@@ -70,6 +106,111 @@ class ReportGenerateTestCase(ReportBaseTestCase):
             requester = query.reportrequester_set.get()
             self.assertTrue(mock_notify.delay.call_args, call(requester.pk))
 
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_generate_report_file_info(self, mock_notify):
+        get_user_model().objects.create_user('user', 'user@localhost', '$3Cre7')
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+
+            generate_report(query.pk)
+            query.refresh_from_db()
+
+            local_path = os.path.join(tmp_dirname, query.storage_path_location)
+            with open(local_path, 'rb') as local_file:
+                content = local_file.read()
+            self.assertEqual(query.file_size, len(content))
+            self.assertEqual(query.checksum, hashlib.sha256(content).hexdigest())
+            self.assertEqual(query.rows, 2)
+            self.assertEqual(query.get_file_size(), len(content))
+
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_generate_report_seekable_buffer(self, mock_notify):
+        def generate(buffer, tmp_dir):
+            self.assertTrue(buffer.name.startswith(tmp_dir))
+            buffer.write('rows: ?\nuser\n')
+            self.assertTrue(buffer.seekable())
+            buffer.seek(0)
+            buffer.write('rows: 1')
+
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+
+            with patch.object(ReportModelGenerator, 'generate', side_effect=generate):
+                generate_report(query.pk)
+            query.refresh_from_db()
+
+            with open(os.path.join(tmp_dirname, query.storage_path_location), 'rb') as local_file:
+                content = local_file.read()
+            self.assertEqual(content, b'rows: 1\nuser\n')
+            self.assertEqual(query.file_size, len(content))
+            self.assertEqual(query.checksum, hashlib.sha256(content).hexdigest())
+
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_generate_report_content_addressed(self, mock_notify):
+        self.report.content_addressed = True
+        self.report.save()
+        with TemporaryDirectory() as tmp_dirname:
+            sender = self._setup_sender(tmp_dirname)
+            query1 = self._create_query({}, {})
+            query2 = self._create_query({'other': 'params'}, {})
+
+            generate_report(query1.pk)
+            with patch('django.core.files.storage.FileSystemStorage.save') as mock_save:
+                generate_report(query2.pk)
+                self.assertFalse(mock_save.called)
+            query1.refresh_from_db()
+            query2.refresh_from_db()
+
+            self.assertEqual(query1.checksum, query2.checksum)
+            self.assertEqual(query1.storage_path_location, query2.storage_path_location)
+            self.assertEqual(
+                query1.storage_path_location,
+                os.path.join('sha256', query1.checksum[:2], query1.checksum + '.csv')
+            )
+            storage = sender.get_storage()
+            self.assertTrue(storage.exists(query1.storage_path_location))
+
+            query1.delete()
+            self.assertTrue(storage.exists(query2.storage_path_location))
+            query2.delete()
+            self.assertFalse(storage.exists(query2.storage_path_location))
+
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_generate_report_content_addressed_bulk_delete(self, mock_notify):
+        self.report.content_addressed = True
+        self.report.save()
+        with TemporaryDirectory() as tmp_dirname:
+            sender = self._setup_sender(tmp_dirname)
+            query1 = self._create_query({}, {})
+            query2 = self._create_query({'other': 'params'}, {})
+            generate_report(query1.pk)
+            generate_report(query2.pk)
+            query1.refresh_from_db()
+
+            ReportQuery.objects.all().delete()
+            self.assertFalse(sender.get_storage().exists(query1.storage_path_location))
+
+    @override_settings(REPORT_NOTIFY_CHUNK_SIZE=2)
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_notify_requesters_in_chunks(self, mock_notify):
+        query = self._create_query({}, {})
+        for _ in range(4):
+            ReportRequester.objects.create(query=query, user=self.user, user_params=json.dumps({}))
+        ReportRequester.objects.create(query=query, user=self.user, notified=True)
+        requester_pks = list(query.reportrequester_set.filter(notified=False).order_by('pk').values_list(
+            'pk', flat=True
+        ))
+
+        notify_requesters(query.pk)
+
+        self.assertEqual(mock_notify.delay.call_args_list, [
+            call(requester_pks[:2]),
+            call(requester_pks[2:4]),
+            call(requester_pks[4:]),
+        ])
+
     @patch('django_easy_report.tasks.notify_report_done')
     def test_generate_report_failing(self, mock_notify):
         self.report.class_name = 'class.not_exists'
@@ -110,24 +251,6 @@ class ReportGenerateTestCase(ReportBaseTestCase):
 
 class ReportNotifiedTestCase(ReportBaseTestCase):
 
-    def _save_example_report(self, query, content=None, size=0, filename=None, mimetype=None):
-        storage = self.report.sender.get_storage()
-        buffer = StringIO()
-        if content:
-            buffer.write(content)
-        elif size:
-            buffer.write('A' * size)
-        buffer.seek(0)
-        if filename:
-            query.filename = filename
-        else:
-            query.filename = 'test.csv'
-        if mimetype:
-            query.mimetype = mimetype
-        query.storage_path_location = storage.save(query.filename, buffer)
-        query.status = STATUS_DONE
-        query.save()
-
     @patch('django_easy_report.tasks.EmailMessage')
     def test_send_with_attachment(self, email_msg_mock):
         with TemporaryDirectory() as tmp_dirname:
@@ -175,6 +298,64 @@ class ReportNotifiedTestCase(ReportBaseTestCase):
             self.assertFalse(email_cls.attach.called)
             self.assertTrue(email_cls.send.called)
 
+    @patch('django_easy_report.tasks.EmailMessage')
+    def test_send_attachment_not_available(self, email_msg_mock):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+            self._save_example_report(query, 'File content', filename='report.txt')
+            requester = query.reportrequester_set.get()
+
+            with patch.object(ReportQuery, 'get_attachment', return_value=None):
+                notify_report_done([requester.pk])
+
+            subject, body, email_from, email_to = email_msg_mock.call_args[0]
+            self.assertTrue(body.startswith('Report completed. Download from'))
+            self.assertFalse(email_msg_mock.return_value.attach.called)
+
+    @patch('django_easy_report.tasks.EmailMessage')
+    def test_send_with_persisted_size(self, email_msg_mock):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+            self._save_example_report(query, 'File content', filename='report.txt')
+            query.file_size = 12
+            query.checksum = hashlib.sha256(b'File content').hexdigest()
+            query.save()
+            request = ReportRequester.objects.create(
+                query=query,
+                user=self.user,
+                user_params=json.dumps({}),
+            )
+
+            with patch('django.core.files.storage.FileSystemStorage.size') as mock_size, \
+                    patch('django.core.files.storage.FileSystemStorage.exists') as mock_exists:
+                notify_report_done([request.id])
+                self.assertFalse(mock_size.called)
+                self.assertFalse(mock_exists.called)
+
+            email_cls = email_msg_mock.return_value
+            self.assertTrue(email_cls.attach.called)
+
+    @override_settings(REPORT_DOWNLOAD_TOKEN_MAX_AGE=60)
+    @patch('django_easy_report.tasks.EmailMessage')
+    def test_send_download_token_link(self, email_msg_mock):
+        with TemporaryDirectory() as tmp_dirname:
+            sender = self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+            self._save_example_report(query, size=sender.size_to_attach, filename='report.dat')
+            request = ReportRequester.objects.create(
+                query=query,
+                user=self.user,
+                user_params=json.dumps({'domain': 'localhost:8000', 'protocol': 'https'}),
+            )
+
+            notify_report_done([request.id])
+
+            subject, body, email_from, email_to = email_msg_mock.call_args[0]
+            url = 'https://localhost:8000/reports/{}/{}/?token='.format(self.report.name, query.pk)
+            self.assertIn('<a href="{}'.format(url), body)
+
     @patch('django_easy_report.tasks.EmailMessage')
     def test_fail_send_message(self, email_msg_mock):
         with TemporaryDirectory() as tmp_dirname:
@@ -195,6 +376,185 @@ class ReportNotifiedTestCase(ReportBaseTestCase):
             self.assertFalse(request.notified)
             self.assertTrue(email_msg_mock.called)
 
+    def test_send_shared_attachment(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+            self._save_example_report(query, 'File content', filename='report.txt', mimetype='text/plain')
+            ReportRequester.objects.create(query=query, user=self.user, user_params=json.dumps({}))
+
+            notify_report_done(list(query.reportrequester_set.values_list('pk', flat=True)))
+
+            self.assertEqual(len(mail.outbox), 2)
+            attachment = mail.outbox[0].attachments[0]
+            self.assertIs(attachment, mail.outbox[1].attachments[0])
+            self.assertEqual(attachment.get_content_type(), 'text/plain')
+            self.assertEqual(attachment.get_filename(), 'report.txt')
+            self.assertEqual(attachment.get_payload(decode=True), b'File content')
+            self.assertIn(b'RmlsZSBjb250ZW50', mail.outbox[1].message().as_bytes())
+
+    def test_get_attachment_chunks(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+            content = ''.join(chr(ord('a') + i % 26) for i in range(200 * 1024))
+            self._save_example_report(query, content)
+
+            # Chunks not aligned with the base64 lines
+            with patch('django.core.files.base.File.DEFAULT_CHUNK_SIZE', 1000):
+                attachment = query.get_attachment()
+
+            self.assertEqual(attachment.get_payload(decode=True), content.encode())
+            lines = attachment.get_payload().splitlines()
+            self.assertTrue(all(len(line) == 76 for line in lines[:-1]))
+
+    def test_get_attachment_without_file(self):
+        query = self._create_query({}, {})
+        self.assertIsNone(query.get_attachment())
+
+    def _save_compressible_report(self, tmp_dirname, content):
+        sender = self._setup_sender(tmp_dirname)
+        sender.compress_attachment = True
+        sender.size_to_attach = 1000
+        sender.save()
+        query = self._create_query({}, {})
+        self._save_example_report(query, content, filename='report.csv')
+        query.file_size = len(content)
+        query.checksum = hashlib.sha256(content.encode()).hexdigest()
+        query.save()
+        return query
+
+    def test_send_compressed_attachment(self):
+        with TemporaryDirectory() as tmp_dirname:
+            content = 'A' * 5000
+            query = self._save_compressible_report(tmp_dirname, content)
+            requester = query.reportrequester_set.get()
+
+            notify_report_done([requester.pk])
+
+            zip_path = os.path.join(tmp_dirname, 'zip', query.checksum[:2], query.checksum + '.zip')
+            self.assertTrue(os.path.isfile(zip_path))
+            self.assertEqual(len(mail.outbox), 1)
+            attachment = mail.outbox[0].attachments[0]
+            self.assertEqual(attachment.get_content_type(), 'application/zip')
+            self.assertEqual(attachment.get_filename(), 'report.zip')
+            with zipfile.ZipFile(BytesIO(attachment.get_payload(decode=True))) as archive:
+                self.assertEqual(archive.read('report.csv'), content.encode())
+            self.assertIn('See attachments', mail.outbox[0].body)
+
+            # Compressed only once
+            requester = ReportRequester.objects.create(query=query, user=self.user)
+            with patch('django_easy_report.models.zipfile.ZipFile') as mock_zip:
+                notify_report_done([requester.pk])
+            self.assertFalse(mock_zip.called)
+            self.assertEqual(mail.outbox[1].attachments[0].get_filename(), 'report.zip')
+
+            query.delete()
+            self.assertFalse(os.path.isfile(zip_path))
+
+    def test_send_compressed_too_big(self):
+        with TemporaryDirectory() as tmp_dirname:
+            content = ''.join(hashlib.sha512(str(pos).encode()).hexdigest() for pos in range(20))
+            query = self._save_compressible_report(tmp_dirname, content)
+
+            notify_report_done([query.reportrequester_set.get().pk])
+
+            self.assertEqual(len(mail.outbox), 1)
+            self.assertEqual(mail.outbox[0].attachments, [])
+            self.assertIn('Download from', mail.outbox[0].body)
+
+    @override_settings(REPORT_COMPRESS_MAX_RATIO=4)
+    def test_send_compressed_over_max_ratio(self):
+        with TemporaryDirectory() as tmp_dirname:
+            query = self._save_compressible_report(tmp_dirname, 'A' * 5000)
+
+            notify_report_done([query.reportrequester_set.get().pk])
+
+            self.assertEqual(mail.outbox[0].attachments, [])
+            self.assertFalse(os.path.exists(os.path.join(tmp_dirname, 'zip')))
+
+    def test_send_without_compress_attachment(self):
+        with TemporaryDirectory() as tmp_dirname:
+            query = self._save_compressible_report(tmp_dirname, 'A' * 5000)
+            sender = query.report.sender
+            sender.compress_attachment = False
+            sender.save()
+
+            notify_report_done([query.reportrequester_set.get().pk])
+
+            self.assertEqual(mail.outbox[0].attachments, [])
+            self.assertFalse(os.path.exists(os.path.join(tmp_dirname, 'zip')))
+
+    def _count_notify_queries(self, num_requesters):
+        query = self._create_query({}, {})
+        self._save_example_report(query, size=self.report.sender.size_to_attach)
+        for pos in range(num_requesters - 1):
+            username = 'user{}_{}'.format(num_requesters, pos)
+            user = get_user_model().objects.create_user(username, '{}@localhost'.format(username))
+            ReportRequester.objects.create(query=query, user=user, user_params=json.dumps({}))
+        requester_pks = list(query.reportrequester_set.values_list('pk', flat=True))
+        with CaptureQueriesContext(connection) as context:
+            notify_report_done(requester_pks)
+        self.assertEqual(len(mail.outbox), num_requesters)
+        mail.outbox = []
+        ReportQuery.objects.all().delete()
+        return len(context.captured_queries)
+
+    def test_notify_queries_do_not_depend_on_requesters(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            self.report.sender.get_storage()
+            one_requester = self._count_notify_queries(2)
+            many_requesters = self._count_notify_queries(20)
+        self.assertEqual(one_requester, many_requesters)
+
+    def _create_error_requesters(self, count):
+        query = self._create_query({}, {})
+        query.status = STATUS_ERROR
+        query.save()
+        for _ in range(count - 1):
+            ReportRequester.objects.create(query=query, user=self.user, user_params=json.dumps({}))
+        return list(query.reportrequester_set.values_list('pk', flat=True))
+
+    @override_settings(REPORT_EMAIL_BATCH_SIZE=2)
+    def test_send_shared_connection(self):
+        requester_pks = self._create_error_requesters(3)
+
+        with patch('django_easy_report.tasks.get_connection', wraps=get_connection) as mock_connection, \
+                patch('django.core.mail.backends.locmem.EmailBackend.open') as mock_open:
+            notify_report_done(requester_pks)
+            self.assertEqual(mock_connection.call_count, 1)
+            self.assertEqual(mock_open.call_count, 2)
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(ReportRequester.objects.filter(pk__in=requester_pks, notified=True).count(), 3)
+
+    def test_send_connection_failing(self):
+        requester_pks = self._create_error_requesters(2)
+
+        with patch('django.core.mail.backends.locmem.EmailBackend.open') as mock_open:
+            mock_open.side_effect = RuntimeError('Test it')
+            notify_report_done(requester_pks)
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(ReportRequester.objects.filter(pk__in=requester_pks, notified=False).count(), 2)
+
+    def test_send_one_recipient_failing(self):
+        requester_pks = self._create_error_requesters(3)
+        send = mail.EmailMessage.send
+
+        def fail_first(message, *args, **kwargs):
+            if not hasattr(fail_first, 'failed'):
+                fail_first.failed = True
+                raise RuntimeError('Test it')
+            return send(message, *args, **kwargs)
+
+        with patch('django.core.mail.EmailMessage.send', autospec=True, side_effect=fail_first):
+            notify_report_done(requester_pks)
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(ReportRequester.objects.filter(pk__in=requester_pks, notified=False).count(), 1)
+
     @patch('django_easy_report.tasks.EmailMessage')
     def test_send_error_report(self, email_msg_mock):
         query = self._create_query({}, {})
@@ -244,6 +604,16 @@ class ReportNotifiedTestCase(ReportBaseTestCase):
         subject, body, email_from, email_to = email_msg_mock.call_args[0]
         self.assertEqual(body, 'Invalid status (Created)')
 
+    @patch('django_easy_report.tasks.EmailMessage')
+    def test_skip_notified(self, email_msg_mock):
+        query = self._create_query({}, {})
+        query.status = STATUS_ERROR
+        query.save()
+        requester = ReportRequester.objects.create(query=query, user=self.user, notified=True)
+
+        notify_report_done([requester.pk])
+        self.assertFalse(email_msg_mock.called)
+
     @patch('django_easy_report.tasks.EmailMessage')
     def test_without_elements(self, email_msg_mock):
         notify_report_done([])
@@ -269,3 +639,713 @@ class ReportNotifiedTestCase(ReportBaseTestCase):
         self.assertGreaterEqual(len(error_context.exception.args), 1)
         message = error_context.exception.args[0]
         self.assertTrue(message.startswith('All requesters must be from the same query'))
+
+
+@override_settings(REPORT_NOTIFICATION_OUTBOX=True)
+class ReportNotificationOutboxTestCase(ReportBaseTestCase):
+
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_generate_report_add_to_outbox(self, mock_notify):
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            query = self._create_query({}, {})
+            ReportRequester.objects.create(query=query, user=self.user, notified=True)
+
+            generate_report(query.pk)
+
+            self.assertFalse(mock_notify.delay.called)
+            requester = query.reportrequester_set.get(notified=False)
+            self.assertEqual(list(ReportNotification.objects.values_list('requester_id', flat=True)), [requester.pk])
+
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_generate_report_failing_add_to_outbox(self, mock_notify):
+        self.report.class_name = 'class.not_exists'
+        self.report.save()
+        query = self._create_query({}, {})
+
+        with self.assertRaises(ImportError):
+            generate_report(query.pk)
+
+        self.assertFalse(mock_notify.delay.called)
+        self.assertEqual(ReportNotification.objects.count(), 1)
+
+    @override_settings(REPORT_NOTIFY_CHUNK_SIZE=2)
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_dispatch_grouped_by_query(self, mock_notify):
+        query1 = self._create_query({}, {})
+        query2 = self._create_query({'other': 'params'}, {})
+        for _ in range(2):
+            ReportRequester.objects.create(query=query1, user=self.user)
+        ReportNotification.objects.add_pending(query1.pk)
+        ReportNotification.objects.add_pending(query2.pk)
+        query1_pks = list(query1.reportrequester_set.order_by('pk').values_list('pk', flat=True))
+        query2_pks = list(query2.reportrequester_set.values_list('pk', flat=True))
+
+        self.assertEqual(dispatch_notifications(), 4)
+
+        self.assertEqual(mock_notify.delay.call_args_list, [
+            call(query1_pks[:2]),
+            call(query1_pks[2:]),
+            call(query2_pks),
+        ])
+        self.assertFalse(ReportNotification.objects.exists())
+        self.assertEqual(dispatch_notifications(), 0)
+
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_dispatch_batch_size(self, mock_notify):
+        query = self._create_query({}, {})
+        ReportRequester.objects.create(query=query, user=self.user)
+        ReportNotification.objects.add_pending(query.pk)
+
+        self.assertEqual(dispatch_notifications(batch_size=1), 1)
+        self.assertEqual(ReportNotification.objects.count(), 1)
+
+    @patch('django_easy_report.tasks.notify_report_done')
+    def test_dispatch_broker_failing(self, mock_notify):
+        mock_notify.delay.side_effect = RuntimeError('Broker down')
+        query = self._create_query({}, {})
+        ReportNotification.objects.add_pending(query.pk)
+
+        with self.assertRaises(RuntimeError):
+            dispatch_notifications()
+        self.assertEqual(ReportNotification.objects.count(), 1)
+
+
+class ReportDigestTestCase(ReportBaseTestCase):
+
+    def _notify_done_reports(self, tmp_dirname, count, size=10):
+        sender = self._setup_sender(tmp_dirname)
+        sender.digest_window = 60
+        sender.save()
+        requesters = []
+        for pos in range(count):
+            query = self._create_query({'pos': pos}, {})
+            self._save_example_report(query, size=size, filename='report{}.csv'.format(pos))
+            requester = query.reportrequester_set.get()
+            notify_report_done([requester.pk])
+            requesters.append(requester)
+        return sender, requesters
+
+    def test_collect_on_digest(self):
+        with TemporaryDirectory() as tmp_dirname:
+            sender, requesters = self._notify_done_reports(tmp_dirname, 3)
+
+            self.assertEqual(len(mail.outbox), 0)
+            self.assertEqual(ReportDigestEntry.objects.filter(sender=sender, email='admin@localhost').count(), 3)
+            self.assertFalse(ReportRequester.objects.filter(notified=False).exists())
+            self.assertEqual(send_digests(), 0)
+            self.assertEqual(len(mail.outbox), 0)
+
+    def test_send_digest_after_window(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._notify_done_reports(tmp_dirname, 3)
+            ReportDigestEntry.objects.update(created_at=timezone.now() - datetime.timedelta(seconds=61))
+
+            self.assertEqual(send_digests(), 1)
+
+            self.assertEqual(len(mail.outbox), 1)
+            message = mail.outbox[0]
+            self.assertEqual(message.to, ['admin@localhost'])
+            self.assertEqual(message.from_email, 'no-reply@localhost')
+            self.assertEqual(message.subject, '3 reports completed')
+            self.assertEqual(message.body.count('Report completed.'), 3)
+            # Attached while they fit together on size_to_attach
+            self.assertEqual([item.get_filename() for item in message.attachments], [
+                'report0.csv', 'report1.csv', 'report2.csv'
+            ])
+            self.assertFalse(ReportDigestEntry.objects.exists())
+            self.assertEqual(send_digests(), 0)
+
+    def test_send_digest_attachments_size(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._notify_done_reports(tmp_dirname, 3, size=40)
+            ReportDigestEntry.objects.update(created_at=timezone.now() - datetime.timedelta(seconds=61))
+
+            self.assertEqual(send_digests(), 1)
+
+            message = mail.outbox[0]
+            self.assertEqual(len(message.attachments), 2)
+            self.assertEqual(message.body.count('See attachments'), 2)
+            self.assertEqual(message.body.count('Download from'), 1)
+
+    def test_send_digest_max_items(self):
+        with TemporaryDirectory() as tmp_dirname:
+            sender = self._setup_sender(tmp_dirname)
+            sender.digest_max_items = 2
+            sender.save()
+            self._notify_done_reports(tmp_dirname, 3)
+
+            self.assertEqual(len(mail.outbox), 1)
+            self.assertEqual(mail.outbox[0].subject, '2 reports completed')
+            self.assertEqual(ReportDigestEntry.objects.count(), 1)
+
+    def test_send_digest_failing(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._notify_done_reports(tmp_dirname, 2)
+            other = get_user_model().objects.create_user('other', 'other@localhost', 'other')
+            query = self._create_query({'other': True}, {})
+            self._save_example_report(query, size=10)
+            ReportRequester.objects.filter(query=query).update(user=other)
+            notify_report_done(list(query.reportrequester_set.values_list('pk', flat=True)))
+            ReportDigestEntry.objects.update(created_at=timezone.now() - datetime.timedelta(seconds=61))
+
+            with patch('django_easy_report.tasks.EmailMessage.send', side_effect=[ConnectionError('SMTP down'), 1]):
+                # The other digests are sent
+                self.assertEqual(send_digests(), 1)
+            # Only the entries of the failing digest are kept
+            emails = list(ReportDigestEntry.objects.values_list('email', flat=True))
+            self.assertEqual(len(emails), {'admin@localhost': 2, 'other@localhost': 1}[emails[0]])
+            self.assertEqual(len(set(emails)), 1)
+
+    def test_send_digest_attachment_not_available(self):
+        with TemporaryDirectory() as tmp_dirname:
+            self._notify_done_reports(tmp_dirname, 2)
+            ReportDigestEntry.objects.update(created_at=timezone.now() - datetime.timedelta(seconds=61))
+
+            with patch.object(ReportQuery, 'get_attachment', side_effect=[None, self._attachment()]):
+                self.assertEqual(send_digests(), 1)
+
+            message = mail.outbox[0]
+            self.assertEqual(len(message.attachments), 1)
+            self.assertEqual(message.body.count('See attachments'), 1)
+            self.assertEqual(message.body.count('Download from'), 1)
+            self.assertFalse(ReportDigestEntry.objects.exists())
+
+    def _attachment(self):
+        attachment = MIMEBase('text', 'csv')
+        attachment.set_payload('report')
+        return attachment
+
+
+class ReportCancelTestCase(ReportBaseTestCase):
+
+    def setUp(self):
+        super(ReportCancelTestCase, self).setUp()
+        self.addCleanup(cache.clear)
+        self.tmp_dir = TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self._setup_sender(self.tmp_dir.name)
+        for pos in range(5):
+            get_user_model().objects.create_user('user{}'.format(pos), 'user{}@localhost'.format(pos), 'user')
+
+    @override_settings(REPORT_CHECK_POINT_ROWS=2)
+    def test_cancel_generating(self):
+        query = self._create_query({}, {})
+        calls = []
+
+        def cancel_on_second_check(report_model):
+            calls.append(report_model.pk)
+            if len(calls) == 2:
+                self.assertTrue(report_model.cancel())
+            return report_model.status == STATUS_CANCELED
+
+        with patch.object(ReportQuery, 'is_canceled', autospec=True, side_effect=cancel_on_second_check):
+            generate_report(query.pk)
+
+        self.assertEqual(len(calls), 2)
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_CANCELED)
+        self.assertIsNone(query.storage_path_location)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Report canceled', mail.outbox[0].body)
+
+    def test_cancel_queued(self):
+        query = self._create_query({}, {})
+        self.assertTrue(query.cancel())
+
+        with patch('django_easy_report.reports.ReportModelGenerator.generate') as mock_generate:
+            generate_report(query.pk)
+
+        self.assertFalse(mock_generate.called)
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_CANCELED)
+
+    def test_cancel_before_start(self):
+        query = self._create_query({}, {})
+        original_get = ReportQuery.objects.get
+
+        def get_and_cancel(*args, **kwargs):
+            # Canceled by other process, without shared cancel cache
+            read = original_get(*args, **kwargs)
+            ReportQuery.objects.filter(pk=read.pk).update(status=STATUS_CANCELED)
+            return read
+
+        with patch.object(ReportQuery.objects, 'get', side_effect=get_and_cancel), \
+                patch('django_easy_report.reports.ReportModelGenerator.generate') as mock_generate:
+            generate_report(query.pk)
+
+        self.assertFalse(mock_generate.called)
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_CANCELED)
+        self.assertEqual(query.attempts, 0)
+
+    def test_generate_not_pending(self):
+        query = self._create_query({}, {})
+        ReportQuery.objects.filter(pk=query.pk).update(status=STATUS_WORKING, attempts=1)
+
+        with patch('django_easy_report.reports.ReportModelGenerator.generate') as mock_generate:
+            generate_report(query.pk)
+
+        self.assertFalse(mock_generate.called)
+        query.refresh_from_db()
+        self.assertEqual((query.status, query.attempts), (STATUS_WORKING, 1))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_cancel_finished(self):
+        query = self._create_query({}, {})
+        query.status = STATUS_DONE
+        query.save()
+
+        self.assertFalse(query.cancel())
+        self.assertFalse(query.is_canceled())
+
+    @override_settings(REPORT_CHECK_POINT_ROWS=1)
+    def test_check_point_uses_cached_flag(self):
+        query = self._create_query({}, {})
+        query.cancel()
+        report = query.get_report()
+        with self.assertNumQueries(0):
+            with self.assertRaises(ReportCanceled):
+                report.row_written()
+
+
+class ReportHeartbeatTestCase(ReportBaseTestCase):
+
+    def setUp(self):
+        super(ReportHeartbeatTestCase, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self._setup_sender(self.tmp_dir.name)
+        for pos in range(5):
+            get_user_model().objects.create_user('user{}'.format(pos), 'user{}@localhost'.format(pos), 'user')
+
+    def _create_stale_query(self, attempts=1, minutes=30):
+        query = self._create_query({}, {})
+        ReportQuery.objects.filter(pk=query.pk).update(
+            status=STATUS_WORKING, attempts=attempts,
+            heartbeat_at=timezone.now() - datetime.timedelta(minutes=minutes)
+        )
+        return query
+
+    @override_settings(REPORT_CHECK_POINT_ROWS=1, REPORT_HEARTBEAT_INTERVAL=0)
+    def test_heartbeat_while_generating(self):
+        query = self._create_query({}, {})
+        heartbeats = []
+        original = ReportQuery.heartbeat
+
+        def heartbeat(report_model, rows=None, **kwargs):
+            heartbeats.append(rows)
+            return original(report_model, rows, **kwargs)
+
+        with patch.object(ReportQuery, 'heartbeat', autospec=True, side_effect=heartbeat):
+            generate_report(query.pk)
+        self.assertEqual(heartbeats, [1, 2, 3, 4, 5, 6])  # one per user
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_DONE)
+        self.assertEqual(query.attempts, 1)
+        self.assertIsNotNone(query.heartbeat_at)
+
+    @override_settings(REPORT_KEEP_ALIVE_INTERVAL=0.01)
+    def test_keep_alive_without_check_points(self):
+        query = self._create_query({}, {})
+
+        def generate(buffer, tmp_dir):
+            # For example waiting the first fetch, without rows
+            time.sleep(0.2)
+
+        with patch.object(ReportModelGenerator, 'generate', side_effect=generate), \
+                patch.object(ReportQuery, 'update_progress', return_value=True) as mock_update:
+            generate_report(query.pk)
+
+        self.assertTrue(mock_update.called)
+        self.assertEqual(mock_update.call_args, call())
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_DONE)
+
+    def test_keep_alive_stop_when_lost(self):
+        query = Mock(pk=1)
+        query.update_progress.return_value = False
+        with KeepAlive(query, 0.01) as keep_alive:
+            keep_alive.join(timeout=5)
+        self.assertTrue(keep_alive.lost)
+        self.assertEqual(query.update_progress.call_count, 1)
+
+    def test_keep_alive_disabled(self):
+        with KeepAlive(Mock(pk=1), 0) as keep_alive:
+            self.assertFalse(keep_alive.is_alive())
+
+    def test_heartbeat_only_while_working(self):
+        query = self._create_query({}, {})
+        self.assertFalse(query.heartbeat(10))
+
+        ReportQuery.objects.filter(pk=query.pk).update(status=STATUS_WORKING)
+        self.assertTrue(query.heartbeat(10))
+        query.refresh_from_db()
+        self.assertEqual(query.rows, 10)
+        self.assertIsNotNone(query.heartbeat_at)
+
+    @override_settings(REPORT_CHECK_POINT_ROWS=1, REPORT_HEARTBEAT_INTERVAL=0)
+    def test_reaped_while_generating(self):
+        query = self._create_query({}, {})
+
+        def reap(report_model):
+            # The reaper requeued the report, this attempt must stop without notify
+            ReportQuery.objects.filter(pk=report_model.pk).update(status=STATUS_CREATED)
+            return False
+
+        with patch.object(ReportQuery, 'is_canceled', autospec=True, side_effect=reap):
+            generate_report(query.pk)
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_CREATED)
+        self.assertIsNone(query.storage_path_location)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_reaped_without_check_points(self):
+        query = self._create_query({}, {})
+
+        def generate(buffer, tmp_dir):
+            # Custom generate without rows, requeued by the reaper
+            ReportQuery.objects.filter(pk=query.pk).update(status=STATUS_CREATED)
+
+        with patch.object(ReportModelGenerator, 'generate', side_effect=generate), \
+                patch.object(ReportModelGenerator, 'save') as mock_save:
+            generate_report(query.pk)
+
+        self.assertFalse(mock_save.called)
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_CREATED)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def _generate_reaped_on_upload(self, query):
+        original = ReportModelGenerator.save
+
+        def save(report, buffer):
+            path = original(report, buffer)
+            ReportQuery.objects.filter(pk=query.pk).update(status=STATUS_CREATED)
+            return path
+
+        with patch.object(ReportModelGenerator, 'save', autospec=True, side_effect=save):
+            generate_report(query.pk)
+
+    def test_reaped_while_uploading(self):
+        query = self._create_query({}, {})
+
+        self._generate_reaped_on_upload(query)
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_CREATED)
+        self.assertIsNone(query.storage_path_location)
+        self.assertEqual([name for _, _, names in os.walk(self.tmp_dir.name) for name in names], [])
+
+    def test_reaped_while_uploading_shared_content(self):
+        self.report.content_addressed = True
+        self.report.save()
+        done = self._create_query({}, {})
+        generate_report(done.pk)
+        done.refresh_from_db()
+        query = self._create_query({'other': 'params'}, {})
+
+        self._generate_reaped_on_upload(query)
+
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, done.storage_path_location)))
+
+    @patch('django_easy_report.tasks.generate_report.delay')
+    def test_reap_requeue(self, mock_delay):
+        query = self._create_stale_query()
+
+        self.assertEqual(reap_reports(), 1)
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_CREATED)
+        mock_delay.assert_called_once_with(query.pk)
+        self.assertEqual(len(mail.outbox), 0)
+
+    @patch('django_easy_report.tasks.generate_report.delay')
+    def test_reap_max_attempts(self, mock_delay):
+        query = self._create_stale_query(attempts=3)
+
+        self.assertEqual(reap_reports(max_attempts=3), 1)
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_ERROR)
+        self.assertFalse(mock_delay.called)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Something was wrong', mail.outbox[0].body)
+
+    @patch('django_easy_report.tasks.generate_report.delay')
+    def test_reap_max_attempts_removes_parts(self, mock_delay):
+        query = self._create_stale_query(attempts=3)
+        storage = self.report.sender.get_storage()
+        path = storage.save('parts/{}/1-2.part'.format(query.pk), ContentFile(b'admin\n'))
+        ReportQuery.objects.filter(pk=query.pk).update(checkpoint=json.dumps({'parts': [path]}))
+
+        self.assertEqual(reap_reports(max_attempts=3), 1)
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_ERROR)
+        self.assertIsNone(query.checkpoint)
+        self.assertFalse(storage.exists(path))
+
+    @patch('django_easy_report.tasks.generate_report.delay')
+    def test_reap_ignore_alive(self, mock_delay):
+        self._create_stale_query(minutes=1)
+        self.assertEqual(reap_reports(), 0)
+        self.assertFalse(mock_delay.called)
+
+    @patch('django_easy_report.tasks.generate_report.delay')
+    def test_reaped_query_generated_again(self, mock_delay):
+        query = self._create_stale_query()
+        reap_reports()
+
+        generate_report(query.pk)
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_DONE)
+        self.assertEqual(query.attempts, 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class ReportCheckpointTestCase(ReportBaseTestCase):
+
+    def setUp(self):
+        super(ReportCheckpointTestCase, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self._setup_sender(self.tmp_dir.name)
+        for pos in range(5):
+            get_user_model().objects.create_user('user{}'.format(pos), 'user{}@localhost'.format(pos), 'user')
+        init_params = json.loads(self.report.init_params)
+        init_params['chunk_size'] = 2
+        self.report.init_params = json.dumps(init_params)
+        self.report.save()
+
+    def _read_report(self, query):
+        query.refresh_from_db()
+        with query.get_file(open_file=True, mode='rb') as report_file:
+            return report_file.read().decode()
+
+    def test_generate_by_chunks(self):
+        query = self._create_query({}, {})
+        generate_report(query.pk)
+
+        content = self._read_report(query)
+        self.assertEqual(query.status, STATUS_DONE)
+        self.assertEqual(query.rows, 6)
+        self.assertIsNone(query.checkpoint)
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertTrue(lines[1].startswith('admin,'))
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir.name, 'parts', str(query.pk))), [])
+
+    @patch('django_easy_report.tasks.generate_report.apply_async')
+    def test_resume_from_checkpoint(self, mock_retry):
+        query = self._create_query({}, {})
+        original = ReportModelGenerator.get_row
+        rows = []
+
+        def fail_on_fifth_row(report, item):
+            rows.append(item.pk)
+            if len(rows) == 5:
+                raise ConnectionError('Database failover')
+            return original(report, item)
+
+        with patch.object(ReportModelGenerator, 'get_row', autospec=True, side_effect=fail_on_fifth_row):
+            generate_report(query.pk)
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_CREATED)
+        self.assertEqual(query.rows, 4)
+        checkpoint = query.get_checkpoint()
+        self.assertEqual(len(checkpoint['parts']), 2)
+        self.assertEqual(checkpoint['last_pk'], rows[3])
+        mock_retry.assert_called_once_with((query.pk, ), countdown=60)
+        self.assertEqual(len(mail.outbox), 0)
+
+        rows.clear()
+        with patch.object(ReportModelGenerator, 'get_row', autospec=True, side_effect=original) as mock_row:
+            generate_report(query.pk)
+        self.assertEqual(mock_row.call_count, 2)
+
+        content = self._read_report(query)
+        self.assertEqual(query.status, STATUS_DONE)
+        self.assertEqual(query.attempts, 2)
+        self.assertEqual(query.rows, 6)
+        self.assertIsNone(query.checkpoint)
+        self.assertEqual(len(content.splitlines()), 7)
+        self.assertEqual(len(set(content.splitlines())), 7)
+        for path in checkpoint['parts']:
+            self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, path)))
+        self.assertEqual(len(mail.outbox), 1)
+
+    @patch('django_easy_report.tasks.generate_report.apply_async')
+    def test_fail_after_max_attempts(self, mock_retry):
+        query = self._create_query({}, {})
+        storage = self.report.sender.get_storage()
+        path = storage.save('parts/{}/1-2.part'.format(query.pk), ContentFile(b'admin\n'))
+        ReportQuery.objects.filter(pk=query.pk).update(
+            attempts=2, checkpoint=json.dumps({'parts': [path], 'rows': 1, 'last_pk': 2})
+        )
+
+        with patch.object(ReportModelGenerator, 'get_row', side_effect=ConnectionError('Database failover')):
+            with self.assertRaises(ConnectionError):
+                generate_report(query.pk)
+
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_ERROR)
+        self.assertFalse(mock_retry.called)
+        self.assertIsNone(query.checkpoint)
+        self.assertFalse(storage.exists(path))
+
+    def test_parts_kept_when_reaped(self):
+        query = self._create_query({}, {})
+
+        # Other attempt took over the report, it could be resuming from the same parts
+        with patch.object(ReportQuery, 'save_result', return_value=False):
+            generate_report(query.pk)
+
+        parts = os.listdir(os.path.join(self.tmp_dir.name, 'parts', str(query.pk)))
+        self.assertEqual(len(parts), 3)
+
+    def test_delete_query_removes_parts(self):
+        query = self._create_query({}, {})
+        storage = self.report.sender.get_storage()
+        path = storage.save('parts/{}/1-2.part'.format(query.pk), ContentFile(b'admin'))
+        ReportQuery.objects.filter(pk=query.pk).update(checkpoint=json.dumps({'parts': [path]}))
+
+        ReportQuery.objects.get(pk=query.pk).delete()
+
+        self.assertFalse(storage.exists(path))
+
+
+class ReportProgressTestCase(ReportBaseTestCase):
+
+    def setUp(self):
+        super(ReportProgressTestCase, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self._setup_sender(self.tmp_dir.name)
+        for pos in range(3):
+            get_user_model().objects.create_user('user{}'.format(pos), 'user{}@localhost'.format(pos), 'user')
+
+    def _set_chunk_size(self, chunk_size):
+        init_params = json.loads(self.report.init_params)
+        init_params['chunk_size'] = chunk_size
+        self.report.init_params = json.dumps(init_params)
+        self.report.save()
+
+    @override_settings(REPORT_CHECK_POINT_ROWS=1, REPORT_HEARTBEAT_INTERVAL=0)
+    def test_progress_saved_with_heartbeat(self):
+        self._set_chunk_size(1)
+        query = self._create_query({}, {})
+        progress = []
+        original = ReportQuery.heartbeat
+
+        def heartbeat(report_model, **kwargs):
+            progress.append(kwargs)
+            return original(report_model, **kwargs)
+
+        with patch.object(ReportQuery, 'heartbeat', autospec=True, side_effect=heartbeat):
+            generate_report(query.pk)
+
+        self.assertEqual([item['rows'] for item in progress], [1, 2, 3, 4])
+        self.assertEqual({item['total_rows'] for item in progress}, {4})
+        self.assertTrue(all(isinstance(item['bytes_written'], int) for item in progress))
+        query.refresh_from_db()
+        self.assertEqual(query.total_rows, 4)
+        self.assertIsNotNone(query.started_at)
+
+    @override_settings(REPORT_CHECK_POINT_ROWS=1, REPORT_HEARTBEAT_INTERVAL=0)
+    def test_progress_without_count(self):
+        query = self._create_query({}, {})
+        with patch.object(QuerySet, 'count', autospec=True) as count:
+            generate_report(query.pk)
+        count.assert_not_called()
+        query.refresh_from_db()
+        self.assertEqual(query.status, STATUS_DONE)
+        self.assertEqual(query.rows, 4)
+        self.assertIsNone(query.total_rows)
+
+    def test_progress_eta(self):
+        now = timezone.now()
+        query = ReportQuery(
+            status=STATUS_WORKING, rows=25, total_rows=100, bytes_written=1024,
+            started_at=now - datetime.timedelta(seconds=60), heartbeat_at=now, progress_at=now,
+        )
+        self.assertEqual(query.get_progress(), {
+            'rows': 25,
+            'total_rows': 100,
+            'bytes_written': 1024,
+            'percent': 25,
+            'eta': now + datetime.timedelta(seconds=180),
+        })
+
+    def test_progress_eta_after_keep_alive(self):
+        query = self._create_query({}, {})
+        self.assertTrue(query.start_attempt())
+        self.assertTrue(query.heartbeat(rows=25, total_rows=100, bytes_written=1024))
+        progress_at = query.progress_at
+        eta = query.get_progress()['eta']
+        self.assertIsNotNone(progress_at)
+        self.assertIsNotNone(eta)
+        self.assertTrue(query.update_progress())
+        query.refresh_from_db()
+        self.assertGreater(query.heartbeat_at, progress_at)
+        self.assertEqual(query.progress_at, progress_at)
+        self.assertEqual(query.get_progress()['eta'], eta)
+
+    def test_progress_without_estimation(self):
+        query = ReportQuery(status=STATUS_WORKING, rows=25, started_at=timezone.now())
+        progress = query.get_progress()
+        self.assertIsNone(progress['percent'])
+        self.assertIsNone(progress['eta'])
+
+    def test_progress_done(self):
+        query = ReportQuery(status=STATUS_DONE, rows=100, total_rows=100, bytes_written=10, file_size=20)
+        progress = query.get_progress()
+        self.assertEqual(progress['rows'], 100)
+        self.assertEqual(progress['bytes_written'], 20)
+        self.assertIsNone(progress['eta'])
+
+
+class ReportTimingTestCase(ReportBaseTestCase):
+
+    def setUp(self):
+        super(ReportTimingTestCase, self).setUp()
+        self.tmp_dir = TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self._setup_sender(self.tmp_dir.name)
+
+    def test_generate_timings(self):
+        query = self._create_query({}, {})
+        generate_report(query.pk)
+
+        timings = {timing.phase: timing for timing in ReportTiming.objects.filter(query=query)}
+        self.assertEqual(set(timings.keys()), set(phase for phase, _ in TIMING_OPTIONS))
+        for timing in timings.values():
+            self.assertEqual(timing.attempt, 1)
+            self.assertGreaterEqual(timing.seconds, 0)
+        self.assertLessEqual(
+            timings[TIMING_QUERY].seconds + timings[TIMING_RENDER].seconds, timings[TIMING_GENERATE].seconds
+        )
+
+    def test_timed_iterator(self):
+        report = self._create_query({}, {}).get_report()
+
+        items = []
+        for item in report.timed_iterator(range(3)):
+            items.append(item)
+            with report.timer(TIMING_RENDER):
+                pass
+        self.assertEqual(items, [0, 1, 2])
+        self.assertEqual(set(report.timings.keys()), {TIMING_QUERY, TIMING_RENDER})
+
+    def test_timer_on_error(self):
+        report = self._create_query({}, {}).get_report()
+        with self.assertRaises(ValueError):
+            with report.timer(TIMING_QUERY):
+                raise ValueError()
+        self.assertIn(TIMING_QUERY, report.timings)
@@ -12,7 +12,7 @@ from django_easy_report.choices import (
     MODE_CRYPTOGRAPHY_ENVIRONMENT,
     MODE_CRYPTOGRAPHY_DJANGO,
 )
-from django_easy_report.models import SecretKey, ReportSender, SecretReplace
+from django_easy_report.models import SecretKey, ReportSender, SecretReplace, secret_cache
 from django_easy_report.tests.test_models_validation import BaseValidationTestCase
 from django_easy_report import utils
 
@@ -146,6 +146,74 @@ class SecretKeyModelTestCase(TestCase):
         self.assertEqual((message, ), error_context.exception.args)
 
 
+class SecretKeyCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.secret = SecretKey.objects.create_secret(
+            mode=MODE_CRYPTOGRAPHY,
+            name='Cached secret',
+            value='cached secret',
+            key='$3cRe7_K3y',
+        )
+
+    def test_decrypt_once(self):
+        self.assertEqual(self.secret.get_secret(), 'cached secret')
+        with patch('django_easy_report.models.Fernet') as fernet_mock:
+            self.assertEqual(SecretKey.objects.get(pk=self.secret.pk).get_secret(), 'cached secret')
+            self.assertFalse(fernet_mock.called)
+
+    @override_settings(REPORT_SECRET_CACHE_TTL=0)
+    def test_cache_disabled(self):
+        self.assertEqual(self.secret.get_secret(), 'cached secret')
+        self.assertEqual(self.secret.get_secret(), 'cached secret')
+        self.assertEqual(len([k for k in secret_cache._items if k[0] == self.secret.pk]), 0)
+
+    def test_unsaved_secret_not_cached(self):
+        secret = SecretKey(mode=self.secret.mode, key=self.secret.key, value=self.secret.value)
+        self.assertEqual(secret.get_secret(), 'cached secret')
+        self.assertEqual(len([k for k in secret_cache._items if k[0] is None]), 0)
+
+    def test_invalidate_on_save(self):
+        self.secret.get_secret()
+        cached = secret_cache.get((self.secret.pk, self.secret.get_version()))
+        self.secret.name = 'Renamed secret'
+        self.secret.save()
+        self.assertIsNone(secret_cache.get((self.secret.pk, self.secret.get_version())))
+        # Evicted value was wiped
+        self.assertEqual(cached, bytearray(len('cached secret')))
+
+    def test_evicted_while_read(self):
+        self.secret.get_secret()
+        original_get = secret_cache.get
+
+        def get_and_evict(*args, **kwargs):
+            value = original_get(*args, **kwargs)
+            secret_cache.clear()
+            return value
+
+        with patch.object(secret_cache, 'get', side_effect=get_and_evict):
+            self.assertEqual(SecretKey.objects.get(pk=self.secret.pk).get_secret(), 'cached secret')
+
+    def test_invalidate_on_delete(self):
+        self.secret.get_secret()
+        key = (self.secret.pk, self.secret.get_version())
+        self.secret.delete()
+        self.assertIsNone(secret_cache.get(key))
+
+    def test_new_version(self):
+        self.secret.get_secret()
+        other = SecretKey.objects.get(pk=self.secret.pk)
+        other.value = utils.encrypt(other.get_key(), 'other secret')
+        self.assertEqual(other.get_secret(), 'other secret')
+
+    def test_expired(self):
+        with patch('django_easy_report.cache.time.monotonic') as monotonic_mock:
+            monotonic_mock.return_value = 0
+            self.secret.get_secret()
+            monotonic_mock.return_value = 301
+            self.assertIsNone(secret_cache.get((self.secret.pk, self.secret.get_version())))
+
+
 class SecretKeyValidationTestCase(BaseValidationTestCase):
 
     def test_invalid_mode(self):
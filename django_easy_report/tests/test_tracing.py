@@ -0,0 +1,91 @@
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from django_easy_report import tracing
+from django_easy_report.tests.test_report_generation import ReportBaseTestCase
+
+
+class TracerTestCase(TestCase):
+
+    def test_noop_by_default(self):
+        self.assertIsInstance(tracing.get_tracer(), tracing.NoopTracer)
+        with tracing.span('test') as span:
+            self.assertIsNone(span)
+            self.assertEqual(tracing.inject(), {})
+
+    @override_settings(REPORT_TRACER='django_easy_report.tracing.InMemoryTracer')
+    def test_nested_spans(self):
+        tracer = tracing.get_tracer()
+        tracer.clear()
+        with tracing.span('parent', query=1) as parent:
+            with self.assertRaises(ValueError):
+                with tracing.span('child'):
+                    raise ValueError('Fail')
+
+        child, finished = tracer.spans
+        self.assertIs(finished, parent)
+        self.assertEqual(parent.attributes, {'query': 1})
+        self.assertIsNone(parent.parent)
+        self.assertEqual(child.parent.span_id, parent.context.span_id)
+        self.assertEqual(child.context.trace_id, parent.context.trace_id)
+        self.assertIn('Fail', child.error)
+        self.assertIsNone(tracing.current_span.get())
+
+    @override_settings(REPORT_TRACER='django_easy_report.tracing.InMemoryTracer')
+    def test_apply_async_headers(self):
+        task = Mock()
+        tracing.apply_async(task, (1, ))
+        task.delay.assert_called_once_with(1)
+
+        with tracing.span('parent') as parent:
+            tracing.apply_async(task, (1, ), countdown=5)
+        task.apply_async.assert_called_once_with((1, ), countdown=5, headers={
+            'traceparent': parent.context.to_header(),
+        })
+
+    def test_header(self):
+        context = tracing.SpanContext('a' * 32, 'b' * 16)
+        parsed = tracing.SpanContext.from_header(context.to_header())
+        self.assertEqual((parsed.trace_id, parsed.span_id), (context.trace_id, context.span_id))
+        self.assertIsNone(tracing.SpanContext.from_header('invalid'))
+        self.assertIsNone(tracing.SpanContext.from_header(None))
+
+    def test_extract_from_worker_request(self):
+        header = tracing.SpanContext('a' * 32, 'b' * 16).to_header()
+        task = SimpleNamespace(request=SimpleNamespace(headers=None, traceparent=header))
+        self.assertEqual(tracing.extract(task).span_id, 'b' * 16)
+        self.assertIsNone(tracing.extract(None))
+
+
+@override_settings(REPORT_TRACER='django_easy_report.tracing.InMemoryTracer')
+class TraceFlowTestCase(ReportBaseTestCase):
+
+    def setUp(self):
+        super(TraceFlowTestCase, self).setUp()
+        self.tracer = tracing.get_tracer()
+        self.tracer.clear()
+
+    def test_request_to_notification(self):
+        self.client.force_login(user=self.user)
+        url = reverse('django_easy_report:report_generator', kwargs={'report_name': self.report.name})
+        with TemporaryDirectory() as tmp_dirname:
+            self._setup_sender(tmp_dirname)
+            response = self.client.post(url, data={})
+        self.assertEqual(response.status_code, 201)
+
+        spans = {span.name: span for span in self.tracer.spans}
+        self.assertEqual(set(spans.keys()), {
+            'report.GenerateReport', 'report.generate', 'report.render', 'report.storage', 'report.notify',
+        })
+        request = spans['report.GenerateReport']
+        self.assertEqual({span.context.trace_id for span in spans.values()}, {request.context.trace_id})
+        self.assertEqual(request.attributes, {'method': 'POST', 'report_name': self.report.name})
+        self.assertEqual(spans['report.generate'].parent.span_id, request.context.span_id)
+        generate = spans['report.generate'].context.span_id
+        self.assertEqual(spans['report.render'].parent.span_id, generate)
+        self.assertEqual(spans['report.storage'].parent.span_id, generate)
+        self.assertEqual(spans['report.notify'].parent.span_id, generate)
@@ -0,0 +1,207 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest.mock import patch
+
+from django.core import mail
+from django.test import SimpleTestCase, override_settings
+
+from django_easy_report.constants import STATUS_ERROR
+from django_easy_report.reports import ReportModelGenerator
+from django_easy_report.tasks import notify_report_done
+from django_easy_report.tests.test_report_generation import ReportBaseTestCase
+from django_easy_report.webhooks import WebhookSender, is_allowed_webhook
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, statuses=None):
+        super(StubServer, self).__init__(('127.0.0.1', 0), StubHandler)
+        self.statuses = list(statuses or [])
+        self.received = []
+        self.clients = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def next_status(self):
+        with self.lock:
+            if self.statuses:
+                return self.statuses.pop(0)
+        return 200
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.received.append((self.path, json.loads(body)))
+            self.server.clients.add(self.client_address)
+        self.send_response(self.server.next_status())
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServerMixin(object):
+
+    def start_server(self, statuses=None):
+        server = StubServer(statuses)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+
+@override_settings(REPORT_WEBHOOK_HOSTS=['127.0.0.1'])
+class WebhookSenderTestCase(StubServerMixin, SimpleTestCase):
+
+    def test_send_concurrently_reusing_connections(self):
+        server = self.start_server()
+        deliveries = [('{}/hook?id={}'.format(server.url, pos), {'pos': pos}) for pos in range(20)]
+        results = WebhookSender(concurrency=4, backoff=0).send(deliveries)
+        self.assertEqual(results, [True] * 20)
+        self.assertEqual(
+            sorted(path for path, _ in server.received),
+            sorted('/hook?id={}'.format(pos) for pos in range(20))
+        )
+        self.assertLessEqual(len(server.clients), 4)
+
+    def test_retry_server_errors(self):
+        server = self.start_server(statuses=[500, 503])
+        results = WebhookSender(retries=3, backoff=0).send([(server.url, {})])
+        self.assertEqual(results, [True])
+        self.assertEqual(len(server.received), 3)
+
+    def test_retry_exhausted(self):
+        server = self.start_server(statuses=[500, 500, 500])
+        results = WebhookSender(retries=2, backoff=0).send([(server.url, {})])
+        self.assertEqual(results, [False])
+        self.assertEqual(len(server.received), 3)
+
+    def test_client_error_not_retried(self):
+        server = self.start_server(statuses=[404])
+        results = WebhookSender(retries=3, backoff=0).send([(server.url, {})])
+        self.assertEqual(results, [False])
+        self.assertEqual(len(server.received), 1)
+
+    def test_connection_error(self):
+        server = self.start_server()
+        url = server.url
+        server.shutdown()
+        server.server_close()
+        results = WebhookSender(retries=1, backoff=0, timeout=1).send([(url, {})])
+        self.assertEqual(results, [False])
+
+    def test_exponential_backoff(self):
+        server = self.start_server(statuses=[500, 500, 500])
+        with patch('django_easy_report.webhooks.asyncio.sleep') as mock_sleep:
+            async def no_wait(delay):
+                pass
+            mock_sleep.side_effect = no_wait
+            WebhookSender(retries=3, backoff=0.5).send([(server.url, {})])
+        self.assertEqual([args[0][0] for args in mock_sleep.call_args_list], [0.5, 1, 2])
+
+    def test_without_deliveries(self):
+        self.assertEqual(WebhookSender().send([]), [])
+
+    @override_settings(REPORT_WEBHOOK_HOSTS=['example.com'])
+    def test_is_allowed_webhook(self):
+        self.assertTrue(is_allowed_webhook('https://example.com/hook'))
+        self.assertFalse(is_allowed_webhook('https://other.example.com/hook'))
+        self.assertFalse(is_allowed_webhook('http://127.0.0.1/hook'))
+        self.assertFalse(is_allowed_webhook('file:///etc/passwd'))
+        self.assertFalse(is_allowed_webhook('http://'))
+        self.assertFalse(is_allowed_webhook('http://example.com:port/hook'))
+
+    @override_settings(REPORT_WEBHOOK_HOSTS=None)
+    @patch('django_easy_report.webhooks.socket.getaddrinfo')
+    def test_is_allowed_webhook_public_addresses(self, mock_getaddrinfo):
+        def resolve(*addresses):
+            mock_getaddrinfo.return_value = [(None, None, None, '', (address, 443)) for address in addresses]
+
+        resolve('93.184.216.34')
+        self.assertTrue(is_allowed_webhook('https://example.com/hook'))
+        for address in ('127.0.0.1', '10.0.0.1', '192.168.1.1', '169.254.169.254', '::1', 'fe80::1%eth0',
+                        '::ffff:127.0.0.1'):
+            resolve(address)
+            self.assertFalse(is_allowed_webhook('https://example.com/hook'), address)
+        resolve('93.184.216.34', '10.0.0.1')
+        self.assertFalse(is_allowed_webhook('https://example.com/hook'))
+        mock_getaddrinfo.side_effect = socket.gaierror()
+        self.assertFalse(is_allowed_webhook('https://unknown.example.com/hook'))
+
+    @override_settings(REPORT_WEBHOOK_HOSTS=None)
+    def test_private_address_refused_on_connect(self):
+        server = self.start_server()
+        self.assertEqual(WebhookSender(retries=0).send([(server.url, {})]), [False])
+        self.assertEqual(server.received, [])
+
+
+@override_settings(REPORT_WEBHOOK_BACKOFF=0, REPORT_WEBHOOK_RETRIES=1, REPORT_WEBHOOK_HOSTS=['127.0.0.1'])
+@patch.object(ReportModelGenerator, 'webhook_param', 'webhook')
+class WebhookNotificationTestCase(StubServerMixin, ReportBaseTestCase):
+
+    def test_notify_by_webhook(self):
+        server = self.start_server()
+        query = self._create_query({}, {'webhook': server.url + '/done'})
+        query.status = STATUS_ERROR
+        query.save()
+        requester = query.reportrequester_set.get()
+
+        notify_report_done([requester.pk])
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(server.received), 1)
+        path, payload = server.received[0]
+        self.assertEqual(path, '/done')
+        self.assertEqual(payload['query'], query.pk)
+        self.assertEqual(payload['requester'], requester.pk)
+        self.assertEqual(payload['status'], {'code': STATUS_ERROR, 'name': 'Error'})
+        self.assertIsNone(payload['link'])
+        requester.refresh_from_db()
+        self.assertTrue(requester.notified)
+
+    def test_notify_by_webhook_failing(self):
+        server = self.start_server(statuses=[500, 500])
+        query = self._create_query({}, {'webhook': server.url})
+        requester = query.reportrequester_set.get()
+
+        notify_report_done([requester.pk])
+
+        self.assertEqual(len(server.received), 2)
+        requester.refresh_from_db()
+        self.assertFalse(requester.notified)
+
+    @override_settings(REPORT_WEBHOOK_HOSTS=['example.com'])
+    def test_notify_by_webhook_not_allowed(self):
+        server = self.start_server()
+        query = self._create_query({}, {'webhook': server.url})
+        requester = query.reportrequester_set.get()
+
+        notify_report_done([requester.pk])
+
+        self.assertEqual(len(server.received), 0)
+        requester.refresh_from_db()
+        self.assertFalse(requester.notified)
+
+    def test_notify_without_webhook_by_email(self):
+        query = self._create_query({}, {})
+        query.status = STATUS_ERROR
+        query.save()
+        requester = query.reportrequester_set.get()
+
+        notify_report_done([requester.pk])
+
+        self.assertEqual(len(mail.outbox), 1)
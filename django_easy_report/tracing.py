@@ -0,0 +1,202 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from celery import current_task
+from django.conf import settings
+
+from django_easy_report.utils import import_class
+
+# W3C trace context header, used on the Celery task headers
+TRACE_HEADER = 'traceparent'
+
+current_span = contextvars.ContextVar('django_easy_report_span', default=None)
+
+
+class SpanContext(object):
+    """
+    Identifies a span, it is propagated to the child spans on the same or other process
+    """
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    def to_header(self):
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    @classmethod
+    def from_header(cls, value):
+        """
+        :param value: traceparent header
+        :type value: str|None
+        :rtype: SpanContext|None
+        """
+        try:
+            _, trace_id, span_id, _ = (value or '').split('-')
+        except ValueError:
+            return
+        if len(trace_id) != 32 or len(span_id) != 16:
+            return
+        return cls(trace_id, span_id)
+
+
+class Span(object):
+
+    def __init__(self, name, context, parent=None, attributes=None):
+        self.name = name
+        self.context = context
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start = time.time()
+        self.end = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+class NoopTracer(object):
+    """
+    Default tracer, it does not create spans
+    """
+
+    @contextmanager
+    def start_span(self, name, parent=None, **attributes):
+        """
+        :param name: span name
+        :type name: str
+        :param parent: parent span, by default the current span
+        :type parent: SpanContext|None
+        :param attributes: span attributes
+        :return: context manager with the span, None if the tracer does not trace
+        """
+        yield None
+
+
+class Tracer(NoopTracer):
+    """
+    Base of the tracers that create spans, export must be implemented to send them
+    """
+
+    @contextmanager
+    def start_span(self, name, parent=None, **attributes):
+        if parent is None:
+            active = current_span.get()
+            parent = active.context if active else None
+        trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        span = Span(name, SpanContext(trace_id, os.urandom(8).hex()), parent=parent, attributes=attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except Exception as ex:
+            span.error = repr(ex)
+            raise
+        finally:
+            current_span.reset(token)
+            span.end = time.time()
+            self.export(span)
+
+    def export(self, span):  # pragma: no cover
+        """
+        :param span: finished span
+        :type span: Span
+        """
+        raise NotImplementedError()
+
+
+class InMemoryTracer(Tracer):
+    """
+    Keep the finished spans on memory, used for testing
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+_tracer = None
+_tracer_class_name = None
+
+
+def get_tracer():
+    """
+    :return: instance of REPORT_TRACER class, shared by the process
+    :rtype: NoopTracer
+    """
+    global _tracer, _tracer_class_name
+    class_name = getattr(settings, 'REPORT_TRACER', None)
+    if _tracer is None or class_name != _tracer_class_name:
+        tracer_class = import_class(class_name) if class_name else NoopTracer
+        _tracer, _tracer_class_name = tracer_class(), class_name
+    return _tracer
+
+
+def span(name, parent=None, **attributes):
+    """
+    :return: context manager with a span of the current tracer
+    """
+    return get_tracer().start_span(name, parent=parent, **attributes)
+
+
+def inject():
+    """
+    :return: headers with the context of the current span, empty if there is not span
+    :rtype: dict
+    """
+    active = current_span.get()
+    if active is None:
+        return {}
+    return {TRACE_HEADER: active.context.to_header()}
+
+
+def extract(task):
+    """
+    :param task: Celery task being executed, None if it is called directly
+    :return: context of the span that enqueued the task
+    :rtype: SpanContext|None
+    """
+    request = getattr(task, 'request', None)
+    if request is None:
+        return
+    headers = getattr(request, 'headers', None) or {}
+    # Custom headers are request attributes on the workers and on headers when the task is eager
+    return SpanContext.from_header(headers.get(TRACE_HEADER) or getattr(request, TRACE_HEADER, None))
+
+
+def traced_task(name):
+    """
+    Decorator of Celery tasks that run them inside a span, child of the span that enqueued the task
+    :param name: span name
+    :type name: str
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, parent=extract(current_task), task=func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def apply_async(task, args, **options):
+    """
+    Enqueue the task propagating the current span on the task headers
+    """
+    headers = inject()
+    if headers:
+        options['headers'] = headers
+    if options:
+        return task.apply_async(args, **options)
+    return task.delay(*args)
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.conf.urls import url
 import django_easy_report.views as views
 
@@ -6,4 +7,10 @@ urlpatterns = [
         views.GenerateReport.as_view(), name='report_generator'),
     url(r'^(?P<report_name>[-\w]+)/(?P<query_pk>[-\w]+)/$',
         views.DownloadReport.as_view(), name='report_download'),
+    url(r'^(?P<report_name>[-\w]+)/(?P<query_pk>[-\w]+)/cancel/$',
+        views.CancelReport.as_view(), name='report_cancel'),
 ]
+
+if getattr(settings, 'REPORT_METRICS', False):
+    # Before the reports, so it is not taken as report name
+    urlpatterns.insert(0, url(r'^metrics/$', views.ReportMetrics.as_view(), name='report_metrics'))
@@ -1,9 +1,13 @@
 import base64
+import hashlib
+import io
 import json
 import os
 import string
+import time
 
 from django.conf import settings
+from django.core import signing
 
 from django_easy_report.choices import (
     MODE_CRYPTOGRAPHY,
@@ -16,6 +20,63 @@ try:
 except ImportError:  # pragma: no cover
     Fernet = None
 
+DOWNLOAD_TOKEN_SALT = 'django_easy_report.download'
+
+
+class ChecksumWriter(io.FileIO):
+    """
+    File that compute the size and the checksum of the content while it is written.
+    It is still a real file, the generators could seek it or use its name.
+    """
+    algorithm = 'sha256'
+
+    def __init__(self, file, mode='wb', **kwargs):
+        super(ChecksumWriter, self).__init__(file, mode, **kwargs)
+        self.size = 0
+        self.hash = hashlib.new(self.algorithm)
+        self.sequential = True
+
+    def write(self, data):
+        position = self.tell()
+        written = super(ChecksumWriter, self).write(data)
+        if not written:
+            return written
+        if self.sequential and position == self.size:
+            self.hash.update(memoryview(data)[:written])
+        else:
+            # Part of the content was rewritten, the checksum is computed again from the file
+            self.sequential = False
+        self.size = max(self.size, position + written)
+        return written
+
+    def truncate(self, size=None):
+        size = super(ChecksumWriter, self).truncate(size)
+        if size < self.size:
+            self.sequential = False
+        self.size = size
+        return size
+
+    def wrap(self, binary=True):
+        """
+        :param binary: if False the buffer will be on text mode
+        :type binary: bool
+        :return: buffer with the same interface as builtin open
+        """
+        buffer = io.BufferedRandom(self) if self.readable() else io.BufferedWriter(self)
+        if not binary:
+            buffer = io.TextIOWrapper(buffer)
+        return buffer
+
+    @property
+    def checksum(self):
+        if self.sequential:
+            return self.hash.hexdigest()
+        checksum = hashlib.new(self.algorithm)
+        with open(self.name, mode='rb') as stream:
+            for chunk in iter(lambda: stream.read(io.DEFAULT_BUFFER_SIZE), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
 
 def import_class(class_name):
     mod_name, cls_name = class_name.rsplit('.', 1)
@@ -70,3 +131,41 @@ def encrypt(key, plain):
 
     key = base64.urlsafe_b64encode(key)
     return Fernet(key).encrypt(plain.encode()).decode()
+
+
+def sign_download(data, max_age):
+    """
+    :param data: information needed to serve the file without database lookups
+    :type data: dict
+    :param max_age: seconds until the token expire
+    :type max_age: int
+    :return: signed token
+    :rtype: str
+    """
+    data = dict(data)
+    data['exp'] = int(time.time()) + int(max_age)
+    return signing.dumps(data, salt=DOWNLOAD_TOKEN_SALT, compress=True)
+
+
+def unsign_download(token):
+    """
+    :param token: token generated by sign_download
+    :type token: str
+    :return: data signed on the token
+    :rtype: dict
+    :raise signing.BadSignature: if the token is invalid or expired
+    """
+    data = signing.loads(token, salt=DOWNLOAD_TOKEN_SALT)
+    if not isinstance(data, dict) or data.get('exp', 0) < time.time():
+        raise signing.SignatureExpired('Download token expired')
+    return data
+
+
+def wipe(value):
+    """
+    Best effort to remove the content of a mutable buffer from memory
+    :param value: buffer to overwrite with zeros
+    :type value: bytearray
+    """
+    if isinstance(value, bytearray):
+        value[:] = b'\x00' * len(value)
@@ -1,15 +1,27 @@
 import json
 import os
 
+from django.conf import settings
+from django.core import signing
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import transaction
+from django.db.models import Count
 from django.http import JsonResponse, HttpResponse, Http404
+from django.shortcuts import redirect
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
-from django_easy_report.models import ReportGenerator, ReportQuery, ReportRequester
+from django_easy_report import metrics, tracing
+from django_easy_report.constants import STATUS_DONE, STATUS_CANCELED, STATUS_OPTIONS
+from django_easy_report.models import ReportGenerator, ReportQuery, ReportRequester, ReportSender, ReportNotification
 from django_easy_report.serializers import DjangoEasyReportJSONEncoder
-from django_easy_report.tasks import generate_report, notify_report_done
+from django_easy_report.tasks import generate_report, notify_report_done, outbox_enabled
+from django_easy_report.utils import unsign_download
 
 
 class BaseReportingView(View):
@@ -17,6 +29,10 @@ class BaseReportingView(View):
         super(BaseReportingView, self).__init__(**kwargs)
         self.report = None
 
+    def dispatch(self, request, *args, **kwargs):
+        with tracing.span('report.{}'.format(self.__class__.__name__), method=request.method, **kwargs):
+            return super(BaseReportingView, self).dispatch(request, *args, **kwargs)
+
     def check_permissions(self):
         permissions = []
         if self.report and self.report.permissions:
@@ -86,9 +102,13 @@ class GenerateReport(BaseReportingView):
         })
 
         params_hash = ReportQuery.gen_hash(report_params)
-        if not self.is_force_generate():
-            previous = ReportQuery.objects.filter(params_hash=params_hash).last()
+        force_generate = self.is_force_generate()
+        if not force_generate:
+            previous = ReportQuery.objects.filter(params_hash=params_hash).exclude(
+                status=STATUS_CANCELED
+            ).exclude(ReportQuery.stale()).last()
             if previous:
+                metrics.inc(metrics.REQUESTS, report=self.report.name, result='hit')
                 return JsonResponse({
                     'find': previous.pk,
                     'created_at': previous.created_at,
@@ -97,17 +117,22 @@ class GenerateReport(BaseReportingView):
                         'code': previous.status,
                         'name': previous.get_status_display()
                     },
+                    'progress': previous.get_progress(),
                 }, status=200)
 
         query_pk = request.GET.get(self.KEY_NOTIFY)
         if query_pk:
             if ReportQuery.objects.filter(params_hash=params_hash, pk=query_pk).exists():
-                requester = ReportRequester.objects.create(
-                    query_id=query_pk,
-                    user=request.user,
-                    user_params=json.dumps(user_params)
-                )
-                notify_report_done.delay([requester.pk])
+                with transaction.atomic():
+                    requester = ReportRequester.objects.create(
+                        query_id=query_pk,
+                        user=request.user,
+                        user_params=json.dumps(user_params)
+                    )
+                    if outbox_enabled():
+                        ReportNotification.objects.create(requester=requester)
+                if not outbox_enabled():
+                    tracing.apply_async(notify_report_done, ([requester.pk], ))
                 return JsonResponse({
                     'accepted': query_pk,
                 }, status=202)
@@ -124,15 +149,68 @@ class GenerateReport(BaseReportingView):
             user=request.user,
             user_params=json.dumps(user_params)
         )
-        generate_report.delay(query.pk)
+        tracing.apply_async(generate_report, (query.pk, ))
+        metrics.inc(metrics.REQUESTS, report=self.report.name, result='forced' if force_generate else 'miss')
 
         return JsonResponse({
             'created': query.pk,
         }, status=201)
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class CancelReport(BaseReportingView):
+
+    def post(self, request, report_name, query_pk):
+        try:
+            self.report = ReportGenerator.objects.get(name=report_name)
+            query = ReportQuery.objects.get(report=self.report, pk=query_pk)
+        except (ReportGenerator.DoesNotExist, ReportQuery.DoesNotExist):
+            return JsonResponse({'error': 'query not found'}, status=404)
+
+        try:
+            self.check_permissions()
+            if not (request.user.is_staff or query.reportrequester_set.filter(user=request.user).exists()):
+                raise PermissionDenied()
+        except PermissionDenied:
+            return JsonResponse({'error': 'forbidden'}, status=403)
+
+        if not query.cancel():
+            return JsonResponse({
+                'error': 'report cannot be canceled',
+                'status': {
+                    'code': query.status,
+                    'name': query.get_status_display(),
+                },
+            }, status=409)
+        return JsonResponse({
+            'canceled': query.pk,
+        }, status=202)
+
+
+class ReportMetrics(View):
+
+    def get(self, request):
+        if not metrics.enabled():
+            raise Http404()
+        token = getattr(settings, 'REPORT_METRICS_TOKEN', None)
+        if token and not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer {}'.format(token)):
+            return HttpResponse(status=401)
+        status_names = dict(STATUS_OPTIONS)
+        queries = {}
+        for status, count in ReportQuery.objects.order_by().values_list('status').annotate(count=Count('pk')):
+            queries[metrics.label_key({'status': status_names.get(status, status)})] = count
+        content = metrics.render(metrics.registry.collect(), gauges={metrics.QUERIES: queries})
+        return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class DownloadReport(BaseReportingView):
+    KEY_TOKEN = 'token'
+
     def get(self, request, report_name, query_pk):
+        token = request.GET.get(self.KEY_TOKEN)
+        if token:
+            return self.get_from_token(token, report_name, query_pk)
+
         try:
             self.report = ReportGenerator.objects.get(name=report_name)
             query = ReportQuery.objects.get(report=self.report, pk=query_pk)
@@ -140,13 +218,99 @@ class DownloadReport(BaseReportingView):
             raise Http404()
         self.check_permissions()
 
+        validators = {}
+        if query.status == STATUS_DONE:
+            validators = {
+                'etag': query.get_etag(),
+                'last_modified': int(query.updated_at.timestamp()),
+                'cache_control': self.report.cache_control,
+            }
+            not_modified = self.conditional_response(**validators)
+            if not_modified:
+                return not_modified
+
         remote_file = query.get_file()
         if remote_file is None:
             raise Http404()
+        metrics.inc(metrics.DOWNLOADS, report=report_name)
         if isinstance(remote_file, HttpResponse):
             return remote_file
+        response = self.file_response(remote_file, query.filename, query.mimetype, size=query.file_size)
+        return self.set_validators(response, **validators)
+
+    def get_from_token(self, token, report_name, query_pk):
+        try:
+            data = unsign_download(token)
+        except signing.BadSignature:
+            raise PermissionDenied()
+        if data.get('r') != report_name or str(data.get('q')) != str(query_pk):
+            raise PermissionDenied()
+        validators = {
+            'etag': data.get('e'),
+            'last_modified': data.get('t'),
+            'cache_control': data.get('cc'),
+        }
+        not_modified = self.conditional_response(**validators)
+        if not_modified:
+            return not_modified
+
+        try:
+            storage = ReportSender.get_pooled_storage(data.get('s'), parse_datetime(data.get('su') or ''))
+        except ReportSender.DoesNotExist:
+            storage = None
+        path = data.get('p')
+        if storage is None or not storage.exists(path):
+            # Report moved to other sender after the token was signed
+            storage, path = self.get_moved_report(report_name, query_pk)
+        metrics.inc(metrics.DOWNLOADS, report=report_name)
+        if not data.get('d'):
+            try:
+                return redirect(storage.url(path))
+            except NotImplementedError:  # pragma: no cover
+                pass
+        response = self.file_response(storage.open(path, 'rb'), data.get('f'), data.get('m'), size=data.get('z'))
+        return self.set_validators(response, **validators)
+
+    def get_moved_report(self, report_name, query_pk):
+        """
+        :return: storage and path where the report is stored now
+        :rtype: (Storage, str)
+        """
+        query = ReportQuery.objects.filter(
+            pk=query_pk, report__name=report_name, status=STATUS_DONE
+        ).select_related('report__sender', 'sender').first()
+        if not query or not query.storage_path_location:
+            raise Http404()
+        storage = query.get_sender().get_storage()
+        if not storage or not storage.exists(query.storage_path_location):
+            raise Http404()
+        return storage, query.storage_path_location
+
+    def conditional_response(self, etag=None, last_modified=None, cache_control=None):
+        """
+        :return: Not Modified response if the client have the last version of the report
+        :rtype: HttpResponse|None
+        """
+        if not (etag or last_modified):
+            return
+        response = get_conditional_response(self.request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return self.set_validators(response, etag=etag, last_modified=last_modified, cache_control=cache_control)
+
+    def set_validators(self, response, etag=None, last_modified=None, cache_control=None):
+        if etag:
+            response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        if cache_control:
+            response['Cache-Control'] = cache_control
+        return response
+
+    def file_response(self, remote_file, filename, mimetype, size=None):
         response = HttpResponse(remote_file)
-        filename = os.path.basename(query.filename)
+        filename = os.path.basename(filename)
         response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
-        response['Content-Type'] = query.mimetype
+        response['Content-Type'] = mimetype
+        if size is not None:
+            response['Content-Length'] = size
         return response
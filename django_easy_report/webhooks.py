@@ -0,0 +1,198 @@
+import asyncio
+import http.client
+import ipaddress
+import json
+import logging
+import socket
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+logger = logging.getLogger(__name__)
+
+
+def get_allowed_hosts():
+    """
+    :return: REPORT_WEBHOOK_HOSTS or None if it is not defined
+    :rtype: list|tuple|None
+    """
+    allowed_hosts = getattr(settings, 'REPORT_WEBHOOK_HOSTS', None)
+    if isinstance(allowed_hosts, (list, tuple)):
+        return allowed_hosts
+
+
+def is_public_address(address):
+    """
+    :param address: IP address, IPv6 could have scope
+    :type address: str
+    :return: False for private, loopback, link-local and reserved addresses
+    :rtype: bool
+    """
+    try:
+        return ipaddress.ip_address(address.split('%', 1)[0]).is_global
+    except ValueError:
+        return False
+
+
+def is_allowed_webhook(url):
+    """
+    :param url: webhook URL
+    :type url: str
+    :return: True if the URL is http(s) and the host is on REPORT_WEBHOOK_HOSTS,
+        without REPORT_WEBHOOK_HOSTS the host must resolve only to public addresses
+    :rtype: bool
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return False
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        return False
+    allowed_hosts = get_allowed_hosts()
+    if allowed_hosts is not None:
+        return parts.hostname in allowed_hosts
+    # The URLs are given by the requesters, they must not reach the internal network
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError):
+        return False
+    return bool(addresses) and all(is_public_address(address[4][0]) for address in addresses)
+
+
+class PublicAddressMixin(object):
+    """
+    Refuse to talk with private addresses, the host could resolve to other address after it was allowed
+    """
+
+    def connect(self):
+        super(PublicAddressMixin, self).connect()
+        address = self.sock.getpeername()[0]
+        if not is_public_address(address):
+            self.close()
+            raise OSError('Webhook address {} is not public'.format(address))
+
+
+class PublicHTTPConnection(PublicAddressMixin, http.client.HTTPConnection):
+    pass
+
+
+class PublicHTTPSConnection(PublicAddressMixin, http.client.HTTPSConnection):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Keep alive HTTP connections, grouped by scheme and location
+    """
+
+    def __init__(self, timeout=None, public_only=False):
+        """
+        :param public_only: connect only to public addresses
+        :type public_only: bool
+        """
+        self.timeout = timeout
+        self.public_only = public_only
+        self._connections = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, netloc):
+        with self._lock:
+            if self._connections[(scheme, netloc)]:
+                return self._connections[(scheme, netloc)].pop()
+        if scheme == 'https':
+            connection_class = PublicHTTPSConnection if self.public_only else http.client.HTTPSConnection
+        else:
+            connection_class = PublicHTTPConnection if self.public_only else http.client.HTTPConnection
+        return connection_class(netloc, timeout=self.timeout)
+
+    def release(self, scheme, netloc, connection):
+        with self._lock:
+            self._connections[(scheme, netloc)].append(connection)
+
+    def close(self):
+        with self._lock:
+            for connections in self._connections.values():
+                for connection in connections:
+                    connection.close()
+            self._connections.clear()
+
+
+class WebhookSender(object):
+    """
+    Deliver JSON payloads to webhooks concurrently, retrying with exponential backoff.
+    The requests are done on a thread pool driven by asyncio, reusing the connections for the same host.
+    """
+
+    def __init__(self, timeout=None, retries=None, backoff=None, concurrency=None):
+        self.timeout = timeout if timeout is not None else getattr(settings, 'REPORT_WEBHOOK_TIMEOUT', 10)
+        self.retries = retries if retries is not None else getattr(settings, 'REPORT_WEBHOOK_RETRIES', 3)
+        self.backoff = backoff if backoff is not None else getattr(settings, 'REPORT_WEBHOOK_BACKOFF', 1)
+        self.concurrency = concurrency or getattr(settings, 'REPORT_WEBHOOK_CONCURRENCY', 10)
+        self.pool = ConnectionPool(timeout=self.timeout, public_only=get_allowed_hosts() is None)
+
+    def send(self, deliveries):
+        """
+        :param deliveries: list of (url, payload)
+        :type deliveries: list
+        :return: for each delivery, True if the webhook accepted the payload
+        :rtype: list
+        """
+        if not deliveries:
+            return []
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            return loop.run_until_complete(self._send_all(loop, executor, deliveries))
+        finally:
+            loop.close()
+            executor.shutdown(wait=True)
+            self.pool.close()
+
+    async def _send_all(self, loop, executor, deliveries):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*[
+            self._deliver(loop, executor, semaphore, url, payload) for url, payload in deliveries
+        ])
+
+    async def _deliver(self, loop, executor, semaphore, url, payload):
+        body = json.dumps(payload, cls=DjangoJSONEncoder).encode()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                async with semaphore:
+                    status = await loop.run_in_executor(executor, self._post, url, body)
+            except (OSError, http.client.HTTPException) as ex:
+                logger.warning('Error calling webhook: %s', ex, extra={'url': url, 'attempt': attempt})
+                continue
+            if 200 <= status < 300:
+                return True
+            logger.warning('Webhook response %s', status, extra={'url': url, 'attempt': attempt})
+            if status < 500 and status != 429:
+                # Client errors will not change retrying
+                return False
+        return False
+
+    def _post(self, url, body):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        connection = self.pool.acquire(parts.scheme, parts.netloc)
+        try:
+            connection.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.release(parts.scheme, parts.netloc, connection)
+        return response.status